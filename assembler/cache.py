@@ -0,0 +1,151 @@
+import functools
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+# Part of every key next to the assembler's own source, see assembler_digest
+ASSEMBLER_VERSION = "2"
+ASSEMBLER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "stp")
+DEFAULT_MAX_SIZE = 64 * 2**20
+READ_CHUNK = 1 << 20
+
+
+@functools.cache
+def assembler_digest() -> bytes:
+    """Hash of the source files of the assembler, changes with any of them"""
+    h = hashlib.sha256(ASSEMBLER_VERSION.encode())
+    for name in sorted(os.listdir(ASSEMBLER_DIR)):
+        if name.endswith(".py"):
+            h.update(name.encode() + b"\0")
+            with open(os.path.join(ASSEMBLER_DIR, name), "rb") as f:
+                h.update(f.read())
+    return h.digest()
+
+
+class BuildCache:
+    """Assembled binaries on disk, addressed by a hash of their source
+
+    The key also covers the assembler's source, instruction set tables
+    included, so no change to the assembler serves stale binaries. Entries
+    are plain '<key>.bin' files, a hit touches the file and the least
+    recently used files are removed once the cache grows beyond 'max_size'
+    bytes.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.stats_path = os.path.join(directory, "stats.json")
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, source_path: str, options: str = "") -> str:
+        """'options' names build options that change the output"""
+        h = hashlib.sha256(assembler_digest())
+        h.update(options.encode() + b"\0")
+        with open(source_path, "rb") as f:
+            while chunk := f.read(READ_CHUNK):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".bin")
+
+    def lookup(self, key: str) -> str | None:
+        """Path of the cached binary or None, counts the hit or miss"""
+        path = self.entry_path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.count("misses")
+            return None
+        self.count("hits")
+        return path
+
+    def load(self, key: str) -> bytes | None:
+        if (path := self.lookup(key)) is None:
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def store(self, key: str, data: bytes):
+        self.replace(key, lambda f: f.write(data))
+
+    def store_file(self, key: str, path: str):
+        def copy(f):
+            with open(path, "rb") as source:
+                shutil.copyfileobj(source, f)
+
+        self.replace(key, copy)
+
+    def replace(self, key: str, write):
+        # Written next to the entry and renamed, so readers never see partial files
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+            os.replace(tmp, self.entry_path(key))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self.evict()
+
+    def entries(self) -> list[os.DirEntry]:
+        with os.scandir(self.directory) as it:
+            return [e for e in it if e.name.endswith(".bin")]
+
+    def evict(self):
+        entries = sorted(self.entries(), key=lambda e: e.stat().st_mtime)
+        size = sum(e.stat().st_size for e in entries)
+        for e in entries:
+            if size <= self.max_size:
+                break
+            size -= e.stat().st_size
+            try:
+                os.unlink(e.path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        for e in self.entries():
+            os.unlink(e.path)
+        if os.path.exists(self.stats_path):
+            os.unlink(self.stats_path)
+
+    # region Statistics
+    def counters(self) -> dict[str, int]:
+        try:
+            with open(self.stats_path, "r") as f:
+                counters = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            counters = {}
+        return {"hits": counters.get("hits", 0), "misses": counters.get("misses", 0)}
+
+    def stats(self) -> dict:
+        entries = self.entries()
+        return {
+            **self.counters(),
+            "entries": len(entries),
+            "size": sum(e.stat().st_size for e in entries),
+            "max_size": self.max_size,
+        }
+
+    def count(self, name: str):
+        # Replaced like the entries, so readers never see a partial file. Builds
+        # counting at the same time may lose each other's update, the counts
+        # are approximate.
+        counters = self.counters()
+        counters[name] += 1
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(counters, f)
+            os.replace(tmp, self.stats_path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    # endregion
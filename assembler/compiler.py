@@ -1,24 +1,13 @@
-from .stp_parser import Parser, Node
-from .tokenizer import Token, TokenType
-
-OPCODES = {
-    "NOP": 0,
-    "ADD": 1,
-    "ADDC": 2,
-    "SUB": 3,
-    "SUBB": 4,
-    "SHL": 5,
-    "SHR": 6,
-    "SHA": 7,
-    "AND": 8,
-    "OR": 9,
-    "XOR": 10,
-    "NOR": 11,
-    "JMP": 17,
-    "JZE": 18,
-    "JNZ": 19,
-    "HLT": 31,
-}
+from __future__ import annotations
+from typing import TYPE_CHECKING, Iterable, Iterator
+from .stp_parser import Parser
+from .expression import Expression, ExpressionError, SymbolTable, resolve
+from .ir import Instruction, Label, SIGNATURES
+
+# Only needed by some builds, imported there to keep 'exec' starting fast
+if TYPE_CHECKING:
+    from .cache import BuildCache
+    from .optimizer import OptimizationReport
 
 
 class CompilationError(Exception):
@@ -26,104 +15,216 @@ class CompilationError(Exception):
         super().__init__(*args)
 
 
+# (name or expression, shift, mask) of an operand depending on labels
+Reference = tuple[str | Expression, int, int]
+
+
+def encode_instruction(instr: Instruction) -> tuple[int, Reference | None]:
+    """Encodes an instruction, a label operand is returned as (name, shift, mask)
+
+    The bits of the label operand are left 0 in the word. Expressions that
+    weren't folded while parsing are returned the same way.
+    """
+    layout, fields = SIGNATURES[instr.signature]
+    instruction = layout << 22 | instr.opcode << 17
+    ref = None
+    for (_, shift, mask, register), v in zip(fields, instr.operands):
+        if v.__class__ is not int:
+            ref = (v, shift, mask)
+            continue
+        if register and v > mask:
+            raise CompilationError(
+                f"Cannot compile 'R{v}'! Max register index is {mask}"
+            )
+        instruction |= (v & mask) << shift
+    return instruction, ref
+
+
+class Region:
+    """Lines assembled on their own, label operands are still 0"""
+
+    def __init__(self, parser: Parser, lines: list[str], first: int):
+        self.words = bytearray()
+        # Instructions starting on each line
+        self.sizes = [0] * len(lines)
+        # name -> (instruction index, line), both relative to the region
+        self.labels: dict[str, tuple[int, int]] = {}
+        self.refs: dict[int, Reference] = {}
+        count = 0
+        for item in parser.parse_lines(lines, first + 1):
+            if item.__class__ is Instruction:
+                word, ref = encode_instruction(item)
+                self.words += word.to_bytes(3, "big")
+                if ref is not None:
+                    self.refs[count] = ref
+                self.sizes[item.line - first - 1] += 1
+                count += 1
+            elif item.name in self.labels:
+                raise CompilationError(f"Label '{item.name}:' already exists!")
+            else:
+                self.labels[item.name] = (count, item.line - first - 1)
+        self.count = count
+        self.continued = {n - first - 1 for n in parser.continued}
+        self.constants = parser.constants
+
+
+def symbol_table(labels: dict[str, int], constants: SymbolTable) -> SymbolTable:
+    """Labels with their address next to the constants, for evaluating expressions"""
+    for name in constants.values.keys() & labels.keys():
+        raise CompilationError(f"'{name}' is both a label and a constant")
+    return SymbolTable({**constants.values, **{n: i * 3 for n, i in labels.items()}})
+
+
+def evaluate(target: str | Expression, symbols: SymbolTable) -> int:
+    try:
+        return resolve(target, symbols)
+    except ExpressionError as e:
+        raise CompilationError(str(e)) from e
+
+
+# Bytes of encoded instructions collected before they are written out
+WRITE_CHUNK = 1 << 16
+
+
 class Compiler:
-    def __init__(self, path: str) -> None:
+    def __init__(
+        self,
+        path: str,
+        cache: BuildCache | None = None,
+        optimize: bool = False,
+        profile: dict | None = None,
+    ) -> None:
         self.parser = Parser(path)
-        self.parser.parse()
+        self.cache = cache
+        # Peephole optimization between parsing and encoding, 'profile' of the
+        # unoptimized program only improves the report
+        self.optimize = optimize
+        self.profile = profile
+        self.report: OptimizationReport | None = None
+        # Set when the binary came from the cache, labels and line_map stay empty
+        self.cached = False
         self.buffer = bytearray()
         self.labels = {}
         self.instr_counter = 0
         self.last_instr = None
+        # Address of every instruction -> source line
+        self.line_map: dict[int, int] = {}
+        # Label references that weren't defined yet and expressions:
+        # (address, name or expression, shift, mask)
+        self.fixups: list[tuple[int, str | Expression, int, int]] = []
 
     def build(self):
-        for node in self.parser.body():
-            if node.token.token_type == TokenType.INSTRUCTION:
-                self.add_data(self.build_instruction(node), 3)
-            elif node.token.token_type == TokenType.LABEL:
-                self.set_label(node.token)
-
-    def set_label(self, t: Token):
-        if t.value not in self.labels:
-            self.labels[t.value[:-1]] = self.instr_counter
-        else:
-            raise CompilationError(f"Label '{t.value}' already exists!")
-
-    def get_register_index(self, t: Token) -> int:
-        if t.token_type == TokenType.REGISTER:
-            reg = int(t.value[1:])
-            if reg > 15:
-                raise CompilationError(
-                    f"Cannot compile '{t.value}'! Max register index is 15"
-                )
-            return reg
-
-    def get_imm(self, t: Token, size: int):
-        if t.token_type == TokenType.INTEGER:
-            v = int(t.value)
-            # if len(bin(v)) > size:
-            #     print("Warning: integer values should not exceed 255")
-            return v & (2**size - 1)
-        elif t.token_type == TokenType.IDENTIFIER:
-            if (v := self.labels.get(t.value)) is None:
-                raise CompilationError(f"Unknown identifier: '{t.value}'")
-            v *= 3
-            return v & (2**size - 1)
+        if self.cache is not None:
+            key = self.cache.key(self.parser.path, "O" if self.optimize else "")
+            if (data := self.cache.load(key)) is not None:
+                self.buffer = bytearray(data)
+                self.cached = True
+                return
+        program = self.parser.iter_parse()
+        if self.optimize:
+            from .optimizer import Optimizer
+
+            optimizer = Optimizer(list(program), self.profile)
+            program = optimizer.run()
+            self.report = optimizer.report
+        for instruction in self.encode(program, self.line_map):
+            self.buffer += instruction.to_bytes(3, "big")
+        for address, value in self.resolve_fixups():
+            word = int.from_bytes(self.buffer[address : address + 3], "big") | value
+            self.buffer[address : address + 3] = word.to_bytes(3, "big")
+        if self.cache is not None:
+            self.cache.store(key, self.buffer)
+
+    def build_streaming(self, path: str):
+        """Assembles straight into 'path' without keeping the program in memory
+
+        Instructions are written in chunks as they are encoded, references to
+        labels defined later are patched in the file at the end. The file is
+        written next to 'path' and only replaces it once assembly succeeded,
+        so an error neither leaves a partial binary nor destroys the old one.
+        """
+        if self.cache is not None:
+            key = self.cache.key(self.parser.path)
+            if (cached := self.cache.lookup(key)) is not None:
+                import shutil
+
+                shutil.copyfile(cached, path)
+                self.cached = True
+                return
+        import os
+
+        tmp = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, "w+b") as f:
+                chunk = bytearray()
+                for instruction in self.encode(self.parser.iter_parse()):
+                    chunk += instruction.to_bytes(3, "big")
+                    if len(chunk) >= WRITE_CHUNK:
+                        f.write(chunk)
+                        chunk.clear()
+                f.write(chunk)
+                for address, value in self.resolve_fixups():
+                    f.seek(address)
+                    word = int.from_bytes(f.read(3), "big") | value
+                    f.seek(address)
+                    f.write(word.to_bytes(3, "big"))
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        if self.cache is not None:
+            self.cache.store_file(key, path)
+
+    def encode(
+        self,
+        program: Iterable[Instruction | Label],
+        line_map: dict[int, int] | None = None,
+    ) -> Iterator[int]:
+        for item in program:
+            if item.__class__ is Instruction:
+                if line_map is not None:
+                    line_map[self.instr_counter * 3] = item.line
+                yield self.build_instruction(item)
+            else:
+                self.set_label(item)
+
+    def resolve_fixups(self) -> Iterator[tuple[int, int]]:
+        """Yields (address, immediate bits) for every forward label reference"""
+        symbols = None
+        if self.parser.constants.values:
+            # Also reports labels and constants of the same name
+            symbols = symbol_table(self.labels, self.parser.constants)
+        for address, target, shift, mask in sorted(self.fixups, key=lambda f: f[0]):
+            if (v := self.labels.get(target)) is not None:
+                yield address, ((v * 3) & mask) << shift
+                continue
+            if symbols is None:
+                symbols = symbol_table(self.labels, self.parser.constants)
+            yield address, (evaluate(target, symbols) & mask) << shift
+        self.fixups.clear()
+
+    def set_label(self, label: Label):
+        if label.name not in self.labels:
+            self.labels[label.name] = self.instr_counter
         else:
-            raise CompilationError(
-                f"Supplied value can't be interpreted as Immidiate: '{t.value}'"
-            )
+            raise CompilationError(f"Label '{label.name}:' already exists!")
 
-    # TODO: Better Layout/Signature System. It's a total mess
-    def build_instruction(self, node: Node):
-        opcode = OPCODES[node.token.value]
-        instruction = opcode << 17
-        sig = node.children[0]
-        assert sig.token.token_type == TokenType.SIGNATURE
-        layout = (int(sig.token.value[0][1:])) & 0b11
-        instruction |= layout << 22
-        reg = val = 0
-        for i, s in enumerate(sig.token.value[1:]):
-            if s == "RD":
-                reg = self.get_register_index(node.children[i + 1].token)
-                instruction |= reg << 13
-            elif s == "RS1":
-                reg = self.get_register_index(node.children[i + 1].token)
-                instruction |= reg << 9
-            elif s == "RS2":
-                reg = self.get_register_index(node.children[i + 1].token)
-                instruction |= reg << 5
-            elif s == "I8":
-                val = self.get_imm(node.children[i + 1].token, 8)
-                instruction |= val << 1
-            elif s == "I16":
-                val = self.get_imm(node.children[i + 1].token, 16)
-                instruction |= val << 1
-        # if len(node.children) == 3:
-        # dest = self.get_register_index(node.children[0].token)
-        # instruction |= dest << 13
-        # src1 = self.get_register_index(node.children[1].token)
-        # instruction |= src1 << 9
-        # t = node.children[2].token
-        # if t.token_type == TokenType.REGISTER:
-        #     src2 = self.get_register_index(t)
-        #     instruction |= src2 << 5
-        # else:
-        #     val = self.get_imm(t, 8)
-        #     instruction |= val << 1
-        #     instruction |= 0b01 << 22
-        # elif len(node.children) == 1:
-        #     val = self.get_imm(node.children[0].token, 16)
-        #     instruction |= val << 1
-        #     instruction |= 0b11 << 22
+    def build_instruction(self, instr: Instruction) -> int:
+        instruction, ref = encode_instruction(instr)
+        if ref is not None:
+            name, shift, mask = ref
+            if (address := self.labels.get(name)) is None:
+                # Possibly defined later, patched once everything is encoded
+                self.fixups.append((self.instr_counter * 3, name, shift, mask))
+            else:
+                instruction |= ((address * 3) & mask) << shift
         self.instr_counter += 1
-        self.last_instr = node.token.value
+        self.last_instr = instr
         return instruction
 
     def add_data(self, data: int, byte_count: int):
-        local_buffer = bytearray()
-        for i in range(byte_count - 1, -1, -1):
-            local_buffer.append((data >> (8 * i)) & 0xFF)
-        self.buffer.extend(local_buffer)
+        self.buffer += (data & ((1 << 8 * byte_count) - 1)).to_bytes(byte_count, "big")
 
     def output(self, path: str):
         with open(path, "wb") as f:
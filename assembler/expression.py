@@ -1,94 +1,131 @@
 from __future__ import annotations
-from enum import Enum, auto
+import itertools
+import operator
 from dataclasses import dataclass, field
-import re
+from typing import Callable
+from .tokenizer import Token, TokenType
 
 
-class TokenizationError(Exception):
+class ExpressionError(Exception):
     def __init__(self, *args) -> None:
         super().__init__(*args)
 
 
-class ParsingError(Exception):
-    def __init__(self, *args) -> None:
-        super().__init__(*args)
-
+def divide(l: int, r: int) -> int:
+    if r == 0:
+        raise ExpressionError("Division by zero")
+    return l // r
 
-class TokenType(Enum):
-    OPERATOR = auto()
-    OPEN_PARAN = auto()
-    CLOSE_PARAN = auto()
-    INT = auto()
-    BIN = auto()
-    HEX = auto()
 
+def modulo(l: int, r: int) -> int:
+    if r == 0:
+        raise ExpressionError("Division by zero")
+    return l % r
 
-@dataclass
-class Token:
-    token_type: TokenType
-    value: str
-
-    def __str__(self) -> str:
-        return f"Token({self.token_type}, '{self.value}')"
 
-
-TOKEN_DEFINTIONS = {
-    TokenType.OPERATOR: re.compile(r"^\+|-|\*|/|\||&|~|\^"),
-    TokenType.OPEN_PARAN: re.compile(r"^\("),
-    TokenType.CLOSE_PARAN: re.compile(r"^\)"),
-    TokenType.HEX: re.compile(r"^0X[0-9A-F]+"),
-    TokenType.BIN: re.compile(r"^0B[01]+"),
-    TokenType.INT: re.compile(r"^\d+"),
+OP_PRESEDENCE = {
+    "|": 0,
+    "^": 1,
+    "&": 2,
+    "<<": 3,
+    ">>": 3,
+    "+": 4,
+    "-": 4,
+    "*": 5,
+    "/": 5,
+    "%": 5,
 }
 
-OP_PRESEDENCE = {"|": 0, "^": 1, "&": 2, "+": 3, "-": 3, "*": 4, "/": 5}
-
 BIN_OP_FUNC = {
-    "+": lambda r, l: r + l,
-    "-": lambda r, l: r - l,
-    "*": lambda r, l: r * l,
-    "/": lambda r, l: r / l,
-    "|": lambda r, l: r | l,
-    "&": lambda r, l: r & l,
+    "+": operator.add,
+    "-": operator.sub,
+    "*": operator.mul,
+    "/": divide,
+    "%": modulo,
+    "|": operator.or_,
+    "^": operator.xor,
+    "&": operator.and_,
+    "<<": operator.lshift,
+    ">>": operator.rshift,
 }
 
 UNARY_OPS = ["-", "~"]
 
-UN_OP_FUNC = {"-": lambda v: -v, "~": lambda v: ~v}
-
-COMMENT = re.compile(r"^\s*(#[^\n]*|\s+)")
-
-
-class Tokenizer:
-    def __init__(self, buffer: str) -> None:
-        self.buffer = buffer.strip().upper()
-        self.pointer = 0
-        self.buff_len = len(self.buffer)
-        self.curr_token = self.scan_token()
-
-    def peek_next_token(self):
-        return self.curr_token
-
-    def get_next_token(self):
-        current = self.curr_token
-        self.scan_token()
-        return current
-
-    def scan_token(self):
-        while m := re.match(COMMENT, self.buffer[self.pointer :]):
-            self.pointer += m.end()
-        if self.pointer >= self.buff_len:
-            self.curr_token = None
-            return None
-        for token_type, token_def in TOKEN_DEFINTIONS.items():
-            if m := re.match(token_def, self.buffer[self.pointer :]):
-                self.pointer += m.end()
-                t = Token(token_type, m[0])
-                self.curr_token = t
-                return t
-        raise TokenizationError(
-            f"Unknown Token at '{self.buffer[self.pointer:self.pointer+20]}'"
-        )
+UN_OP_FUNC = {"-": operator.neg, "~": operator.invert}
+
+
+# Every change of a symbol table draws a new version, unique among all tables
+VERSIONS = itertools.count(1)
+
+
+class SymbolTable:
+    """Values of labels and constants that expressions are evaluated against
+
+    A value is an integer, the name of another symbol or an Expression.
+    Expressions keep their last value until the version of the table changes.
+    """
+
+    def __init__(self, values: dict[str, int | str | Expression] | None = None):
+        self.values: dict[str, int | str | Expression] = dict(values or {})
+        self.version = next(VERSIONS)
+        self.resolving: set[str] = set()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.values
+
+    def define(self, name: str, value: int | str | Expression):
+        self.values[name] = value
+        self.version = next(VERSIONS)
+
+    def lookup(self, name: str) -> int:
+        if (value := self.values.get(name)) is None:
+            raise ExpressionError(f"Unknown identifier: '{name}'")
+        if value.__class__ is int:
+            return value
+        if name in self.resolving:
+            raise ExpressionError(f"'{name}' is defined in terms of itself")
+        self.resolving.add(name)
+        try:
+            return resolve(value, self)
+        finally:
+            self.resolving.discard(name)
+
+
+class Expression:
+    """An expression depending on symbols not known while parsing
+
+    Compiled into a closure over the symbol table, constant subtrees are
+    already folded.
+    """
+
+    __slots__ = ("source", "names", "function", "version", "value")
+
+    def __init__(
+        self, source: str, names: frozenset[str], function: Callable[[SymbolTable], int]
+    ):
+        self.source = source
+        self.names = names
+        self.function = function
+        self.version = 0
+        self.value = 0
+
+    def evaluate(self, symbols: SymbolTable) -> int:
+        if self.version != symbols.version:
+            self.value = self.function(symbols)
+            self.version = symbols.version
+        return self.value
+
+    def __repr__(self) -> str:
+        return self.source
+
+
+def resolve(target: int | str | Expression, symbols: SymbolTable) -> int:
+    """Value of an operand or constant that may reference other symbols"""
+    if target.__class__ is int:
+        return target
+    if target.__class__ is str:
+        return symbols.lookup(target)
+    return target.evaluate(symbols)
 
 
 @dataclass
@@ -98,49 +135,56 @@ class Node:
     children: list[Node] = field(repr=False)
 
 
-def parse_primary(t: Tokenizer):
+def is_operator(token: Token | None, operators) -> bool:
+    return (
+        token is not None
+        and token.token_type == TokenType.OPERATOR
+        and token.value in operators
+    )
+
+
+def parse_primary(t) -> Node:
+    """'t' provides get_next_token() and peek_next_token()"""
     token = t.get_next_token()
     if token is None:
-        raise ParsingError()
+        raise ExpressionError("Missing value at the end of the expression")
     if token.token_type == TokenType.OPERATOR and token.value in UNARY_OPS:
         val = parse_primary(t)
         return Node("UN_OP", token.value, [val])
     if token.token_type == TokenType.OPEN_PARAN:
         node = parse_expression(t)
         token = t.get_next_token()
-        if token.token_type != TokenType.CLOSE_PARAN:
-            raise ParsingError()
+        if token is None or token.token_type != TokenType.CLOSE_PARAN:
+            raise ExpressionError("Missing ')'")
         return node
-    elif token.token_type == TokenType.INT:
+    elif token.token_type == TokenType.INTEGER:
         return Node("VAL", int(token.value), None)
     elif token.token_type == TokenType.HEX:
         return Node("VAL", int(token.value, 16), None)
     elif token.token_type == TokenType.BIN:
         return Node("VAL", int(token.value, 2), None)
-    elif token.token_type == TokenType.ID:
+    elif token.token_type == TokenType.IDENTIFIER:
         return Node("ID", token.value, None)
     else:
-        raise ParsingError()
+        raise ExpressionError(
+            f"Wrong arguments! Expected 'INTEGER' or 'IDENTIFIER' got '{token.token_type.name}'"
+        )
 
 
-def parse_expression(t: Tokenizer, p=0, lhs=None):
+def parse_expression(t, p=0, lhs=None) -> Node:
+    """Precedence climbing, operators of the same precedence are left associative"""
     if lhs is None:
         lhs = parse_primary(t)
     token = t.peek_next_token()
-    while (
-        token
-        and token.token_type == TokenType.OPERATOR
-        and OP_PRESEDENCE[token.value] >= p
-    ):
+    while is_operator(token, OP_PRESEDENCE) and OP_PRESEDENCE[token.value] >= p:
         op = t.get_next_token()
         rhs = parse_primary(t)
         token = t.peek_next_token()
         while (
-            token
-            and token.token_type == TokenType.OPERATOR
-            and OP_PRESEDENCE[token.value] >= p + 1
+            is_operator(token, OP_PRESEDENCE)
+            and OP_PRESEDENCE[token.value] > OP_PRESEDENCE[op.value]
         ):
-            rhs = parse_expression(t, p + 1, rhs)
+            rhs = parse_expression(t, OP_PRESEDENCE[op.value] + 1, rhs)
             token = t.peek_next_token()
         lhs = Node("BIN_OP", op.value, [lhs, rhs])
     return lhs
@@ -153,15 +197,62 @@ def print_node(n: Node, level):
             print_node(child, level + 1)
 
 
-def eval_node(n: Node):
+def node_source(n: Node) -> str:
     if n.name == "BIN_OP":
-        return BIN_OP_FUNC[n.value](eval_node(n.children[0]), eval_node(n.children[1]))
+        return f"({node_source(n.children[0])} {n.value} {node_source(n.children[1])})"
     elif n.name == "UN_OP":
-        return UN_OP_FUNC[n.value](eval_node(n.children[0]))
-    elif n.name == "VAL":
-        return n.value
+        return f"{n.value}{node_source(n.children[0])}"
+    return str(n.value)
 
 
-t = Tokenizer("")
-start = parse_expression(t)
-print(eval_node(start))
+def compile_node(
+    n: Node, constants: SymbolTable | None, names: set[str]
+) -> int | Callable[[SymbolTable], int]:
+    """An int for constant subtrees, otherwise a closure over the symbol table"""
+    if n.name == "VAL":
+        return n.value
+    elif n.name == "ID":
+        name = n.value
+        if constants is not None:
+            value = constants.values.get(name)
+            if value.__class__ is int:
+                return value
+        names.add(name)
+        return lambda s: s.lookup(name)
+    elif n.name == "UN_OP":
+        f = UN_OP_FUNC[n.value]
+        a = compile_node(n.children[0], constants, names)
+        if a.__class__ is int:
+            return f(a)
+        return lambda s: f(a(s))
+    f = BIN_OP_FUNC[n.value]
+    a = compile_node(n.children[0], constants, names)
+    b = compile_node(n.children[1], constants, names)
+    if a.__class__ is int:
+        if b.__class__ is int:
+            return f(a, b)
+        return lambda s: f(a, b(s))
+    if b.__class__ is int:
+        return lambda s: f(a(s), b)
+    return lambda s: f(a(s), b(s))
+
+
+def compile_expression(
+    n: Node, constants: SymbolTable | None = None
+) -> int | str | Expression:
+    """Folds what is known, 'constants' holds the integer constants defined so far
+
+    Returns an int for a constant expression, the name for a single identifier
+    (handled like a label operand) and an Expression otherwise.
+    """
+    if n.name == "ID":
+        value = constants.values.get(n.value) if constants is not None else None
+        return value if value.__class__ is int else n.value
+    names = set()
+    function = compile_node(n, constants, names)
+    if function.__class__ is int:
+        return function
+    source = node_source(n)
+    if source[0] == "(":
+        source = source[1:-1]
+    return Expression(source, frozenset(names), function)
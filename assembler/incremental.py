@@ -0,0 +1,244 @@
+from __future__ import annotations
+import os
+from .compiler import (
+    Compiler,
+    CompilationError,
+    Region,
+    Reference,
+    evaluate,
+    symbol_table,
+)
+from .expression import Expression, SymbolTable
+from .stp_parser import Parser, ParsingError
+from .tokenizer import TokenizationError
+
+
+class IncrementalCompiler(Compiler):
+    """Keeps the assembled program to reassemble only the lines that changed
+
+    Changed lines are found by comparing the new source with the last one,
+    only they are tokenized, parsed and encoded and replace their old words
+    in 'buffer'. Label operands pointing to labels that moved are patched in
+    place. Anything that fails is retried as a full build, which reports the
+    error. Editing a '.EQU' constant also takes a full build. 'line_map' is
+    not kept.
+    """
+
+    def __init__(self, path: str) -> None:
+        super().__init__(path)
+        self.lines: list[str] = []
+        self.sizes: list[int] = []
+        self.label_lines: dict[str, int] = {}
+        self.refs: dict[int, Reference] = {}
+        # Label name -> indices of the instructions referencing it
+        self.referrers: dict[str, set[int]] = {}
+        self.continued: set[int] = set()
+        self.constants = SymbolTable()
+        # Constants that depend on labels, their referrers follow moved labels
+        self.dynamic_constants: list[str] = []
+        # Labels and constants for expressions, built when first needed
+        self.symbols: SymbolTable | None = None
+        self.valid = False
+
+    def read_lines(self) -> list[str]:
+        with open(self.parser.path, "r") as f:
+            return f.read().split("\n")
+
+    def build(self, lines: list[str] | None = None):
+        self.valid = False
+        if lines is None:
+            lines = self.read_lines()
+        region = Region(Parser(self.parser.path), lines, 0)
+        self.constants = region.constants
+        self.dynamic_constants = [
+            name
+            for name, value in self.constants.values.items()
+            if value.__class__ is not int
+        ]
+        self.symbols = None
+        self.lines = lines
+        self.buffer = region.words
+        self.sizes = region.sizes
+        self.labels = {name: index for name, (index, _) in region.labels.items()}
+        self.label_lines = {name: line for name, (_, line) in region.labels.items()}
+        self.refs = region.refs
+        self.referrers = {}
+        for index, (target, _, _) in self.refs.items():
+            for name in dependencies(target):
+                self.referrers.setdefault(name, set()).add(index)
+        self.continued = region.continued
+        self.check_references(self.referrers)
+        for index in self.refs:
+            self.patch_reference(index)
+        self.instr_counter = region.count
+        self.valid = True
+
+    def update(self) -> tuple[int, int] | None:
+        """Reassembles the changed lines, returns the changed byte range of 'buffer'"""
+        lines = self.read_lines()
+        if not self.valid:
+            self.build(lines)
+            return 0, len(self.buffer)
+        a, b, c = self.changed_lines(lines)
+        if a == b == c:
+            return None
+        if any(".EQU" in line.upper() for line in self.lines[a:b] + lines[a:c]):
+            # Constants are folded into the operands everywhere
+            self.build(lines)
+            return 0, len(self.buffer)
+        try:
+            return self.replace_lines(lines, a, b, c)
+        except (TokenizationError, ParsingError, CompilationError):
+            # A statement may span the edited lines, a full build decides
+            self.build(lines)
+            return 0, len(self.buffer)
+
+    def changed_lines(self, lines: list[str]) -> tuple[int, int, int]:
+        """Old lines [a, b) were replaced by the new lines [a, c)"""
+        old = self.lines
+        a = 0
+        for x, y in zip(old, lines):
+            if x != y:
+                break
+            a += 1
+        # The common suffix must not overlap the common prefix
+        same = 0
+        for x, y in zip(reversed(old[a:]), reversed(lines[a:])):
+            if x != y:
+                break
+            same += 1
+        b, c = len(old) - same, len(lines) - same
+        # Statements spanning lines are reassembled as a whole
+        while a > 0 and a in self.continued:
+            a -= 1
+        while b < len(old) and b in self.continued:
+            b += 1
+            c += 1
+        return a, b, c
+
+    def replace_lines(self, lines: list[str], a: int, b: int, c: int):
+        region = Region(Parser(self.parser.path, self.constants), lines[a:c], a)
+        start = sum(self.sizes[:a])
+        end = start + sum(self.sizes[a:b])
+        delta = region.count - (end - start)
+        line_delta = c - b
+
+        # Validate the labels before anything is changed
+        removed = {name for name, line in self.label_lines.items() if a <= line < b}
+        for name in region.labels:
+            if name in self.labels and name not in removed:
+                raise CompilationError(f"Label '{name}:' already exists!")
+            if name in self.constants:
+                raise CompilationError(f"'{name}' is both a label and a constant")
+        referenced = {
+            name
+            for target, _, _ in region.refs.values()
+            for name in dependencies(target)
+        }
+        for name in removed - region.labels.keys():
+            if any(i < start or i >= end for i in self.referrers.get(name, ())):
+                referenced.add(name)
+        for name in referenced:
+            if (
+                name not in region.labels
+                and name not in self.constants
+                and (name in removed or name not in self.labels)
+            ):
+                raise CompilationError(f"Unknown identifier: '{name}'")
+
+        # Labels and references behind the region move with it
+        moved = set()
+        if delta or line_delta:
+            for name, line in self.label_lines.items():
+                if line >= b:
+                    self.label_lines[name] = line + line_delta
+                    if delta:
+                        self.labels[name] += delta
+                        moved.add(name)
+        for name in removed:
+            del self.labels[name]
+            del self.label_lines[name]
+            moved.add(name)
+        for name, (index, line) in region.labels.items():
+            if self.labels.get(name) != start + index:
+                moved.add(name)
+            self.labels[name] = start + index
+            self.label_lines[name] = a + line
+
+        for index in range(start, end):
+            if (ref := self.refs.pop(index, None)) is not None:
+                for name in dependencies(ref[0]):
+                    self.referrers[name].discard(index)
+        if delta:
+            refs = {}
+            for index, ref in self.refs.items():
+                if index >= end:
+                    index += delta
+                refs[index] = ref
+            self.refs = refs
+            self.referrers = {}
+            for index, (target, _, _) in self.refs.items():
+                for name in dependencies(target):
+                    self.referrers.setdefault(name, set()).add(index)
+        for index, ref in region.refs.items():
+            self.refs[start + index] = ref
+            for name in dependencies(ref[0]):
+                self.referrers.setdefault(name, set()).add(start + index)
+
+        self.lines = lines
+        self.sizes[a:b] = region.sizes
+        if self.continued or region.continued:
+            self.continued = {
+                n + line_delta if n >= b else n
+                for n in self.continued
+                if not a <= n < b
+            } | {a + n for n in region.continued}
+        self.buffer[start * 3 : end * 3] = region.words
+        self.instr_counter += delta
+
+        first = start * 3
+        last = len(self.buffer) if delta else (start + region.count) * 3
+        patch = {start + index for index in region.refs}
+        if moved:
+            self.symbols = None
+            moved.update(self.dynamic_constants)
+        for name in moved:
+            patch |= self.referrers.get(name, set())
+        for index in patch:
+            self.patch_reference(index)
+            first = min(first, index * 3)
+            last = max(last, index * 3 + 3)
+        return first, last
+
+    def check_references(self, referrers: dict[str, set[int]]):
+        if self.constants.values:
+            symbol_table(self.labels, self.constants)
+        for name, indices in referrers.items():
+            if indices and name not in self.labels and name not in self.constants:
+                raise CompilationError(f"Unknown identifier: '{name}'")
+
+    def patch_reference(self, index: int):
+        target, shift, mask = self.refs[index]
+        if (value := self.labels.get(target)) is not None:
+            value *= 3
+        else:
+            if self.symbols is None:
+                self.symbols = symbol_table(self.labels, self.constants)
+            value = evaluate(target, self.symbols)
+        address = index * 3
+        word = int.from_bytes(self.buffer[address : address + 3], "big")
+        word &= ~(mask << shift)
+        word |= (value & mask) << shift
+        self.buffer[address : address + 3] = word.to_bytes(3, "big")
+
+    def output_range(self, path: str, f: int, t: int):
+        """Writes buffer[f:t] into an output file holding the previous build"""
+        with open(path, "r+b" if os.path.exists(path) else "wb") as file:
+            file.seek(f)
+            file.write(self.buffer[f:t])
+            file.truncate(len(self.buffer))
+
+
+def dependencies(target: str | Expression) -> tuple[str, ...] | frozenset[str]:
+    """Names a reference depends on"""
+    return (target,) if target.__class__ is str else target.names
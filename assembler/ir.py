@@ -0,0 +1,89 @@
+from __future__ import annotations
+
+OPCODES = {
+    "NOP": 0,
+    "ADD": 1,
+    "ADDC": 2,
+    "SUB": 3,
+    "SUBB": 4,
+    "SHL": 5,
+    "SHR": 6,
+    "SHA": 7,
+    "AND": 8,
+    "OR": 9,
+    "XOR": 10,
+    "NOR": 11,
+    "INB": 13,
+    "OUTB": 14,
+    "LDB": 15,
+    "STB": 16,
+    "JMP": 17,
+    "JZE": 18,
+    "JNZ": 19,
+    "HLT": 31,
+}
+
+MNEMONICS = {opcode: name for name, opcode in OPCODES.items()}
+
+# Operand fields: (name, shift, mask, is register)
+RD = ("RD", 13, 0xF, True)
+RS1 = ("RS1", 9, 0xF, True)
+RS2 = ("RS2", 5, 0xF, True)
+I8 = ("I8", 1, 0xFF, False)
+I12 = ("I12", 1, 0xFFF, False)
+I16 = ("I16", 1, 0xFFFF, False)
+
+# Interned signatures: layout and operand fields, instructions store the index
+SIGNATURES: list[tuple[int, tuple[tuple, ...]]] = []
+SIGNATURE_IDS: dict[tuple[int, tuple[tuple, ...]], int] = {}
+
+
+def signature_id(layout: int, *fields: tuple) -> int:
+    signature = (layout, fields)
+    if (sid := SIGNATURE_IDS.get(signature)) is None:
+        sid = SIGNATURE_IDS[signature] = len(SIGNATURES)
+        SIGNATURES.append(signature)
+    return sid
+
+
+L0_REGISTERS = signature_id(0, RD, RS1, RS2)
+L1_IMMEDIATE = signature_id(1, RD, RS1, I8)
+L2_I12 = signature_id(2, RD, I12)
+L3_NONE = signature_id(3)
+L3_I16 = signature_id(3, I16)
+
+
+class Instruction:
+    """One parsed instruction
+
+    'operands' follow the fields of the signature, they are register indices,
+    integers or the names of labels.
+    """
+
+    __slots__ = ("opcode", "signature", "operands", "line")
+
+    def __init__(
+        self, opcode: int, signature: int, operands: tuple[int | str, ...], line: int
+    ):
+        self.opcode = opcode
+        self.signature = signature
+        self.operands = operands
+        self.line = line
+
+    def __repr__(self) -> str:
+        fields = SIGNATURES[self.signature][1]
+        args = ", ".join(
+            f"R{v}" if f[3] else str(v) for f, v in zip(fields, self.operands)
+        )
+        return f"{MNEMONICS[self.opcode]} {args}".rstrip()
+
+
+class Label:
+    __slots__ = ("name", "line")
+
+    def __init__(self, name: str, line: int):
+        self.name = name
+        self.line = line
+
+    def __repr__(self) -> str:
+        return f"{self.name}:"
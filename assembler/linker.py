@@ -0,0 +1,176 @@
+from __future__ import annotations
+import os
+import struct
+from dataclasses import dataclass, field
+
+from .cache import assembler_digest
+from .compiler import Region
+from .expression import ExpressionError, resolve
+from .stp_parser import Parser
+
+OBJECT_MAGIC = b"STPO"
+OBJECT_VERSION = 2
+OBJECT_EXTENSION = ".o"
+
+# Magic, version, digest of the assembler that wrote it, code size, label and
+# relocation counts
+HEADER = struct.Struct(">4sB32sIII")
+LABEL = struct.Struct(">IB")
+RELOCATION = struct.Struct(">IBIB")
+
+
+class LinkError(Exception):
+    def __init__(self, *args) -> None:
+        super().__init__(*args)
+
+
+@dataclass
+class ObjectModule:
+    """A separately assembled module
+
+    Every label operand is left 0 in 'code' and listed in 'relocations' as
+    (instruction index, label, shift, mask), since even labels of the module
+    itself only get their address when the modules are laid out. All labels
+    are exported, a module sees its own labels before those of the others.
+    Constants and expressions are resolved while assembling, they can't
+    depend on labels.
+    """
+
+    name: str
+    code: bytes
+    labels: dict[str, int] = field(default_factory=dict)
+    relocations: list[tuple[int, str, int, int]] = field(default_factory=list)
+
+    @classmethod
+    def assemble(cls, source: str) -> ObjectModule:
+        with open(source, "r") as f:
+            lines = f.read().split("\n")
+        region = Region(Parser(source), lines, 0)
+        relocations = []
+        for index, (target, shift, mask) in sorted(region.refs.items()):
+            if target.__class__ is str and target not in region.constants:
+                relocations.append((index, target, shift, mask))
+                continue
+            try:
+                value = resolve(target, region.constants)
+            except ExpressionError as e:
+                raise LinkError(
+                    f"'{target}' in module '{module_name(source)}' can't be relocated: {e}"
+                ) from e
+            address = index * 3
+            word = int.from_bytes(region.words[address : address + 3], "big")
+            word |= (value & mask) << shift
+            region.words[address : address + 3] = word.to_bytes(3, "big")
+        return cls(
+            module_name(source),
+            bytes(region.words),
+            {name: index for name, (index, _) in region.labels.items()},
+            relocations,
+        )
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            f.write(
+                HEADER.pack(
+                    OBJECT_MAGIC,
+                    OBJECT_VERSION,
+                    assembler_digest(),
+                    len(self.code),
+                    len(self.labels),
+                    len(self.relocations),
+                )
+            )
+            f.write(self.code)
+            for name, index in self.labels.items():
+                f.write(LABEL.pack(index, len(name)) + name.encode())
+            for index, name, shift, mask in self.relocations:
+                f.write(RELOCATION.pack(index, shift, mask, len(name)) + name.encode())
+
+    @classmethod
+    def load(cls, path: str) -> ObjectModule:
+        with open(path, "rb") as f:
+            data = f.read()
+        if len(data) < HEADER.size:
+            raise LinkError(f"'{path}' is not a version {OBJECT_VERSION} object file")
+        magic, version, _, code_size, labels, relocations = HEADER.unpack_from(data)
+        if magic != OBJECT_MAGIC or version != OBJECT_VERSION:
+            raise LinkError(f"'{path}' is not a version {OBJECT_VERSION} object file")
+        pos = HEADER.size
+        module = cls(module_name(path), data[pos : pos + code_size])
+        pos += code_size
+        for _ in range(labels):
+            index, length = LABEL.unpack_from(data, pos)
+            pos += LABEL.size
+            module.labels[data[pos : pos + length].decode()] = index
+            pos += length
+        for _ in range(relocations):
+            index, shift, mask, length = RELOCATION.unpack_from(data, pos)
+            pos += RELOCATION.size
+            module.relocations.append(
+                (index, data[pos : pos + length].decode(), shift, mask)
+            )
+            pos += length
+        return module
+
+
+def module_name(path: str) -> str:
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def object_path(source: str, directory: str) -> str:
+    return os.path.join(directory, module_name(source) + OBJECT_EXTENSION)
+
+
+def assemble_object(source: str, path: str) -> str:
+    """Assembles 'source' into the object file 'path', runs in worker processes"""
+    ObjectModule.assemble(source).save(path)
+    return path
+
+
+def is_stale(source: str, path: str) -> bool:
+    """Missing, older than 'source' or written by another assembler version"""
+    try:
+        if os.stat(path).st_mtime_ns < os.stat(source).st_mtime_ns:
+            return True
+        with open(path, "rb") as f:
+            header = f.read(HEADER.size)
+    except FileNotFoundError:
+        return True
+    if len(header) < HEADER.size:
+        return True
+    magic, version, digest, _, _, _ = HEADER.unpack(header)
+    return (
+        magic != OBJECT_MAGIC
+        or version != OBJECT_VERSION
+        or digest != assembler_digest()
+    )
+
+
+def link(modules: list[ObjectModule]) -> bytearray:
+    """Lays out the modules in order and applies all relocations in one pass"""
+    buffer = bytearray()
+    bases = []
+    exports: dict[str, list[int]] = {}
+    for m in modules:
+        base = len(buffer) // 3
+        bases.append(base)
+        buffer += m.code
+        for name, index in m.labels.items():
+            exports.setdefault(name, []).append(base + index)
+    for m, base in zip(modules, bases):
+        for index, name, shift, mask in m.relocations:
+            if (target := m.labels.get(name)) is not None:
+                target += base
+            elif len(candidates := exports.get(name, ())) == 1:
+                target = candidates[0]
+            elif not candidates:
+                raise LinkError(f"Unknown identifier '{name}' in module '{m.name}'")
+            else:
+                raise LinkError(
+                    f"Label '{name}' used in module '{m.name}' is defined by several modules"
+                )
+            address = (base + index) * 3
+            word = int.from_bytes(buffer[address : address + 3], "big")
+            word |= ((target * 3) & mask) << shift
+            buffer[address : address + 3] = word.to_bytes(3, "big")
+    return buffer
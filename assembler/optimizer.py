@@ -0,0 +1,313 @@
+"""Peephole optimizer working on the parsed program before it is encoded
+
+Removes instructions without effect, unreachable code and jumps to jumps. An
+instruction that sets flags is only removed if no later instruction can read
+them (JZE, JNZ, ADDC, SUBB, or the final state after HLT).
+"""
+
+from __future__ import annotations
+from dataclasses import dataclass, field
+
+from .ir import Instruction, Label, OPCODES, L1_IMMEDIATE, L3_I16
+
+JMP, JZE, JNZ, HLT, NOP = (OPCODES[n] for n in ("JMP", "JZE", "JNZ", "HLT", "NOP"))
+ADD, SUB = OPCODES["ADD"], OPCODES["SUB"]
+JUMPS = {JMP, JZE, JNZ}
+FLAG_READERS = {JZE, JNZ, OPCODES["ADDC"], OPCODES["SUBB"], HLT}
+FLAG_WRITERS = {
+    OPCODES[n]
+    for n in ("ADD", "ADDC", "SUB", "SUBB", "SHL", "SHR", "AND", "OR", "XOR", "NOR")
+}
+# Immediates that leave the source register unchanged: 'OP rX, rX, imm'
+IDENTITIES = {
+    ADD: 0,
+    SUB: 0,
+    OPCODES["SHL"]: 0,
+    OPCODES["SHR"]: 0,
+    OPCODES["OR"]: 0,
+    OPCODES["XOR"]: 0,
+    OPCODES["AND"]: 0xFF,
+}
+# Without a profile every loop is assumed to run this many times
+LOOP_ITERATIONS = 10
+
+
+@dataclass
+class OptimizationReport:
+    instructions: int = 0
+    # Removed instructions by reason
+    removed: dict[str, int] = field(default_factory=dict)
+    threaded_jumps: int = 0
+    # Instructions no longer executed, measured by a profile or estimated
+    dynamic_savings: int = 0
+    dynamic_total: int = 0
+    estimated: bool = True
+    skipped: str | None = None
+
+    def count(self, reason: str):
+        self.removed[reason] = self.removed.get(reason, 0) + 1
+
+    def summary(self) -> str:
+        if self.skipped:
+            return f"Optimizer skipped: {self.skipped}"
+        removed = sum(self.removed.values())
+        lines = [f"Removed {removed} of {self.instructions} instructions"]
+        for reason, count in sorted(self.removed.items()):
+            lines.append(f"  {reason:<20} {count:>8}")
+        lines.append(f"Threaded {self.threaded_jumps} jumps to jumps")
+        kind = "Estimated" if self.estimated else "Profiled"
+        savings = f"{kind} dynamic savings: {self.dynamic_savings} instructions"
+        if self.dynamic_total:
+            savings += f" ({100 * self.dynamic_savings / self.dynamic_total:.1f}%)"
+        lines.append(savings)
+        return "\n".join(lines)
+
+
+class Optimizer:
+    def __init__(self, program: list[Instruction | Label], profile: dict | None = None):
+        self.instructions: list[Instruction] = []
+        # Labels in front of every instruction, the last entry holds trailing labels
+        self.labels_before: list[list[Label]] = [[]]
+        for item in program:
+            if item.__class__ is Instruction:
+                self.instructions.append(item)
+                self.labels_before.append([])
+            else:
+                self.labels_before[-1].append(item)
+        self.targets = {
+            label.name: i
+            for i, labels in enumerate(self.labels_before)
+            for label in labels
+        }
+        self.removed = [False] * len(self.instructions)
+        self.report = OptimizationReport(len(self.instructions))
+        self.profile = profile
+        self.counts: list[int] = []
+
+    # region Analysis
+    def weights(self, profile: dict | None) -> list[int]:
+        """Executions of every instruction, from a profile or loop nesting"""
+        n = len(self.instructions)
+        if profile is not None:
+            self.report.estimated = False
+            self.report.dynamic_total = profile.get("instructions", 0)
+            counts = [0] * n
+            for entry in profile.get("pcs", []):
+                if entry["pc"] % 3 == 0 and entry["pc"] // 3 < n:
+                    counts[entry["pc"] // 3] = entry["count"]
+            return counts
+        # Every backward jump closes a loop over [target, jump]
+        depth = [0] * (n + 1)
+        for i, instr in enumerate(self.instructions):
+            if instr.opcode in JUMPS and (t := self.target(instr)) is not None:
+                if t <= i:
+                    depth[t] += 1
+                    depth[i + 1] -= 1
+        counts, level = [], 0
+        for i in range(n):
+            level += depth[i]
+            counts.append(LOOP_ITERATIONS ** min(level, 6))
+        return counts
+
+    def target(self, instr: Instruction) -> int | None:
+        """Index of the instruction a jump lands on, after removed ones"""
+        operand = instr.operands[0]
+        if operand.__class__ is not str or (t := self.targets.get(operand)) is None:
+            return None
+        if t < len(self.instructions) and self.removed[t]:
+            return self.next_kept(t)
+        return t
+
+    def next_kept(self, i: int) -> int:
+        i += 1
+        while i < len(self.instructions) and self.removed[i]:
+            i += 1
+        return i
+
+    def successors(self, i: int, instr: Instruction) -> list[int]:
+        if instr.opcode == HLT:
+            return []
+        if instr.opcode == JMP:
+            successors = [self.target(instr)]
+        elif instr.opcode in (JZE, JNZ):
+            successors = [self.target(instr), self.next_kept(i)]
+        else:
+            return [self.next_kept(i)]
+        # Unknown labels are reported by the compiler
+        return [s for s in successors if s is not None]
+
+    def reachable(self) -> set[int]:
+        n = len(self.instructions)
+        seen = set()
+        todo = [self.next_kept(-1)]
+        while todo:
+            i = todo.pop()
+            if i >= n or i in seen:
+                continue
+            seen.add(i)
+            todo.extend(self.successors(i, self.instructions[i]))
+        return seen
+
+    def flags_live_after(self) -> list[bool]:
+        """Whether the flags set by each instruction may still be read"""
+        n = len(self.instructions)
+        live_in = [False] * (n + 1)
+        # Running off the end executes whatever follows, assume it reads them
+        live_in[n] = True
+        kept = [i for i in range(n) if not self.removed[i]]
+        live_out = [False] * n
+        changed = True
+        while changed:
+            changed = False
+            for i in reversed(kept):
+                instr = self.instructions[i]
+                out = any(live_in[s] for s in self.successors(i, instr))
+                live_out[i] = out
+                value = instr.opcode in FLAG_READERS or (
+                    out and instr.opcode not in FLAG_WRITERS
+                )
+                if value != live_in[i]:
+                    live_in[i] = value
+                    changed = True
+        return live_out
+
+    def jump_targets(self) -> set[int]:
+        return {
+            self.target(instr)
+            for i, instr in enumerate(self.instructions)
+            if not self.removed[i] and instr.opcode in JUMPS
+        }
+
+    # endregion
+    # region Passes
+    def remove(self, i: int, reason: str):
+        self.removed[i] = True
+        self.report.count(reason)
+        self.report.dynamic_savings += self.counts[i] if reason != "unreachable" else 0
+
+    def thread_jumps(self) -> bool:
+        changed = False
+        for i, instr in enumerate(self.instructions):
+            if self.removed[i] or instr.opcode not in JUMPS:
+                continue
+            name, t, hops, seen = instr.operands[0], self.target(instr), 0, {i}
+            # Jumps don't change flags, a conditional jump landing on the same
+            # condition takes it too
+            while (
+                t is not None
+                and t < len(self.instructions)
+                and t not in seen
+                and self.instructions[t].opcode in (JMP, instr.opcode)
+                and self.instructions[t].operands[0].__class__ is str
+            ):
+                seen.add(t)
+                name = self.instructions[t].operands[0]
+                t = self.target(self.instructions[t])
+                hops += 1
+            if hops and t is not None and name != instr.operands[0]:
+                instr.operands = (name,)
+                self.report.threaded_jumps += 1
+                self.report.dynamic_savings += self.counts[i] * hops
+                changed = True
+        return changed
+
+    def remove_jumps_to_next(self) -> bool:
+        changed = False
+        for i, instr in enumerate(self.instructions):
+            if not self.removed[i] and instr.opcode in JUMPS:
+                if self.target(instr) == self.next_kept(i):
+                    self.remove(i, "jump to next")
+                    changed = True
+        return changed
+
+    def remove_unreachable(self) -> bool:
+        reachable = self.reachable()
+        changed = False
+        for i in range(len(self.instructions)):
+            if not self.removed[i] and i not in reachable:
+                self.remove(i, "unreachable")
+                changed = True
+        return changed
+
+    def remove_without_effect(self) -> bool:
+        changed = False
+        live = self.flags_live_after()
+        targets = self.jump_targets()
+        for i, instr in enumerate(self.instructions):
+            if self.removed[i]:
+                continue
+            if instr.opcode == NOP:
+                self.remove(i, "nop")
+                changed = True
+            elif instr.signature != L1_IMMEDIATE or live[i]:
+                continue
+            elif is_identity(instr):
+                self.remove(i, "identity")
+                changed = True
+            elif instr.opcode in (ADD, SUB) and (j := self.next_kept(i)) not in targets:
+                # 'ADD rX, rX, k' and 'SUB rX, rX, k' cancel out
+                if j < len(self.instructions) and not live[j]:
+                    other = self.instructions[j]
+                    if (
+                        other.signature == L1_IMMEDIATE
+                        and other.opcode == ADD + SUB - instr.opcode
+                        and instr.operands == other.operands
+                        and instr.operands[0] == instr.operands[1]
+                        and instr.operands[2].__class__ is int
+                    ):
+                        self.remove(i, "add/sub pair")
+                        self.remove(j, "add/sub pair")
+                        changed = True
+        return changed
+
+    # endregion
+
+    def resolve_numeric_jumps(self) -> bool:
+        """Numeric jump targets become labels, so they follow the instruction"""
+        for instr in self.instructions:
+            if instr.opcode in JUMPS and instr.signature == L3_I16:
+                address = instr.operands[0]
+                if address.__class__ is str:
+                    if address in self.targets:
+                        continue
+                    # A constant or an unknown label, reported by the compiler
+                    self.report.skipped = f"jump target '{address}' is no label"
+                    return False
+                if address.__class__ is not int:
+                    self.report.skipped = f"jump target '{address}' is computed"
+                    return False
+                if address % 3 or address // 3 >= len(self.instructions):
+                    self.report.skipped = f"jump to address {address} is no instruction"
+                    return False
+                name = f"@{address // 3}"
+                if name not in self.targets:
+                    self.targets[name] = address // 3
+                    self.labels_before[address // 3].append(Label(name, instr.line))
+                instr.operands = (name,)
+        return True
+
+    def run(self) -> list[Instruction | Label]:
+        if not self.resolve_numeric_jumps():
+            return self.program()
+        self.counts = self.weights(self.profile)
+        changed = True
+        while changed:
+            changed = self.thread_jumps()
+            changed |= self.remove_jumps_to_next()
+            changed |= self.remove_unreachable()
+            changed |= self.remove_without_effect()
+        return self.program()
+
+    def program(self) -> list[Instruction | Label]:
+        program = []
+        for i, instr in enumerate(self.instructions):
+            program.extend(self.labels_before[i])
+            if not self.removed[i]:
+                program.append(instr)
+        program.extend(self.labels_before[-1])
+        return program
+
+
+def is_identity(instr: Instruction) -> bool:
+    dest, src, value = instr.operands
+    return dest == src and IDENTITIES.get(instr.opcode) == value
@@ -1,6 +1,24 @@
 from __future__ import annotations
-from .tokenizer import Tokenizer, Token, TokenType
-from dataclasses import dataclass, field
+from .tokenizer import SCANNER, Token, TokenType
+from .expression import (
+    Expression,
+    ExpressionError,
+    SymbolTable,
+    compile_expression,
+    parse_expression,
+)
+from .ir import (
+    Instruction,
+    Label,
+    OPCODES,
+    L0_REGISTERS,
+    L1_IMMEDIATE,
+    L2_I12,
+    L3_NONE,
+    L3_I16,
+)
+from typing import Iterable, Iterator
+import re
 
 
 class ParsingError(Exception):
@@ -8,15 +26,11 @@ class ParsingError(Exception):
         super().__init__(*args)
 
 
-@dataclass
-class Node:
-    token: Token
-    children: list[Node] = field(repr=False)
-
-
-A0_INSTRUCTIONS = ["HLT", "NOP"]
-A1_INSTRUCTIONS = ["JMP", "JZE", "JNZ"]
-A3_INSTRUCTIONS = [
+A0_INSTRUCTIONS = {"HLT", "NOP"}
+A1_INSTRUCTIONS = {"JMP", "JZE", "JNZ"}
+# 'INB rd, port', 'OUTB rs, port', 'LDB rd, address' and 'STB rs, address'
+A2_INSTRUCTIONS = {"INB", "OUTB", "LDB", "STB"}
+A3_INSTRUCTIONS = {
     "ADD",
     "ADDC",
     "SUB",
@@ -28,109 +42,186 @@ A3_INSTRUCTIONS = [
     "OR",
     "XOR",
     "NOR",
-]
+}
+
+# A line with an optional label, at most one instruction and a comment. This
+# covers nearly every line and is parsed without going through tokens, anything
+# else (several statements on a line, statements spanning lines, errors) is
+# left to the token based parser.
+OPERAND = r"R\d{1,2}|\d+|[A-Z]+"
+SPACE = r"[^\S\n]*"
+STATEMENT = re.compile(
+    rf"{SPACE}(?:(?P<label>[A-Z]+):{SPACE})?"
+    rf"(?:(?P<name>[A-Z]+)(?:[^\S\n]+(?P<a>{OPERAND})"
+    rf"(?:{SPACE},{SPACE}(?P<b>{OPERAND}){SPACE},{SPACE}(?P<c>{OPERAND}))?)?{SPACE})?"
+    r"(?:#[^\n]*)?\n?"
+)
+
+
+def is_register(operand: str) -> bool:
+    return operand[0] == "R" and operand[1:].isdigit()
 
 
 class Parser:
-    def __init__(self, path: str):
-        with open(path, "r") as f:
-            buffer = f.read()
-        self.tokenizer = Tokenizer(buffer)
-        self.root = Node(None, [])
+    def __init__(self, path: str, constants: SymbolTable | None = None):
+        self.path = path
+        # '.EQU' constants, known ones are folded into the operands while parsing
+        self.constants = constants if constants is not None else SymbolTable()
+        self.lines = iter(())
+        # Tokens of the current line, reversed
+        self.pending: list[Token] = []
+        # Lines holding the continuation of a statement started on an earlier line
+        self.continued: set[int] = set()
+        self.program: list[Instruction | Label] = []
+        self.last_line = 0
 
     def parse(self):
-        while t := self.tokenizer.get_next_token():
-            if t.token_type == TokenType.IDENTIFIER:
-                self.root.children.append(self.parse_instruction(t))
-            elif t.token_type == TokenType.DIRECTIVE:
-                print("TODO (Directive)")
-            elif t.token_type == TokenType.LABEL:
-                self.root.children.append(Node(t, []))
+        self.program.extend(self.iter_parse())
+
+    def iter_parse(self) -> Iterator[Instruction | Label]:
+        """Yields instructions and labels while reading the source line by line"""
+        with open(self.path, "r") as f:
+            yield from self.parse_lines(f)
+
+    def parse_lines(
+        self, lines: Iterable[str], first_line: int = 1
+    ) -> Iterator[Instruction | Label]:
+        self.lines = enumerate(lines, first_line)
+        for number, line in self.lines:
+            line = line.upper()
+            if (items := self.parse_line(line, number)) is not None:
+                yield from items
+                continue
+            self.pending = list(SCANNER.scan(line, number))[::-1]
+            while self.pending:
+                t = self.next_token()
+                if t.token_type == TokenType.IDENTIFIER:
+                    yield self.parse_instruction(t)
+                elif t.token_type == TokenType.DIRECTIVE:
+                    self.parse_directive(t)
+                elif t.token_type == TokenType.LABEL:
+                    yield Label(t.value[:-1], t.line)
+                else:
+                    raise ParsingError(
+                        f"Invalid token! Excpected 'IDENTIFIER' or 'LABEL' got '{t.token_type.name}'"
+                    )
+
+    def parse_line(self, line: str, number: int) -> list[Instruction | Label] | None:
+        """Parses a common line directly, None leaves it to the token parser"""
+        if (m := STATEMENT.fullmatch(line)) is None:
+            return None
+        label, name, a, b, c = m.groups()
+        items = [Label(label, number)] if label else []
+        if name is None:
+            return items
+        if c is not None:
+            if name not in A3_INSTRUCTIONS or not is_register(a) or not is_register(b):
+                return None
+            if is_register(c):
+                signature, operands = L0_REGISTERS, (int(a[1:]), int(b[1:]), int(c[1:]))
             else:
-                raise ParsingError(
-                    f"Invalid token! Excpected 'IDENTIFIER' or 'LABEL' got '{t.token_type.name}'"
-                )
+                signature = L1_IMMEDIATE
+                operands = (int(a[1:]), int(b[1:]), self.parse_name(c))
+        elif a is not None:
+            if name not in A1_INSTRUCTIONS or is_register(a):
+                return None
+            signature, operands = L3_I16, (self.parse_name(a),)
+        elif name in A0_INSTRUCTIONS:
+            signature, operands = L3_NONE, ()
+        else:
+            return None
+        items.append(Instruction(OPCODES[name], signature, operands, number))
+        return items
 
-    # TODO: Better Layout/Signature System. It's a total mess
-    def parse_instruction(self, t: Token):
+    def parse_instruction(self, t: Token) -> Instruction:
         if t.value in A3_INSTRUCTIONS:
-            args = self.parse_A3()
+            signature, operands = self.parse_A3()
         elif t.value in A1_INSTRUCTIONS:
-            args = self.parse_A1()
+            signature, operands = L3_I16, (self.parse_operand(),)
+        elif t.value in A2_INSTRUCTIONS:
+            register = self.parse_register()
+            self.parse_comma()
+            signature, operands = L2_I12, (register, self.parse_operand())
         elif t.value in A0_INSTRUCTIONS:
-            args = [Node(Token(TokenType.SIGNATURE, ["L3"]), [])]
+            signature, operands = L3_NONE, ()
         else:
             raise ParsingError(f"Unknown instruction '{t.value}'")
-        t.token_type = TokenType.INSTRUCTION
-        return Node(t, args)
-
-    def parse_A1(self):
-        sig = Token(TokenType.SIGNATURE, ["L3", "I16"])
-        return [Node(sig, []), self.parse_int()]
-
-    # TODO: just no, neeads cleaning up
-    def parse_A3(self):
-        args = []
-        sig = Token(TokenType.SIGNATURE, [])
-        n = self.parse_register()
-        args.append(n)
-        sig.value.append("RD")
+        return Instruction(OPCODES[t.value], signature, operands, t.line)
+
+    def parse_A3(self) -> tuple[int, tuple[int | str | Expression, ...]]:
+        dest = self.parse_register()
         self.parse_comma()
-        n = self.parse_register()
-        args.append(n)
-        sig.value.append("RS1")
+        src1 = self.parse_register()
         self.parse_comma()
-        s, n = self.parse_register_or_int()
-        args.append(n)
-        sig.value.append(s)
-        if s == "I8":
-            sig.value.insert(0, "L1")
-        else:
-            sig.value.insert(0, "L0")
-        args.insert(0, Node(sig, []))
-        return args
+        t = self.next_token()
+        if t.token_type == TokenType.REGISTER:
+            return L0_REGISTERS, (dest, src1, int(t.value[1:]))
+        self.pending.append(t)
+        return L1_IMMEDIATE, (dest, src1, self.parse_operand())
+
+    def parse_directive(self, t: Token):
+        if t.value != ".EQU":
+            raise ParsingError(f"Unknown directive '{t.value}'")
+        name = self.next_token()
+        if name.token_type != TokenType.IDENTIFIER:
+            raise ParsingError(
+                f"Wrong arguments! Expected 'IDENTIFIER' got '{name.token_type.name}'"
+            )
+        self.parse_comma()
+        if name.value in self.constants:
+            raise ParsingError(f"Constant '{name.value}' already exists!")
+        self.constants.define(name.value, self.parse_operand())
+
+    def next_token(self) -> Token:
+        # Statements may continue on the next lines
+        while not self.pending:
+            if (line := next(self.lines, None)) is None:
+                raise ParsingError("Missing arguments at the end of the file")
+            number, text = line
+            self.continued.add(number)
+            self.pending = list(SCANNER.scan(text.upper(), number))[::-1]
+        return self.pending.pop()
 
     def parse_comma(self):
-        t = self.tokenizer.get_next_token()
+        t = self.next_token()
         if t.token_type != TokenType.COMMA:
             raise ParsingError("Missing ',' between arguments")
 
-    def parse_register(self, current=False):
-        t = self.tokenizer.get_next_token()
+    def parse_register(self) -> int:
+        t = self.next_token()
         if t.token_type != TokenType.REGISTER:
             raise ParsingError(
                 f"Worng arguments! Expected 'REGISTER' got '{t.token_type.name}'"
             )
-        return Node(t, None)
-
-    # TODO: Does it need to be a separate method
-    def parse_register_or_int(self):
-        t = self.tokenizer.get_next_token()
-        if t.token_type == TokenType.REGISTER:
-            return "RS2", Node(t, None)
-        elif t.token_type == TokenType.INTEGER or t.token_type == TokenType.IDENTIFIER:
-            return "I8", Node(t, None)
-        else:
-            raise ParsingError(
-                f"Wrong arguments! Expected 'REGISTER' or 'INTEGER' got '{t.token_type.name}'"
-            )
-
-    def parse_int(self):
-        t = self.tokenizer.get_next_token()
-        if t.token_type != TokenType.INTEGER and t.token_type != TokenType.IDENTIFIER:
-            raise ParsingError(
-                f"Wrong arguments! Expected 'INTEGER' got '{t.token_type.name}'"
-            )
-        return Node(t, None)
-
-    def body(self) -> list[Node]:
-        return self.root.children
-
-    def print_node(self, n, level):
-        print(f"{' ' * level}{'-' if n.children else ' '} {n}")
-        if n.children:
-            for child in n.children:
-                self.print_node(child, level + 1)
+        return int(t.value[1:])
+
+    def parse_operand(self) -> int | str | Expression:
+        """An integer, a name or an expression, known constants are folded"""
+        try:
+            return compile_expression(parse_expression(self), self.constants)
+        except ExpressionError as e:
+            raise ParsingError(f"{e} at line {self.last_line}") from e
+
+    def parse_name(self, operand: str) -> int | str:
+        """Operand of the fast path, an integer or a name"""
+        if operand.isdigit():
+            return int(operand)
+        value = self.constants.values.get(operand)
+        return value if value.__class__ is int else operand
+
+    # Token source of the expression parser, an expression ends with its line
+    # unless an operator asks for another operand
+    def get_next_token(self) -> Token:
+        t = self.next_token()
+        self.last_line = t.line
+        return t
+
+    def peek_next_token(self) -> Token | None:
+        return self.pending[-1] if self.pending else None
+
+    def body(self) -> list[Instruction | Label]:
+        return self.program
 
     def print_ast(self):
-        self.print_node(self.root, 0)
+        for item in self.program:
+            print(f"{'' if isinstance(item, Label) else '  '}{item}")
@@ -1,5 +1,6 @@
 from enum import Enum, auto
 from dataclasses import dataclass
+from typing import Iterator
 import re
 
 
@@ -18,47 +19,90 @@ class TokenType(Enum):
     DIRECTIVE = auto()
     IDENTIFIER = auto()
     SIGNATURE = auto()
+    HEX = auto()
+    BIN = auto()
+    OPERATOR = auto()
+    OPEN_PARAN = auto()
+    CLOSE_PARAN = auto()
 
 
-@dataclass
+@dataclass(slots=True)
 class Token:
     token_type: TokenType
     value: str
+    line: int = 0
+    column: int = 0
 
 
+# Tried in this order, the first alternative that matches wins
 TOKEN_DEFINTIONS = {
-    TokenType.LABEL: re.compile(r"^[A-Z]+:"),
-    TokenType.DIRECTIVE: re.compile(r"^\.[A-Z]+"),
-    TokenType.IDENTIFIER: re.compile(r"[A-Z]+\b"),
-    TokenType.REGISTER: re.compile(r"^R\d{1,2}"),
-    TokenType.INTEGER: re.compile(r"^\d+"),
-    TokenType.COMMA: re.compile(r"^,"),
+    TokenType.LABEL: r"[A-Z]+:",
+    TokenType.DIRECTIVE: r"\.[A-Z]+",
+    TokenType.IDENTIFIER: r"[A-Z]+\b",
+    TokenType.REGISTER: r"R\d{1,2}",
+    TokenType.HEX: r"0X[0-9A-F]+",
+    TokenType.BIN: r"0B[01]+",
+    TokenType.INTEGER: r"\d+",
+    TokenType.COMMA: r",",
+    TokenType.OPERATOR: r"<<|>>|\+|-|\*|/|%|\||&|~|\^",
+    TokenType.OPEN_PARAN: r"\(",
+    TokenType.CLOSE_PARAN: r"\)",
 }
-COMMENT = re.compile(r"^\s*(#[^\n]*|\s+)")
+# Whitespace and comments between tokens, newlines are matched separately
+SKIP = r"[^\S\n]+|#[^\n]*"
+
+
+class Scanner:
+    """Tokenizes with one combined pattern, matching in place instead of on slices"""
+
+    def __init__(self, definitions: dict[Enum, str], token_class, skip=SKIP):
+        self.token_class = token_class
+        self.types = {t.name: t for t in definitions}
+        self.pattern = re.compile(
+            "|".join(
+                [
+                    r"(?P<NEWLINE>\n)",
+                    f"(?P<SKIP>{skip})",
+                    *(f"(?P<{t.name}>{p})" for t, p in definitions.items()),
+                    r"(?P<MISMATCH>.)",
+                ]
+            )
+        )
+
+    def scan(self, buffer: str, line: int = 1) -> Iterator:
+        types = self.types
+        token_class = self.token_class
+        line_start = 0
+        for m in self.pattern.finditer(buffer):
+            if (token_type := types.get(m.lastgroup)) is not None:
+                pos = m.start()
+                yield token_class(token_type, m.group(), line, pos - line_start + 1)
+            elif m.lastgroup == "NEWLINE":
+                line += 1
+                line_start = m.end()
+            elif m.lastgroup == "MISMATCH":
+                pos = m.start()
+                raise TokenizationError(
+                    f"Unknown Token at line {line}, column {pos - line_start + 1}: "
+                    f"'{buffer[pos:pos + 20]}'"
+                )
+
+
+SCANNER = Scanner(TOKEN_DEFINTIONS, Token)
 
 
 class Tokenizer:
     def __init__(self, buffer: str) -> None:
-        self.buffer = buffer.strip().upper()
-        self.pointer = 0
-        self.buff_len = len(self.buffer)
+        self.buffer = buffer.upper()
+        self.tokens = SCANNER.scan(self.buffer)
         self.curr_token = None
 
+    def __iter__(self) -> Iterator[Token]:
+        return self.tokens
+
     def get_current_token(self):
         return self.curr_token
 
     def get_next_token(self):
-        while m := re.match(COMMENT, self.buffer[self.pointer :]):
-            self.pointer += m.end()
-        if self.pointer >= self.buff_len:
-            self.curr_token = None
-            return None
-        for token_type, token_def in TOKEN_DEFINTIONS.items():
-            if m := re.match(token_def, self.buffer[self.pointer :]):
-                self.pointer += m.end()
-                t = Token(token_type, m[0])
-                self.curr_token = t
-                return t
-        raise TokenizationError(
-            f"Unknown Token at '{self.buffer[self.pointer:self.pointer+20]}'"
-        )
+        self.curr_token = next(self.tokens, None)
+        return self.curr_token
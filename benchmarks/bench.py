@@ -0,0 +1,261 @@
+"""Throughput benchmarks for the assembler and the emulator
+
+Run from the repository root:
+    python -m benchmarks.bench                    # measure and compare to baseline
+    python -m benchmarks.bench --update-baseline  # store the results as new baseline
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from assembler import Compiler
+from assembler.stp_parser import Parser
+from assembler.tokenizer import Tokenizer
+from budgets import EXEC_LATENCY_BUDGET
+from emulator import CPU, Memory, RegisterFile
+from emulator.tracer import Tracer, TRACE_OVERHEAD_LIMIT
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MAIN = os.path.join(os.path.dirname(HERE), "main.py")
+WORKLOADS = os.path.join(HERE, "workloads")
+BASELINE = os.path.join(HERE, "baseline.json")
+RESULTS = os.path.join(HERE, "results.json")
+
+GENERATED_INSTRUCTIONS = 100_000
+
+
+def label_name(i: int) -> str:
+    # Labels may only contain letters
+    name = ""
+    while True:
+        name += chr(ord("A") + i % 26)
+        i //= 26
+        if i == 0:
+            return "L" + name
+
+
+def generate_source(path: str, instructions: int, seed: int = 0):
+    """Writes a large program: random arithmetic with a loop every 100 lines"""
+    rnd = random.Random(seed)
+    ops = ["ADD", "ADDC", "SUB", "SUBB", "SHL", "SHR", "AND", "OR", "XOR", "NOR"]
+    with open(path, "w") as f:
+        for i in range(instructions):
+            if i % 100 == 0:
+                f.write(f"{label_name(i // 100)}:\n")
+            if i % 100 == 99:
+                f.write(f"JNZ {label_name(i // 100)}\n")
+                continue
+            d, s = rnd.randrange(16), rnd.randrange(16)
+            if rnd.random() < 0.5:
+                operand = f"r{rnd.randrange(16)}"
+            else:
+                operand = str(rnd.randrange(256))
+            f.write(f"{rnd.choice(ops)} r{d}, r{s}, {operand} # comment\n")
+
+
+# region Measuring
+def best_time(f, repeat: int, min_time: float = 0.2) -> float:
+    """Best time per call, short calls are repeated until 'min_time' passed"""
+    best = float("inf")
+    for _ in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            f()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        best = min(best, elapsed / calls)
+    return best
+
+
+def peak_memory(f) -> int:
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def tokenize(path: str):
+    with open(path, "r") as f:
+        t = Tokenizer(f.read())
+    while t.get_next_token():
+        pass
+
+
+def parse(path: str):
+    Parser(path).parse()
+
+
+def assemble(path: str) -> Compiler:
+    c = Compiler(path)
+    c.build()
+    return c
+
+
+def emulate(program: bytes, jit: bool, trace: str | None = None) -> int:
+    m = Memory(2**16)
+    m.view[: len(program)] = program
+    m.notify_write(0, len(program))
+    c = CPU(m, RegisterFile(10, 3))
+    if trace is None:
+        return c.run(jit=jit)
+    tracer = Tracer(trace)
+    try:
+        return c.run(tracer=tracer)
+    finally:
+        tracer.close()
+
+
+def exec_latency(path: str) -> float:
+    """Seconds from the start of 'main.py exec' to the first instruction"""
+    out = subprocess.run(
+        [sys.executable, MAIN, "exec", path, "--latency"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return float(re.search(r"after ([\d.]+) ms", out.stderr).group(1)) / 1000
+
+
+def metric(value: float, unit: str, better: str) -> dict:
+    return {"value": value, "unit": unit, "better": better}
+
+
+def bench_assembler(name: str, path: str, repeat: int, results: dict):
+    with open(path, "r") as f:
+        lines = f.read().count("\n") + 1
+    for stage, f in (("tokenize", tokenize), ("parse", parse), ("build", assemble)):
+        t = best_time(lambda: f(path), repeat)
+        results[f"assembler.{stage}.{name}"] = metric(lines / t, "lines/s", "higher")
+    peak = peak_memory(lambda: assemble(path))
+    results[f"assembler.peak.{name}"] = metric(peak, "bytes", "lower")
+
+
+def bench_emulator(name: str, path: str, repeat: int, results: dict):
+    program = bytes(assemble(path).buffer)
+    for mode, jit in (("interpreter", False), ("jit", True)):
+        executed = emulate(program, jit)
+        t = best_time(lambda: emulate(program, jit), repeat)
+        results[f"emulator.{mode}.{name}"] = metric(executed / t, "instr/s", "higher")
+    with tempfile.TemporaryDirectory() as directory:
+        trace = os.path.join(directory, "bench.trace")
+        t = best_time(lambda: emulate(program, False, trace), repeat)
+    results[f"emulator.traced.{name}"] = metric(executed / t, "instr/s", "higher")
+    overhead = results[f"emulator.interpreter.{name}"]["value"] * t / executed
+    results[f"emulator.trace_overhead.{name}"] = metric(overhead, "x", "lower")
+    peak = peak_memory(lambda: emulate(program, False))
+    results[f"emulator.peak.{name}"] = metric(peak, "bytes", "lower")
+
+
+def bench_exec(path: str, repeat: int, results: dict):
+    # Every run is a new process, so the best of a few more runs is taken
+    latency = min(exec_latency(path) for _ in range(3 * repeat))
+    results["exec.latency"] = metric(1000 * latency, "ms", "lower")
+
+
+def run_benchmarks(repeat: int, generated: int) -> dict:
+    results = {}
+    for path in sorted(glob.glob(os.path.join(WORKLOADS, "*.stp"))):
+        name = os.path.splitext(os.path.basename(path))[0]
+        bench_assembler(name, path, repeat, results)
+        bench_emulator(name, path, repeat, results)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "halt.stp")
+        with open(path, "w") as f:
+            f.write("HLT\n")
+        bench_exec(path, repeat, results)
+        path = os.path.join(directory, "generated.stp")
+        generate_source(path, generated)
+        # Too large for the 64 KiB address space, so only the assembler is measured
+        bench_assembler("generated", path, max(1, repeat // 3), results)
+    return results
+
+
+# endregion
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list[str]:
+    regressions = []
+    for name, m in results.items():
+        if (base := baseline.get(name)) is None or base["value"] == 0:
+            continue
+        change = m["value"] / base["value"] - 1
+        if m["better"] == "lower":
+            change = -change
+        status = ""
+        if change < -tolerance:
+            status = "REGRESSION"
+            regressions.append(name)
+        print(
+            f"{name:<42} {m['value']:>14.1f} {m['unit']:<8} {100 * change:+7.1f}% {status}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Assembler and emulator benchmarks")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="runs per metric")
+    parser.add_argument("-o", "--output", default=RESULTS, help="results json file")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline json file")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="allowed relative slowdown before a metric counts as regression",
+    )
+    parser.add_argument(
+        "--generated",
+        type=int,
+        default=GENERATED_INSTRUCTIONS,
+        help=f"instructions in the generated source (default {GENERATED_INSTRUCTIONS})",
+    )
+    parser.add_argument(
+        "--update-baseline", action="store_true", help="store results as baseline"
+    )
+    ns = parser.parse_args()
+
+    results = run_benchmarks(ns.repeat, ns.generated)
+    with open(ns.output, "w") as f:
+        json.dump(results, f, indent=2)
+    if ns.update_baseline:
+        with open(ns.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Baseline written to '{ns.baseline}'")
+        return
+    if (latency := results["exec.latency"]["value"]) > 1000 * EXEC_LATENCY_BUDGET:
+        print(
+            f"exec latency {latency:.1f} ms is over the budget of {1000 * EXEC_LATENCY_BUDGET:.0f} ms"
+        )
+        sys.exit(1)
+    overheads = {n: m["value"] for n, m in results.items() if ".trace_overhead." in n}
+    if over := [n for n, v in overheads.items() if v > TRACE_OVERHEAD_LIMIT]:
+        for name in over:
+            print(
+                f"{name} {overheads[name]:.2f}x is over the limit of {TRACE_OVERHEAD_LIMIT}x"
+            )
+        sys.exit(1)
+    if not os.path.exists(ns.baseline):
+        print(f"No baseline at '{ns.baseline}', run with --update-baseline first")
+        return
+    with open(ns.baseline, "r") as f:
+        baseline = json.load(f)
+    if regressions := compare(results, baseline, ns.tolerance):
+        print(f"{len(regressions)} regression(s)")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+"""Performance budgets checked by main.py and the benchmarks
+
+Kept apart from main.py so the benchmarks don't load the whole command line
+interface for them.
+"""
+
+# Seconds from the start of main.py until 'exec' runs the first instruction
+EXEC_LATENCY_BUDGET = 0.15
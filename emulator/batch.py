@@ -0,0 +1,260 @@
+from __future__ import annotations
+import numpy as np
+
+from .cpu import OpCode, Flag
+from .devices import DeviceBus, QueueDevice
+from .dispatch import REGISTER_FIELDS
+
+CARRY, SIGN, ZERO = int(Flag.CARRY), int(Flag.SIGN), int(Flag.ZERO)
+
+# Shifting a byte by 16 already moves every bit out of the low 8 bits and
+# keeps the flags of the unbounded shift, larger counts are clamped to that
+MAX_SHIFT = 16
+IMMEDIATE_MASKS = (0, 0xFF, 0xFFF, 0xFFFF)
+# Control instructions that also exist in the register layout (L0)
+NO_OPERANDS = (OpCode.NOP.value, OpCode.HLT.value)
+
+
+class BatchCPU:
+    """Runs the same instruction set on many independent machines (lanes) at once
+
+    Every lane has its own registers, flags, pc and memory, all stored as NumPy
+    arrays. A step fetches the next instruction of every running lane and
+    executes it for all lanes that decoded the same opcode and layout together,
+    so lanes whose pcs diverge still make progress in the same step.
+
+    Every lane has a DeviceBus like a CPU. A lane whose 'INB' found no input
+    waits in front of it, 'run' tries it again. A lane whose pc runs off the
+    end of its memory, that accesses memory beyond it or that executes an
+    instruction the CPU would report (an unknown opcode or a register outside
+    the register file) is stopped and marked in 'errors'.
+    """
+
+    def __init__(
+        self,
+        lanes: int,
+        memory_size: int = 2**16,
+        reg_count: int = 10,
+        ireg_count: int = 3,
+    ):
+        self.lanes = lanes
+        self.memory_size = memory_size
+        self.register_count = reg_count + 2 * ireg_count
+        self.memory = np.zeros((lanes, memory_size), dtype=np.uint8)
+        self.registers = np.zeros((lanes, self.register_count), dtype=np.uint8)
+        self.flags = np.zeros(lanes, dtype=np.uint8)
+        self.pc = np.zeros(lanes, dtype=np.int64)
+        self.running = np.zeros(lanes, dtype=bool)
+        self.instructions = np.zeros(lanes, dtype=np.int64)
+        # Port of the 'INB' a lane waits in front of, -1 if it doesn't
+        self.waiting = np.full(lanes, -1, dtype=np.int64)
+        self.errors = np.zeros(lanes, dtype=bool)
+        self.buses = [DeviceBus() for _ in range(lanes)]
+        self.handlers = {
+            OpCode.NOP.value: self.nop,
+            OpCode.HLT.value: self.hlt,
+            OpCode.JMP.value: self.jmp,
+            OpCode.JZE.value: self.jze,
+            OpCode.JNZ.value: self.jnz,
+        }
+        # Instructions with a register and a 12-bit port or address (L2)
+        self.l2_handlers = {
+            OpCode.INB.value: self.inb,
+            OpCode.OUTB.value: self.outb,
+            OpCode.LDB.value: self.ldb,
+            OpCode.STB.value: self.stb,
+        }
+        self.alu = {
+            OpCode.ADD.value: lambda a, b, f: a + b,
+            OpCode.ADDC.value: lambda a, b, f: a + b + (f & CARRY),
+            OpCode.SUB.value: lambda a, b, f: a - b,
+            OpCode.SUBB.value: lambda a, b, f: a - b - ((f & SIGN) >> 1),
+            OpCode.SHL.value: lambda a, b, f: a << np.minimum(b, MAX_SHIFT),
+            OpCode.SHR.value: lambda a, b, f: a >> np.minimum(b, MAX_SHIFT),
+            OpCode.AND.value: lambda a, b, f: a & b,
+            OpCode.OR.value: lambda a, b, f: a | b,
+            OpCode.XOR.value: lambda a, b, f: a ^ b,
+            OpCode.NOR.value: lambda a, b, f: ~(a | b),
+        }
+
+    # region State
+    def load_program(self, program: bytes, offset: int = 0):
+        """Copies the same image into the memory of every lane and resets them"""
+        image = np.frombuffer(program, dtype=np.uint8)
+        self.memory[:, offset : offset + len(image)] = image
+        self.reset()
+
+    def reset(self):
+        """Starts every lane again at pc 0, registers and memory are kept"""
+        self.pc[:] = 0
+        self.running[:] = True
+        self.instructions[:] = 0
+        self.waiting[:] = -1
+        self.errors[:] = False
+
+    def feed(self, lane: int, port: int, data: bytes):
+        """Queues input for 'INB' on 'port' of 'lane', like CPU.feed"""
+        device = self.buses[lane][port]
+        if not isinstance(device, QueueDevice):
+            raise ValueError(f"Port {port} has no queue device, it can't be fed")
+        device.feed(data)
+
+    def load_from_file(self, path: str):
+        with open(path, "rb") as f:
+            self.load_program(f.read())
+
+    def final_state(self) -> dict[str, np.ndarray]:
+        return {
+            "registers": self.registers.copy(),
+            "flags": self.flags.copy(),
+            "pc": self.pc.copy(),
+            "running": self.running.copy(),
+            "instructions": self.instructions.copy(),
+            "waiting": self.waiting.copy(),
+            "errors": self.errors.copy(),
+        }
+
+    def lane_state(self, lane: int) -> dict:
+        return {
+            "registers": self.registers[lane].tolist(),
+            "flags": Flag(int(self.flags[lane])),
+            "pc": int(self.pc[lane]),
+            "running": bool(self.running[lane]),
+            "instructions": int(self.instructions[lane]),
+            "waiting": None if self.waiting[lane] < 0 else int(self.waiting[lane]),
+            "error": bool(self.errors[lane]),
+        }
+
+    # endregion
+    # region Execution
+    def step(self):
+        lanes = np.flatnonzero(self.running)
+        if len(lanes) == 0:
+            return
+        pc = self.pc[lanes]
+        if (outside := pc > self.memory_size - 3).any():
+            # The CPU fails to fetch there, only these lanes stop
+            self.fail(lanes[outside])
+            lanes, pc = lanes[~outside], pc[~outside]
+        mem = self.memory
+        word = (
+            mem[lanes, pc].astype(np.int64) << 16
+            | mem[lanes, pc + 1].astype(np.int64) << 8
+            | mem[lanes, pc + 2]
+        )
+        self.pc[lanes] = pc + 3
+        self.instructions[lanes] += 1
+        index = (word >> 17) & 0x7F
+        fields = (
+            (word >> 13) & 0xF,
+            (word >> 9) & 0xF,
+            (word >> 5) & 0xF,
+        )
+        for i in np.unique(index).tolist():
+            layout, opcode = i >> 5, i & 0b11111
+            group = index == i
+            sel = lanes[group]
+            d, s, r = (f[group] for f in fields)
+            x = r if layout == 0 else (word[group] >> 1) & IMMEDIATE_MASKS[layout]
+            # Lanes naming a register outside the register file fail
+            valid = np.ones(len(sel), dtype=bool)
+            for reg in (d, s, r)[: REGISTER_FIELDS[layout]]:
+                valid &= reg < self.register_count
+            if not valid.all():
+                self.fail(sel[~valid])
+                sel, d, s, x = sel[valid], d[valid], s[valid], x[valid]
+            self.execute(opcode, layout, sel, d, s, x)
+
+    def execute(self, opcode: int, layout: int, lanes, d, s, x):
+        if opcode in self.alu and layout < 2:
+            self.arithmetic(opcode, layout, lanes, d, s, x)
+        elif (handler := self.handlers.get(opcode)) and (
+            layout != 0 or opcode in NO_OPERANDS
+        ):
+            handler(lanes, x)
+        elif opcode in self.l2_handlers and layout == 2:
+            self.l2_handlers[opcode](lanes, d, x)
+        else:
+            # Unknown opcodes and layouts, the CPU reports them
+            self.fail(lanes)
+
+    def fail(self, lanes):
+        self.errors[lanes] = True
+        self.running[lanes] = False
+
+    def arithmetic(self, opcode: int, layout: int, lanes, d, s, x):
+        a = self.registers[lanes, s].astype(np.int64)
+        if layout == 0:
+            b = self.registers[lanes, x].astype(np.int64)
+        else:
+            b = x
+        v = self.alu[opcode](a, b, self.flags[lanes].astype(np.int64))
+        self.flags[lanes] = (
+            (v == 0) * ZERO + ((v & 0x80) != 0) * SIGN + (v > 0xFF) * CARRY
+        )
+        self.registers[lanes, d] = v & 0xFF
+
+    def nop(self, lanes, x):
+        return
+
+    def hlt(self, lanes, x):
+        self.running[lanes] = False
+
+    def jmp(self, lanes, x):
+        self.pc[lanes] = x
+
+    def jze(self, lanes, x):
+        taken = (self.flags[lanes] & ZERO) != 0
+        self.pc[lanes[taken]] = x[taken]
+
+    def jnz(self, lanes, x):
+        taken = (self.flags[lanes] & ZERO) == 0
+        self.pc[lanes[taken]] = x[taken]
+
+    def inb(self, lanes, d, x):
+        # Lanes read from their own devices, one at a time
+        for lane, reg, port in zip(lanes.tolist(), d.tolist(), x.tolist()):
+            if (byte := self.buses[lane][port].read()) is None:
+                # Like CPU: waits in front of the 'INB', which isn't counted
+                self.waiting[lane] = port
+                self.running[lane] = False
+                self.pc[lane] -= 3
+                self.instructions[lane] -= 1
+            else:
+                self.registers[lane, reg] = byte
+
+    def outb(self, lanes, d, x):
+        values = self.registers[lanes, d].tolist()
+        for lane, value, port in zip(lanes.tolist(), values, x.tolist()):
+            self.buses[lane][port].write(value)
+
+    def ldb(self, lanes, d, x):
+        lanes, d, x = self.in_memory(lanes, d, x)
+        self.registers[lanes, d] = self.memory[lanes, x]
+
+    def stb(self, lanes, d, x):
+        lanes, d, x = self.in_memory(lanes, d, x)
+        self.memory[lanes, x] = self.registers[lanes, d]
+
+    def in_memory(self, lanes, d, x):
+        """Stops the lanes whose address is outside their memory, like on a fetch"""
+        inside = x < self.memory_size
+        if not inside.all():
+            self.fail(lanes[~inside])
+        return lanes[inside], d[inside], x[inside]
+
+    def run(self, max_steps: int | None = None) -> int:
+        """Runs until every lane halted or waits or 'max_steps' steps were executed
+
+        Continues where the last run stopped, lanes that halted stay halted
+        until 'reset'. Waiting lanes try their 'INB' again.
+        """
+        self.running |= self.waiting >= 0
+        self.waiting[:] = -1
+        steps = 0
+        while self.running.any() and (max_steps is None or steps < max_steps):
+            self.step()
+            steps += 1
+        return steps
+
+    # endregion
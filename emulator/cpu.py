@@ -1,7 +1,19 @@
-from .memory import Memory
+from __future__ import annotations
+from .memory import Memory, MemorySnapshot
 from .register_file import RegisterFile
+from .devices import DeviceBus, QueueDevice
+from .dispatch import Handler, REGISTER_FIELDS, build_dispatch_table
+import math
+from itertools import repeat
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
 from enum import IntFlag, auto, Enum
 
+if TYPE_CHECKING:
+    from .jit import BlockTranslator
+    from .profiler import Profiler
+    from .tracer import Tracer
+
 Address = int
 
 
@@ -46,18 +58,82 @@ class Flag(IntFlag):
     ZERO = auto()
 
 
+FLAGS = [Flag(i) for i in range(8)]
+
+
+class StopReason(Enum):
+    HALT = auto()
+    BREAKPOINT = auto()
+    WATCHPOINT = auto()
+    # 'INB' found no input, see CPU.feed
+    INPUT = auto()
+    # The instruction budget ran out
+    LIMIT = auto()
+
+
+@dataclass
+class Stop:
+    reason: StopReason
+    pc: Address
+    # ('read' or 'write', address, byte) of the access that hit a watchpoint
+    access: tuple[str, Address, int] | None = None
+
+
+@dataclass
+class CPUSnapshot:
+    memory: MemorySnapshot
+    registers: bytes
+    pc: Address
+    sp: Address
+    flags: Flag
+
+
 class CPU:
-    def __init__(self, memory: Memory, register_file: RegisterFile):
+    def __init__(
+        self, memory: Memory, register_file: RegisterFile, lazy_flags: bool = False
+    ):
         self.memory = memory
         self.registers = register_file
         self.pc = 0
-        self.flags = Flag(0)
+        # With lazy flags the result of the last ALU instruction is kept in
+        # 'flag_result' and only turned into flags when they are read
+        self.lazy_flags = lazy_flags
+        self.flag_state = Flag(0)
+        self.flag_result: int | None = None
         self.sp = 0
         self.instr_buffer = 0
         self.opcode = OpCode(1)
         self.running = False
+        # Devices 'INB' reads from and 'OUTB' writes to, by port
+        self.bus = DeviceBus()
+        # Port of an 'INB' that found no input. The run stopped in front of it
+        # with 'running' cleared, it continues once 'feed' provided input.
+        self.waiting: int | None = None
+        self.dispatch = build_dispatch_table(self)
+        # Predecoded instructions by address: (handler, d, s, x)
+        self.icache: list[tuple | None] = [None] * memory.size
+        self.icache_hits = 0
+        self.icache_misses = 0
+        memory.add_write_listener(self.invalidate_icache)
+        self.jit: BlockTranslator | None = None
+        # Runs check the pc against the breakpoints only while there are any
+        self.breakpoints: set[Address] = set()
+        # Why the last run under the debugger or a watchpoint stopped
+        self.stop: Stop | None = None
+        memory.add_watch_listener(self.watchpoint_hit)
 
     # region Helper functions
+    @property
+    def flags(self) -> Flag:
+        if self.flag_result is not None:
+            self.update_flags(self.flag_result)
+        return self.flag_state
+
+    @flags.setter
+    def flags(self, flags: Flag):
+        self.flag_state = flags
+        self.flag_result = None
+
     def set_flag(self, flag: Flag):
         self.flags |= flag
 
@@ -68,6 +144,35 @@ class CPU:
     def is_flag_set(self, flag: Flag) -> bool:
         return flag in self.flags
 
+    def snapshot(self) -> CPUSnapshot:
+        return CPUSnapshot(
+            self.memory.snapshot(),
+            self.registers.snapshot(),
+            self.pc,
+            self.sp,
+            self.flags,
+        )
+
+    def restore(self, snapshot: CPUSnapshot):
+        """Resets the machine, only memory pages written since are copied back"""
+        self.memory.restore(snapshot.memory)
+        self.registers.restore(snapshot.registers)
+        self.pc = snapshot.pc
+        self.sp = snapshot.sp
+        self.flags = snapshot.flags
+        self.running = False
+        self.stop = None
+        self.waiting = None
+
+    def feed(self, port: int, data: bytes):
+        """Queues input for 'INB' on 'port', which needs a QueueDevice"""
+        device = self.bus[port]
+        if not isinstance(device, QueueDevice):
+            raise ValueError(f"Port {port} has no queue device, it can't be fed")
+        device.feed(data)
+        if self.waiting == port:
+            self.waiting = None
+
     def PC(self) -> Address:
         pc = self.pc
         self.pc += 1
@@ -76,147 +181,331 @@ class CPU:
     # endregion
     # region Instruction pipeline
     def fetch_instr(self):
-        self.instr_buffer = 0
-        for i in range(2, -1, -1):
-            self.instr_buffer |= self.memory.load_byte(self.PC()) << (8 * i)
+        # Instruction fetches don't go through load_byte, see Memory.watch
+        data = self.memory.data
+        pc = self.pc
+        self.instr_buffer = data[pc] << 16 | data[pc + 1] << 8 | data[pc + 2]
+        self.pc = pc + 3
 
-    def decode_instr(self):
+    def decode_instr(self) -> tuple[Handler, int, int, int]:
         # 00IIIII | DDDD SSSS SSSS XXXXX
         # 01IIIII | DDDD SSSS VVVV VVVVX
         # 10IIIII | DDDD VVVV VVVV VVVVX
         # 11IIIII | VVVV VVVV VVVV VVVVX
-        layout = (self.instr_buffer >> 22) & 0b11
-        self.opcode = OpCode((self.instr_buffer >> 17) & 0b11111)
+        index = (self.instr_buffer >> 17) & 0x7F
+        layout = index >> 5
+        self.opcode = OpCode(index & 0b11111)
         if layout == 0:
-            self.decode_L0()
+            args = self.decode_L0()
         elif layout == 1:
-            self.decode_L1()
+            args = self.decode_L1()
         elif layout == 2:
-            self.decode_L2()
-        elif layout == 3:
-            self.decode_L3()
-
-    def decode_L0(self):
-        self.decoded_args = {
-            "dest": (self.instr_buffer >> 13) & 0xF,
-            "src1": (self.instr_buffer >> 9) & 0xF,
-            "src2": (self.instr_buffer >> 5) & 0xF,
-        }
-
-    def decode_L1(self):
-        self.decoded_args = {
-            "dest": (self.instr_buffer >> 13) & 0xF,
-            "src1": (self.instr_buffer >> 9) & 0xF,
-            "val": (self.instr_buffer >> 1) & 0xFF,
-        }
-
-    def decode_L2(self):
-        self.decoded_args = {
-            "dest": (self.instr_buffer >> 13) & 0xF,
-            "val": (self.instr_buffer >> 1) & 0xFFF,
-        }
-
-    def decode_L3(self):
-        self.decoded_args = {
-            "val": (self.instr_buffer >> 1) & 0xFFFF,
-        }
-
-    def execute_instr(self):
-        self.fetch_instr()
-        self.decode_instr()
-        if f := getattr(self, self.opcode.name.lower() + "_", None):
-            f()
+            args = self.decode_L2()
         else:
-            print(f"'{self.opcode.name}' not implemented!")
+            args = self.decode_L3()
+        # Register indices are validated here once instead of on every access
+        for reg in args[: REGISTER_FIELDS[layout]]:
+            if not self.registers.check_r_index(reg):
+                return (self.skip_instr, *args)
+        return (self.dispatch[index], *args)
+
+    def decode_L0(self) -> tuple[int, int, int]:
+        return (
+            (self.instr_buffer >> 13) & 0xF,
+            (self.instr_buffer >> 9) & 0xF,
+            (self.instr_buffer >> 5) & 0xF,
+        )
+
+    def decode_L1(self) -> tuple[int, int, int]:
+        return (
+            (self.instr_buffer >> 13) & 0xF,
+            (self.instr_buffer >> 9) & 0xF,
+            (self.instr_buffer >> 1) & 0xFF,
+        )
+
+    def decode_L2(self) -> tuple[int, int, int]:
+        return (
+            (self.instr_buffer >> 13) & 0xF,
+            0,
+            (self.instr_buffer >> 1) & 0xFFF,
+        )
+
+    def decode_L3(self) -> tuple[int, int, int]:
+        return 0, 0, (self.instr_buffer >> 1) & 0xFFFF
 
-    def update_flags(self, value: int):
-        if value == 0:
-            self.set_flag(Flag.ZERO)
-        else:
-            self.remove_flag(Flag.ZERO)
-        if value > 0xFF:
-            self.set_flag(Flag.CARRY)
-        else:
-            self.remove_flag(Flag.CARRY)
-        if value & 0x80 > 1:
-            self.set_flag(Flag.SIGN)
-        else:
-            self.remove_flag(Flag.SIGN)
-
-    def load_operands(self) -> tuple[int, int, int]:
-        d = self.decoded_args["dest"]
-        a = self.registers.get_register(self.decoded_args["src1"])
-        if "src2" in self.decoded_args:
-            b = self.registers.get_register(self.decoded_args["src2"])
+    def execute_instr(self):
+        pc = self.pc
+        entry = self.icache[pc]
+        if entry is None:
+            self.icache_misses += 1
+            self.fetch_instr()
+            entry = self.icache[pc] = self.decode_instr()
         else:
-            b = self.decoded_args["val"]
-        return d, a, b
+            self.icache_hits += 1
+            self.pc = pc + 3
+        handler, d, s, x = entry
+        handler(d, s, x)
 
-    # endregion
-    # region Instruction implementations
+    def predecode(self, start: Address = 0, end: Address | None = None) -> int:
+        """Decodes memory[start:end] into the icache at once, requires NumPy"""
+        from .decoder import predecode
 
-    def hlt_(self):
-        self.running = False
+        return predecode(self, start, end)
 
-    def nop_(self):
+    def skip_instr(self, d: int, s: int, x: int):
         return
 
-    def arithmetic(self, o):
-        d, a, b = self.load_operands()
-        res = o(a, b)
-        self.update_flags(res)
-        self.registers.set_register(d, res)
-
-    def add_(self):
-        self.arithmetic(lambda a, b: a + b)
-
-    def addc_(self):
-        self.arithmetic(lambda a, b: a + b + (1 if self.is_flag_set(Flag.CARRY) else 0))
+    def invalidate_icache(self, start: Address, end: Address):
+        # An instruction starting up to two bytes before 'start' overlaps the range
+        for addr in range(max(start - 2, 0), min(end, len(self.icache))):
+            self.icache[addr] = None
 
-    def sub_(self):
-        self.arithmetic(lambda a, b: a - b)
+    def update_flags(self, value: int):
+        self.flag_state = FLAGS[
+            (value == 0) << 2 | ((value & 0x80) != 0) << 1 | (value > 0xFF)
+        ]
+        self.flag_result = None
 
-    def subb_(self):
-        self.arithmetic(lambda a, b: a - b - (1 if self.is_flag_set(Flag.SIGN) else 0))
+    def record_result(self, value: int):
+        self.flag_result = value
 
-    def shl_(self):
-        self.arithmetic(lambda a, b: a << b)
+    # endregion
 
-    def shr_(self):
-        self.arithmetic(lambda a, b: a >> b)
+    def run(
+        self,
+        jit: bool = False,
+        max_instructions: int | None = None,
+        profiler: Profiler | None = None,
+        tracer: Tracer | None = None,
+    ) -> int:
+        """Runs until 'HLT' or until 'max_instructions' instructions were executed
+
+        Returns the number of executed instructions. 'running' stays set if the
+        budget ran out before the program halted, so the run can be resumed.
+        With a profiler or a tracer the program is interpreted and every step
+        is recorded. Otherwise breakpoints, if any are set, stop the run, which
+        is then interpreted too.
+        """
+        if profiler is not None and tracer is not None:
+            raise ValueError("A run can't be profiled and traced at once")
+        if self.breakpoints and profiler is None and tracer is None:
+            return self.run_debug(max_instructions)
+        self.stop = None
+        if profiler is not None:
+            return self.run_profiled(profiler, max_instructions)
+        if tracer is not None:
+            return self.run_traced(tracer, max_instructions)
+        if jit:
+            return self.run_blocks(max_instructions)
+        return self.run_interpreter(max_instructions)
+
+    def run_interpreter(self, max_instructions: int | None = None) -> int:
+        self.running = True
+        self.waiting = None
+        if max_instructions is None:
+            # Every executed instruction is an icache hit or miss, so the
+            # unbounded loop doesn't need a counter of its own
+            before = self.icache_hits + self.icache_misses
+            while self.running:
+                self.execute_instr()
+            return self.uncount_parked(self.icache_hits + self.icache_misses - before)
+        executed = 0
+        while self.running and executed < max_instructions:
+            self.execute_instr()
+            executed += 1
+        return self.uncount_parked(executed)
 
-    # TODO sha_
+    def uncount_parked(self, executed: int) -> int:
+        # An 'INB' that parked the machine ended the run, it is executed again
+        # once input arrived and only counts then
+        return executed - 1 if self.waiting is not None else executed
 
-    def and_(self):
-        self.arithmetic(lambda a, b: a & b)
+    # region Debugging
+    def add_breakpoint(self, address: Address):
+        self.breakpoints.add(address)
 
-    def or_(self):
-        self.arithmetic(lambda a, b: a | b)
+    def remove_breakpoint(self, address: Address):
+        self.breakpoints.discard(address)
 
-    def xor_(self):
-        self.arithmetic(lambda a, b: a ^ b)
+    def watch(self, address: Address, read: bool = False, write: bool = True):
+        """Stops a run after the 'LDB' or 'STB' that accessed 'address'
 
-    def nor_(self):
-        self.arithmetic(lambda a, b: ~(a | b))
+        See Memory.watch for the accesses that are watched.
+        """
+        self.memory.watch(address, read, write)
 
-    ...
+    def unwatch(self, address: Address):
+        self.memory.unwatch(address)
 
-    def jmp_(self):
-        self.pc = self.decoded_args["val"]
+    def halt(self):
+        # Recorded for every run, so the debugger doesn't continue past 'HLT'
+        self.stop = Stop(StopReason.HALT, self.pc)
+        self.running = False
 
-    def jze_(self):
-        if self.is_flag_set(Flag.ZERO):
-            self.jmp_()
+    def watchpoint_hit(self, access: str, address: Address, byte: int):
+        self.stop = Stop(StopReason.WATCHPOINT, self.pc, (access, address, byte))
+        self.running = False
 
-    def jnz_(self):
-        if not self.is_flag_set(Flag.ZERO):
-            self.jmp_()
+    def step(self, count: int = 1) -> Stop:
+        """Executes 'count' instructions unless a breakpoint comes first"""
+        if not self.halted():
+            self.run_debug(count)
+        return self.stopped()
+
+    def continue_(self, max_instructions: int | None = None) -> Stop:
+        """Runs until a breakpoint, a watchpoint, 'HLT' or the budget ran out"""
+        if not self.halted():
+            self.run_debug(max_instructions)
+        return self.stopped()
+
+    def run_until(self, address: Address, max_instructions: int | None = None) -> Stop:
+        """Like continue_ with a temporary breakpoint at 'address'"""
+        if self.halted():
+            return self.stop
+        temporary = address not in self.breakpoints
+        self.breakpoints.add(address)
+        try:
+            self.run_debug(max_instructions)
+        finally:
+            if temporary:
+                self.breakpoints.discard(address)
+        return self.stopped()
+
+    def halted(self) -> bool:
+        # A halted program isn't continued past its 'HLT'
+        return self.stop is not None and self.stop.reason == StopReason.HALT
+
+    def stopped(self) -> Stop:
+        if self.stop is None:
+            if self.running:
+                reason = StopReason.LIMIT
+            elif self.waiting is not None:
+                reason = StopReason.INPUT
+            else:
+                reason = StopReason.HALT
+            self.stop = Stop(reason, self.pc)
+        return self.stop
 
     # endregion
 
-    def run(self):
+    def run_profiled(
+        self, profiler: Profiler, max_instructions: int | None = None
+    ) -> int:
+        # Separate loop so the other modes don't pay for the counters
+        budget = math.inf if max_instructions is None else max_instructions
+        data = self.memory.data
+        record = profiler.record
+        executed = 0
         self.running = True
-        while self.running:
+        self.waiting = None
+        while self.running and executed < budget:
+            pc = self.pc
+            opcode = (data[pc] >> 1) & 0b11111
             self.execute_instr()
+            if not self.running and self.waiting is not None:
+                # Parked at 'INB', recorded once it found input
+                break
+            record(pc, opcode, self.pc, self.pc != pc + 3)
+            executed += 1
+        profiler.instructions += executed
+        return executed
+
+    def run_traced(self, tracer: Tracer, max_instructions: int | None = None) -> int:
+        # Separate loop like run_profiled, the records are written straight
+        # into the tracer's arrays instead of calling a method per instruction
+        from .tracer import DEST_INSTRUCTIONS, NO_DEST
+
+        data = self.memory.data
+        regs = self.registers.registers
+        icache = self.icache
+        # Handlers that write their destination register, invalid instructions
+        # are decoded to 'skip_instr' and never match
+        writers = {self.dispatch[i] for i in DEST_INSTRUCTIONS}
+        pcs, ops, dests, results = tracer.pcs, tracer.ops, tracer.dests, tracer.results
+        capacity = tracer.capacity
+        lazy = self.lazy_flags
+        # The tracer counts the executed instructions
+        before = tracer.recorded
+        steps = (
+            repeat(None) if max_instructions is None else repeat(None, max_instructions)
+        )
+        i = tracer.position
+        self.running = True
+        self.waiting = None
+        try:
+            for _ in steps:
+                if not self.running:
+                    break
+                pc = self.pc
+                op = data[pc] >> 1
+                self.execute_instr()
+                if not self.running and self.waiting is not None:
+                    # Parked at 'INB', recorded once it found input
+                    break
+                entry = icache[pc]
+                pcs[i] = pc
+                ops[i] = op
+                if entry[0] in writers:
+                    d = entry[1]
+                    dests[i] = d
+                    results[i] = regs[d]
+                else:
+                    dests[i] = NO_DEST
+                    results[i] = self.flags if lazy else self.flag_state
+                i += 1
+                if i == capacity:
+                    tracer.position = i
+                    tracer.wrap()
+                    i = 0
+        finally:
+            tracer.position = i
+        return tracer.recorded - before
+
+    def run_debug(self, max_instructions: int | None = None) -> int:
+        # Separate loop so runs without breakpoints don't check the pc
+        budget = math.inf if max_instructions is None else max_instructions
+        breakpoints = self.breakpoints
+        # Resuming from a breakpoint executes the instruction it stopped at
+        stop = self.stop
+        resumed = (
+            stop is not None
+            and stop.reason in (StopReason.BREAKPOINT, StopReason.INPUT)
+            and stop.pc == self.pc
+        )
+        self.stop = None
+        executed = 0
+        self.running = True
+        self.waiting = None
+        while self.running and executed < budget:
+            if self.pc in breakpoints and not (resumed and executed == 0):
+                # Cleared like on 'HLT', so callers don't take the stop for a
+                # run that only ran out of budget
+                self.stop = Stop(StopReason.BREAKPOINT, self.pc)
+                self.running = False
+                break
+            self.execute_instr()
+            executed += 1
+        return self.uncount_parked(executed)
+
+    def run_blocks(self, max_instructions: int | None = None) -> int:
+        if self.jit is None:
+            from .jit import BlockTranslator
+
+            self.jit = BlockTranslator(self)
+        blocks = self.jit.blocks
+        lookup = self.jit.lookup
+        budget = math.inf if max_instructions is None else max_instructions
+        executed = 0
+        self.running = True
+        self.waiting = None
+        while self.running and executed < budget:
+            block = blocks.get(self.pc) or lookup(self.pc)
+            if block and block.length <= budget - executed:
+                block.run()
+                executed += block.length
+            else:
+                self.execute_instr()
+                executed += 1
+        return self.uncount_parked(executed)
 
     ...
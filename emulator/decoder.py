@@ -0,0 +1,142 @@
+from __future__ import annotations
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+import numpy as np
+
+from .cpu import OpCode
+from .dispatch import REGISTER_FIELDS
+
+if TYPE_CHECKING:
+    from .cpu import CPU
+
+IMMEDIATE_MASKS = np.array([0, 0xFF, 0xFFF, 0xFFFF], dtype=np.uint32)
+VALID_OPCODES = np.zeros(32, dtype=bool)
+VALID_OPCODES[[op.value for op in OpCode]] = True
+# Listed without operands when all operand bits are 0
+NO_OPERANDS = {OpCode.NOP.value, OpCode.HLT.value}
+
+
+@dataclass
+class DecodedImage:
+    """Fields of every 3-byte word of an image, one array per field
+
+    'd', 's' and 'x' are the operands the CPU hands to the instruction
+    handlers, the unused fields of a layout are 0 like in CPU.decode_instr.
+    """
+
+    base: int
+    words: np.ndarray
+    layout: np.ndarray
+    opcode: np.ndarray
+    d: np.ndarray
+    s: np.ndarray
+    x: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def addresses(self) -> np.ndarray:
+        return self.base + 3 * np.arange(len(self.words))
+
+    def valid(self, register_count: int) -> np.ndarray:
+        """Words with a known opcode whose register fields are in range"""
+        fields = np.array(REGISTER_FIELDS)[self.layout]
+        return (
+            VALID_OPCODES[self.opcode]
+            & ((fields < 1) | (self.d < register_count))
+            & ((fields < 2) | (self.s < register_count))
+            & ((fields < 3) | (self.x < register_count))
+        )
+
+
+def decode(image, base: int = 0) -> DecodedImage:
+    """Decodes all complete words of 'image' (bytes, bytearray or memoryview)"""
+    count = len(image) // 3
+    data = np.frombuffer(image, dtype=np.uint8, count=3 * count).reshape(count, 3)
+    words = data.astype(np.uint32)
+    words = words[:, 0] << 16 | words[:, 1] << 8 | words[:, 2]
+    index = (words >> 17) & 0x7F
+    layout = index >> 5
+    opcode = index & 0b11111
+    dest = (words >> 13) & 0xF
+    src1 = (words >> 9) & 0xF
+    src2 = (words >> 5) & 0xF
+    immediate = (words >> 1) & IMMEDIATE_MASKS[layout]
+    # Same fields as CPU.decode_L0 to decode_L3
+    d = np.where(layout < 3, dest, 0)
+    s = np.where(layout < 2, src1, 0)
+    x = np.where(layout == 0, src2, immediate)
+    return DecodedImage(base, words, layout, opcode, d, s, x)
+
+
+def disassemble(decoded: DecodedImage, collapse_zeros: bool = True) -> list[str]:
+    """One line per word: address, word and instruction
+
+    Runs of two or more zero words (NOP) are collapsed into a single line.
+    """
+    names = [OpCode(op).name if VALID_OPCODES[op] else f"?{op}" for op in range(32)]
+    zero = decoded.words == 0
+    # A zero word that follows another one is skipped
+    skip = np.zeros(len(decoded), dtype=bool)
+    if collapse_zeros and len(decoded):
+        skip[1:] = zero[1:] & zero[:-1]
+    lines = []
+    run = 0
+    for address, word, layout, opcode, d, s, x, skipped in zip(
+        decoded.addresses().tolist(),
+        decoded.words.tolist(),
+        decoded.layout.tolist(),
+        decoded.opcode.tolist(),
+        decoded.d.tolist(),
+        decoded.s.tolist(),
+        decoded.x.tolist(),
+        skip.tolist(),
+    ):
+        if skipped:
+            run += 1
+            continue
+        if run:
+            lines.append(f"*        {run} more zero words")
+            run = 0
+        name = names[opcode]
+        if opcode in NO_OPERANDS and word & 0x1FFFF == 0:
+            text = name
+        elif layout == 0:
+            text = f"{name} R{d}, R{s}, R{x}"
+        elif layout == 1:
+            text = f"{name} R{d}, R{s}, {x}"
+        elif layout == 2:
+            text = f"{name} R{d}, {x}"
+        else:
+            text = f"{name} {x}"
+        lines.append(f"0x{address:04x}  {word:06x}  {text}")
+    if run:
+        lines.append(f"*        {run} more zero words")
+    return lines
+
+
+def predecode(cpu: CPU, start: int = 0, end: int | None = None) -> int:
+    """Fills the CPU's icache for the words in memory[start:end]
+
+    Only words that would decode without an error are filled, the others are
+    still decoded (and reported) when they are executed. Returns the number
+    of filled entries.
+    """
+    memory = cpu.memory
+    end = memory.size if end is None else min(end, memory.size)
+    decoded = decode(memory.view[start:end], start)
+    valid = decoded.valid(cpu.registers.total_count)
+    index = decoded.layout << 5 | decoded.opcode
+    dispatch = cpu.dispatch
+    icache = cpu.icache
+    filled = 0
+    for address, i, d, s, x in zip(
+        decoded.addresses()[valid].tolist(),
+        index[valid].tolist(),
+        decoded.d[valid].tolist(),
+        decoded.s[valid].tolist(),
+        decoded.x[valid].tolist(),
+    ):
+        icache[address] = (dispatch[i], d, s, x)
+        filled += 1
+    return filled
@@ -0,0 +1,157 @@
+from __future__ import annotations
+import sys
+from collections import defaultdict, deque
+from typing import BinaryIO
+
+# Bytes a stream device reads at once
+READ_AHEAD = 1 << 16
+# Output collected before a stream device writes it
+FLUSH_SIZE = 1 << 16
+
+
+class Device:
+    """Something 'INB' reads from and 'OUTB' writes to
+
+    'read' returns the next input byte or None if there is none yet, the
+    machine then waits in front of its 'INB'. 'ended' is set once no more
+    input can arrive, a machine waiting for it never continues.
+    """
+
+    ended = False
+
+    def read(self) -> int | None:
+        return None
+
+    def write(self, byte: int):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class QueueDevice(Device):
+    """Input queued by 'feed', output collected in 'output'
+
+    Ports without a device get one of these.
+    """
+
+    def __init__(self):
+        self.input: deque[int] = deque()
+        self.output = bytearray()
+        # Bound directly, 'OUTB' is one call into bytearray.append
+        self.write = self.output.append
+
+    def feed(self, data: bytes):
+        self.input.extend(data)
+
+    def read(self) -> int | None:
+        return self.input.popleft() if self.input else None
+
+
+class StreamDevice(Device):
+    """Reads and writes binary files, in blocks
+
+    Input is read ahead up to READ_AHEAD bytes at a time, output is written
+    once FLUSH_SIZE bytes were collected, on 'flush' and before reading more
+    input (so a prompt is visible before the program waits for the answer).
+    Streams passed in stay open on 'close' unless 'owned'.
+    """
+
+    def __init__(
+        self,
+        input: BinaryIO | None = None,
+        output: BinaryIO | None = None,
+        owned: bool = False,
+    ):
+        self.input = input
+        self.output = output
+        self.owned = owned
+        self.buffer = b""
+        self.position = 0
+        self.pending = bytearray()
+
+    @classmethod
+    def open(cls, input: str | None = None, output: str | None = None):
+        """A device reading the file 'input' and writing the file 'output'"""
+        i = open(input, "rb") if input is not None else None
+        o = open(output, "wb") if output is not None else None
+        return cls(i, o, owned=True)
+
+    def read(self) -> int | None:
+        if self.position == len(self.buffer) and not self.read_ahead():
+            return None
+        byte = self.buffer[self.position]
+        self.position += 1
+        return byte
+
+    def read_ahead(self) -> bool:
+        if self.input is None:
+            self.ended = True
+            return False
+        self.flush()
+        # read1 returns what is available, e.g. a line typed into a terminal
+        read = getattr(self.input, "read1", self.input.read)
+        self.buffer = read(READ_AHEAD)
+        self.position = 0
+        # Nothing to read is the end of the stream
+        self.ended = len(self.buffer) == 0
+        return not self.ended
+
+    def write(self, byte: int):
+        self.pending.append(byte)
+        if len(self.pending) >= FLUSH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending and self.output is not None:
+            self.output.write(self.pending)
+            self.output.flush()
+        self.pending.clear()
+
+    def close(self):
+        self.flush()
+        if self.owned:
+            for stream in (self.input, self.output):
+                if stream is not None:
+                    stream.close()
+
+
+class ConsoleDevice(StreamDevice):
+    """Standard input and output"""
+
+    def __init__(self):
+        super().__init__(sys.stdin.buffer, sys.stdout.buffer)
+
+
+class DeviceBus:
+    """Devices of a CPU by port
+
+    A port without an attached device gets a QueueDevice when it is first
+    used. A device can be attached to several ports.
+    """
+
+    def __init__(self):
+        self.devices: defaultdict[int, Device] = defaultdict(QueueDevice)
+
+    def __getitem__(self, port: int) -> Device:
+        return self.devices[port]
+
+    def attach(self, port: int, device: Device):
+        self.devices[port] = device
+
+    def detach(self, port: int) -> Device | None:
+        return self.devices.pop(port, None)
+
+    def unique(self) -> list[Device]:
+        return list({id(d): d for d in self.devices.values()}.values())
+
+    def flush(self):
+        for device in self.unique():
+            device.flush()
+
+    def close(self):
+        for device in self.unique():
+            device.close()
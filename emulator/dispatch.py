@@ -0,0 +1,210 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Callable
+
+if TYPE_CHECKING:
+    from .cpu import CPU
+
+# Every handler takes the three decoded operand fields (d, s, x):
+# L0: dest, src1, src2    L1: dest, src1, val8
+# L2: dest, 0, val12      L3: 0, 0, val16
+# 'INB rd, port' and 'OUTB rs, port' use L2, the port is val12, as do
+# 'LDB rd, address' and 'STB rs, address'
+Handler = Callable[[int, int, int], None]
+# Number of leading (d, s, x) fields that hold a register index per layout
+REGISTER_FIELDS = (3, 2, 1, 0)
+
+
+def build_dispatch_table(cpu: CPU) -> list[Handler]:
+    """Builds the handler table indexed by 'layout << 5 | opcode' (instr >> 17)"""
+    from .cpu import OpCode, Flag, FLAGS
+
+    regs = cpu.registers.registers
+    memory = cpu.memory
+    devices = cpu.bus.devices
+    ZERO_SET = {flags for flags in FLAGS if flags & Flag.ZERO}
+    update = cpu.record_result if cpu.lazy_flags else cpu.update_flags
+
+    # region Control
+    def nop(d, s, x):
+        return
+
+    def hlt(d, s, x):
+        cpu.halt()
+
+    def jmp(d, s, x):
+        cpu.pc = x
+
+    def jze(d, s, x):
+        if cpu.flags in ZERO_SET:
+            cpu.pc = x
+
+    def jnz(d, s, x):
+        if cpu.flags not in ZERO_SET:
+            cpu.pc = x
+
+    # endregion
+    # region Register form (L0)
+    def add_rr(d, s, x):
+        v = regs[s] + regs[x]
+        update(v)
+        regs[d] = v & 0xFF
+
+    def addc_rr(d, s, x):
+        v = regs[s] + regs[x] + (1 if cpu.flags & Flag.CARRY else 0)
+        update(v)
+        regs[d] = v & 0xFF
+
+    def sub_rr(d, s, x):
+        v = regs[s] - regs[x]
+        update(v)
+        regs[d] = v & 0xFF
+
+    def subb_rr(d, s, x):
+        v = regs[s] - regs[x] - (1 if cpu.flags & Flag.SIGN else 0)
+        update(v)
+        regs[d] = v & 0xFF
+
+    def shl_rr(d, s, x):
+        v = regs[s] << regs[x]
+        update(v)
+        regs[d] = v & 0xFF
+
+    def shr_rr(d, s, x):
+        v = regs[s] >> regs[x]
+        update(v)
+        regs[d] = v & 0xFF
+
+    def and_rr(d, s, x):
+        v = regs[s] & regs[x]
+        update(v)
+        regs[d] = v
+
+    def or_rr(d, s, x):
+        v = regs[s] | regs[x]
+        update(v)
+        regs[d] = v
+
+    def xor_rr(d, s, x):
+        v = regs[s] ^ regs[x]
+        update(v)
+        regs[d] = v
+
+    def nor_rr(d, s, x):
+        v = ~(regs[s] | regs[x])
+        update(v)
+        regs[d] = v & 0xFF
+
+    # endregion
+    # region Immediate form (L1)
+    def add_ri(d, s, x):
+        v = regs[s] + x
+        update(v)
+        regs[d] = v & 0xFF
+
+    def addc_ri(d, s, x):
+        v = regs[s] + x + (1 if cpu.flags & Flag.CARRY else 0)
+        update(v)
+        regs[d] = v & 0xFF
+
+    def sub_ri(d, s, x):
+        v = regs[s] - x
+        update(v)
+        regs[d] = v & 0xFF
+
+    def subb_ri(d, s, x):
+        v = regs[s] - x - (1 if cpu.flags & Flag.SIGN else 0)
+        update(v)
+        regs[d] = v & 0xFF
+
+    def shl_ri(d, s, x):
+        v = regs[s] << x
+        update(v)
+        regs[d] = v & 0xFF
+
+    def shr_ri(d, s, x):
+        v = regs[s] >> x
+        update(v)
+        regs[d] = v & 0xFF
+
+    def and_ri(d, s, x):
+        v = regs[s] & x
+        update(v)
+        regs[d] = v
+
+    def or_ri(d, s, x):
+        v = regs[s] | x
+        update(v)
+        regs[d] = v
+
+    def xor_ri(d, s, x):
+        v = regs[s] ^ x
+        update(v)
+        regs[d] = v
+
+    def nor_ri(d, s, x):
+        v = ~(regs[s] | x)
+        update(v)
+        regs[d] = v & 0xFF
+
+    # endregion
+    # region Port I/O (L2)
+    def inb(d, s, x):
+        if (byte := devices[x].read()) is None:
+            # Executed again once input for the port arrived, see CPU.feed
+            cpu.waiting = x
+            cpu.running = False
+            cpu.pc -= 3
+            return
+        regs[d] = byte
+
+    def outb(d, s, x):
+        devices[x].write(regs[d])
+
+    # endregion
+    # region Memory (L2)
+    # Looked up on every access, Memory.watch replaces the accessors
+    def ldb(d, s, x):
+        regs[d] = memory.load_byte(x)
+
+    def stb(d, s, x):
+        memory.store_byte(x, regs[d])
+
+    # endregion
+
+    def not_implemented(opcode: int, layout: int) -> Handler:
+        def handler(d, s, x):
+            print(f"'{OpCode(opcode).name}' not implemented for layout L{layout}!")
+
+        return handler
+
+    table = [not_implemented(i & 0b11111, i >> 5) for i in range(128)]
+    for layout in range(4):
+        base = layout << 5
+        table[base | OpCode.NOP.value] = nop
+        table[base | OpCode.HLT.value] = hlt
+        if layout != 0:
+            table[base | OpCode.JMP.value] = jmp
+            table[base | OpCode.JZE.value] = jze
+            table[base | OpCode.JNZ.value] = jnz
+
+    table[2 << 5 | OpCode.INB.value] = inb
+    table[2 << 5 | OpCode.OUTB.value] = outb
+    table[2 << 5 | OpCode.LDB.value] = ldb
+    table[2 << 5 | OpCode.STB.value] = stb
+
+    arithmetic = {
+        OpCode.ADD: (add_rr, add_ri),
+        OpCode.ADDC: (addc_rr, addc_ri),
+        OpCode.SUB: (sub_rr, sub_ri),
+        OpCode.SUBB: (subb_rr, subb_ri),
+        OpCode.SHL: (shl_rr, shl_ri),
+        OpCode.SHR: (shr_rr, shr_ri),
+        OpCode.AND: (and_rr, and_ri),
+        OpCode.OR: (or_rr, or_ri),
+        OpCode.XOR: (xor_rr, xor_ri),
+        OpCode.NOR: (nor_rr, nor_ri),
+    }
+    for opcode, (rr, ri) in arithmetic.items():
+        table[opcode.value] = rr
+        table[1 << 5 | opcode.value] = ri
+    return table
@@ -0,0 +1,185 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Callable
+
+from .memory import Address
+from .dispatch import REGISTER_FIELDS
+
+if TYPE_CHECKING:
+    from .cpu import CPU
+
+MAX_BLOCK_LENGTH = 256
+PAGE_SHIFT = 8
+
+# Result expressions of the ALU opcodes, 'a' and 'b' are the operands and
+# 'c' is the carry/borrow-in read from the flags
+ALU_EXPRESSIONS = {
+    1: "{a} + {b}",  # ADD
+    2: "{a} + {b} + {c}",  # ADDC
+    3: "{a} - {b}",  # SUB
+    4: "{a} - {b} - {c}",  # SUBB
+    5: "{a} << {b}",  # SHL
+    6: "{a} >> {b}",  # SHR
+    8: "{a} & {b}",  # AND
+    9: "{a} | {b}",  # OR
+    10: "{a} ^ {b}",  # XOR
+    11: "~({a} | {b})",  # NOR
+}
+# Results that always fit into a byte don't need to be masked
+UNMASKED = {8, 9, 10}
+
+NOP, ADDC, SUBB, OUTB, JMP, JZE, JNZ, HLT = 0, 2, 4, 14, 17, 18, 19, 31
+BRANCHES = {JMP, JZE, JNZ, HLT}
+
+
+class Block:
+    __slots__ = ("run", "start", "end", "length", "source")
+
+    def __init__(self, run: Callable[[], None], start, end, length, source):
+        self.run = run
+        self.start = start
+        self.end = end
+        self.length = length
+        self.source = source
+
+
+class BlockTranslator:
+    """Translates straight-line runs of instructions into compiled Python functions"""
+
+    def __init__(self, cpu: CPU):
+        from .cpu import FLAGS
+
+        self.cpu = cpu
+        self.memory = cpu.memory
+        self.flag_table = FLAGS
+        self.register_count = cpu.registers.total_count
+        self.blocks: dict[Address, Block] = {}
+        self.pages: dict[int, set[Address]] = {}
+        self.translations = 0
+        self.invalidations = 0
+        self.memory.add_write_listener(self.invalidate)
+
+    def lookup(self, pc: Address) -> Block | None:
+        if (block := self.blocks.get(pc)) is None:
+            block = self.translate(pc)
+        return block
+
+    def fetch_word(self, pc: Address) -> int:
+        # Instruction fetches don't go through load_byte, see Memory.watch
+        data = self.memory.data
+        return data[pc] << 16 | data[pc + 1] << 8 | data[pc + 2]
+
+    def translate(self, start: Address) -> Block | None:
+        body: list[str] = []
+        loaded: set[int] = set()
+        written: set[int] = set()
+        flags_written = False
+        pc = start
+        length = 0
+        exit_code = None
+
+        def read(reg: int) -> str:
+            if reg not in loaded and reg not in written:
+                loaded.add(reg)
+            return f"r{reg}"
+
+        def flag(bit: int) -> str:
+            if flags_written:
+                return {
+                    1: "(v > 0xFF)",
+                    2: "((v & 0x80) != 0)",
+                    4: "(v == 0)",
+                }[bit]
+            return f"(1 if cpu.flags & {bit} else 0)"
+
+        while length < MAX_BLOCK_LENGTH and pc + 3 <= self.memory.size:
+            word = self.fetch_word(pc)
+            index = (word >> 17) & 0x7F
+            layout, opcode = index >> 5, index & 0b11111
+            d, s = (word >> 13) & 0xF, (word >> 9) & 0xF
+            fields = (d, s, (word >> 5) & 0xF)[: REGISTER_FIELDS[layout]]
+            if any(reg >= self.register_count for reg in fields):
+                # Let the interpreter report the invalid register
+                break
+            if opcode in ALU_EXPRESSIONS and layout < 2:
+                a = read(s)
+                if layout == 0:
+                    b = read((word >> 5) & 0xF)
+                else:
+                    b = str((word >> 1) & 0xFF)
+                c = flag(1) if opcode == ADDC else flag(2) if opcode == SUBB else ""
+                body.append("v = " + ALU_EXPRESSIONS[opcode].format(a=a, b=b, c=c))
+                if opcode in UNMASKED:
+                    body.append(f"r{d} = v")
+                else:
+                    body.append(f"r{d} = v & 0xFF")
+                written.add(d)
+                flags_written = True
+            elif opcode == NOP:
+                pass
+            elif opcode == OUTB and layout == 2:
+                # 'D' are the devices by port, INB is left to the interpreter
+                # as it may have to wait for input, LDB and STB as they may
+                # hit a watchpoint
+                body.append(f"D[{(word >> 1) & 0xFFF}].write({read(d)})")
+            elif opcode in BRANCHES and (layout != 0 or opcode == HLT):
+                length += 1
+                pc += 3
+                target = (word >> 1) & (0xFF, 0xFF, 0xFFF, 0xFFFF)[layout]
+                if opcode == HLT:
+                    exit_code = [f"cpu.pc = {pc}", "cpu.halt()"]
+                elif opcode == JMP:
+                    exit_code = [f"cpu.pc = {target}"]
+                else:
+                    taken = flag(4) if opcode == JZE else f"not {flag(4)}"
+                    exit_code = [f"cpu.pc = {target} if {taken} else {pc}"]
+                break
+            else:
+                # Everything else is left to the interpreter
+                break
+            length += 1
+            pc += 3
+
+        if length == 0:
+            return None
+        if exit_code is None:
+            exit_code = [f"cpu.pc = {pc}"]
+        prologue = [f"r{reg} = R[{reg}]" for reg in sorted(loaded)]
+        epilogue = [f"R[{reg}] = r{reg}" for reg in sorted(written)]
+        if flags_written and self.cpu.lazy_flags:
+            epilogue.append("cpu.flag_result = v")
+        elif flags_written:
+            epilogue.append(
+                "cpu.flags = FLAGS[(v == 0) << 2 | ((v & 0x80) != 0) << 1 | (v > 0xFF)]"
+            )
+        lines = prologue + body + epilogue + exit_code
+        source = "def make(cpu, R, FLAGS, D):\n    def block():\n"
+        source += "".join(f"        {line}\n" for line in lines)
+        source += "    return block\n"
+
+        namespace = {}
+        exec(compile(source, f"<block 0x{start:04x}>", "exec"), namespace)
+        run = namespace["make"](
+            self.cpu,
+            self.cpu.registers.registers,
+            self.flag_table,
+            self.cpu.bus.devices,
+        )
+        block = Block(run, start, pc, length, source)
+        self.blocks[start] = block
+        for page in range(start >> PAGE_SHIFT, ((pc - 1) >> PAGE_SHIFT) + 1):
+            self.pages.setdefault(page, set()).add(start)
+        self.translations += 1
+        return block
+
+    def invalidate(self, start: Address, end: Address):
+        for page in range(start >> PAGE_SHIFT, ((end - 1) >> PAGE_SHIFT) + 1):
+            for block_start in list(self.pages.get(page, ())):
+                block = self.blocks.get(block_start)
+                if block is None or block.end <= start or block.start >= end:
+                    continue
+                del self.blocks[block_start]
+                for p in range(
+                    block.start >> PAGE_SHIFT, ((block.end - 1) >> PAGE_SHIFT) + 1
+                ):
+                    self.pages[p].discard(block_start)
+                self.invalidations += 1
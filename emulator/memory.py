@@ -1,11 +1,63 @@
+import mmap
+import os
+from dataclasses import dataclass
+from typing import Callable
+
 Address = int
 Byte = int
 
+PAGE_SHIFT = 8
+PAGE_SIZE = 1 << PAGE_SHIFT
+
+
+@dataclass
+class MemorySnapshot:
+    # Immutable page contents, pages that didn't change between two snapshots
+    # are the same objects
+    pages: tuple[bytes, ...]
+
 
 class Memory:
-    def __init__(self, size: int):
-        self.data = [0 for _ in range(size)]
+    def __init__(self, size: int, data: bytearray | None = None):
+        """'data', e.g. an assembled program, becomes the memory without a copy
+
+        It is grown to 'size' in place.
+        """
+        length = 0
+        if data is None:
+            data = bytearray(size)
+        elif (length := len(data)) > size:
+            raise ValueError(f"{length} bytes don't fit into {size} bytes of memory")
+        else:
+            data += bytes(size - length)
+        self.data = data
+        # Shared view of the backing buffer, slices of it don't copy
+        self.view = memoryview(self.data)
         self.size = size
+        self.write_listeners: list[Callable[[Address, Address], None]] = []
+        # Page contents as of the last snapshot/restore and the pages written since
+        self.pages = [
+            bytes(min(PAGE_SIZE, size - f)) for f in range(0, size, PAGE_SIZE)
+        ]
+        self.dirty_pages: set[int] = set()
+        # Watched addresses, see 'watch'
+        self.read_watches: set[Address] = set()
+        self.write_watches: set[Address] = set()
+        self.watch_listeners: list[Callable[[str, Address, Byte], None]] = []
+        if length:
+            self.notify_write(0, length)
+
+    def add_write_listener(self, listener: Callable[[Address, Address], None]):
+        self.write_listeners.append(listener)
+
+    def notify_write(self, start: Address, end: Address):
+        """Must be called by everything that writes to 'data' or 'view' directly"""
+        if start < end:
+            self.dirty_pages.update(
+                range(start >> PAGE_SHIFT, ((end - 1) >> PAGE_SHIFT) + 1)
+            )
+        for listener in self.write_listeners:
+            listener(start, end)
 
     def check_index(self, index: Address):
         if index < 0 and index >= self.size:
@@ -21,14 +73,99 @@ class Memory:
     def store_byte(self, index: Address, byte: Byte):
         if self.check_index(index):
             self.data[index] = byte & 0xFF
+            self.notify_write(index, index + 1)
+
+    # region Watchpoints
+    def watch(self, address: Address, read: bool = False, write: bool = True):
+        """Reports accesses to 'address' to the watch listeners
+
+        Only accesses through load_byte and store_byte, which 'LDB' and 'STB'
+        use, are watched. Instruction fetches and direct writes to 'data' are
+        not. The watched accessors replace them on this instance while any
+        address is watched, so memory without watchpoints doesn't pay for them.
+        """
+        if read:
+            self.read_watches.add(address)
+        if write:
+            self.write_watches.add(address)
+        self.install_accessors()
+
+    def unwatch(self, address: Address):
+        self.read_watches.discard(address)
+        self.write_watches.discard(address)
+        self.install_accessors()
 
-    def load_from_file(self, path: str):
+    def add_watch_listener(self, listener: Callable[[str, Address, Byte], None]):
+        """'listener' is called with 'read' or 'write', the address and the byte"""
+        self.watch_listeners.append(listener)
+
+    def install_accessors(self):
+        if self.read_watches:
+            self.load_byte = self.load_byte_watched
+        else:
+            self.__dict__.pop("load_byte", None)
+        if self.write_watches:
+            self.store_byte = self.store_byte_watched
+        else:
+            self.__dict__.pop("store_byte", None)
+
+    def load_byte_watched(self, index: Address) -> Byte:
+        byte = Memory.load_byte(self, index)
+        if index in self.read_watches:
+            for listener in self.watch_listeners:
+                listener("read", index, byte)
+        return byte
+
+    def store_byte_watched(self, index: Address, byte: Byte):
+        Memory.store_byte(self, index, byte)
+        if index in self.write_watches:
+            for listener in self.watch_listeners:
+                listener("write", index, byte & 0xFF)
+
+    # endregion
+
+    def load_from_file(self, path: str, use_mmap: bool = False):
         with open(path, "rb") as f:
-            buffer = f.read()
-        for i, byte in enumerate(buffer):
-            self.data[i] = byte
+            if use_mmap and os.fstat(f.fileno()).st_size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    length = min(len(mm), self.size)
+                    with memoryview(mm) as source:
+                        self.view[:length] = source[:length]
+            else:
+                length = f.readinto(self.view)
+        self.notify_write(0, length)
+
+    # region Snapshots
+    def snapshot(self) -> MemorySnapshot:
+        for page in self.dirty_pages:
+            f = page << PAGE_SHIFT
+            self.pages[page] = bytes(self.view[f : f + PAGE_SIZE])
+        self.dirty_pages.clear()
+        return MemorySnapshot(tuple(self.pages))
+
+    def restore(self, snapshot: MemorySnapshot):
+        """Copies back only the pages that differ from the snapshot"""
+        changed = [
+            page
+            for page, content in enumerate(snapshot.pages)
+            if page in self.dirty_pages or self.pages[page] is not content
+        ]
+        for page in changed:
+            f = page << PAGE_SHIFT
+            content = snapshot.pages[page]
+            self.view[f : f + len(content)] = content
+            self.notify_write(f, f + len(content))
+        self.pages = list(snapshot.pages)
+        self.dirty_pages.clear()
+
+    # endregion
+
+    def dump_to_file(self, path: str, f: int = 0, t: int | None = None):
+        with open(path, "wb") as file:
+            file.write(self.view[f:t])
 
     def print_bytes(self, f: int, t: int):
-        for i in range(f, t):
-            print(f"{self.data[i]:0>2x}|", end="")
-        print()
+        if f < t:
+            print(self.view[f:t].hex("|") + "|")
+        else:
+            print()
@@ -0,0 +1,130 @@
+from __future__ import annotations
+import json
+from array import array
+
+from .cpu import OpCode
+from .memory import Address
+
+JUMPS = {OpCode.JMP.value, OpCode.JZE.value, OpCode.JNZ.value}
+CONDITIONAL_JUMPS = {OpCode.JZE.value, OpCode.JNZ.value}
+
+
+def counters(size: int) -> array:
+    return array("Q", bytes(8 * size))
+
+
+class Profiler:
+    """Execution counters filled by 'CPU.run_profiled'
+
+    'line_map' maps instruction addresses to source lines (see
+    'Compiler.line_map'), 'source' holds the lines of the assembled file.
+    """
+
+    def __init__(
+        self,
+        memory_size: int,
+        line_map: dict[Address, int] | None = None,
+        source: list[str] | None = None,
+    ):
+        self.instructions = 0
+        self.pc_counts = counters(memory_size)
+        self.opcode_counts = counters(32)
+        self.taken = counters(memory_size)
+        self.not_taken = counters(memory_size)
+        # Taken backward jumps by target, that is iterations of the loop at target
+        self.loop_iterations = counters(memory_size)
+        self.loop_ends: dict[Address, Address] = {}
+        self.line_map = line_map or {}
+        self.source = source or []
+
+    def record(self, pc: Address, opcode: int, next_pc: Address, taken: bool):
+        self.pc_counts[pc] += 1
+        self.opcode_counts[opcode] += 1
+        if opcode in JUMPS:
+            if opcode in CONDITIONAL_JUMPS:
+                if taken:
+                    self.taken[pc] += 1
+                else:
+                    self.not_taken[pc] += 1
+            if taken and next_pc <= pc:
+                self.loop_iterations[next_pc] += 1
+                self.loop_ends[next_pc] = max(self.loop_ends.get(next_pc, 0), pc)
+
+    # region Results
+    def line(self, pc: Address) -> str:
+        if (line := self.line_map.get(pc)) is None:
+            return ""
+        if 0 < line <= len(self.source):
+            return f"line {line}: {self.source[line - 1].strip()}"
+        return f"line {line}"
+
+    def nonzero(self, counts: array) -> list[int]:
+        return [pc for pc, count in enumerate(counts) if count]
+
+    def hot_spots(self, top: int) -> list[tuple[Address, int]]:
+        spots = [(pc, self.pc_counts[pc]) for pc in self.nonzero(self.pc_counts)]
+        return sorted(spots, key=lambda s: s[1], reverse=True)[:top]
+
+    def branches(self) -> list[tuple[Address, int, int]]:
+        pcs = sorted(set(self.nonzero(self.taken)) | set(self.nonzero(self.not_taken)))
+        return [(pc, self.taken[pc], self.not_taken[pc]) for pc in pcs]
+
+    def hot_loops(self) -> list[tuple[Address, Address, int]]:
+        loops = [
+            (start, self.loop_ends[start], self.loop_iterations[start])
+            for start in self.nonzero(self.loop_iterations)
+        ]
+        return sorted(loops, key=lambda l: l[2], reverse=True)
+
+    def report(self, top: int = 10) -> str:
+        lines = [f"Executed {self.instructions} instructions", "", "Opcodes:"]
+        total = max(self.instructions, 1)
+        for opcode in sorted(
+            self.nonzero(self.opcode_counts), key=lambda o: -self.opcode_counts[o]
+        ):
+            count = self.opcode_counts[opcode]
+            lines.append(
+                f"  {OpCode(opcode).name:<5} {count:>12} {100 * count / total:6.2f}%"
+            )
+        lines += ["", f"Hot spots (top {top}):"]
+        for pc, count in self.hot_spots(top):
+            lines.append(f"  0x{pc:04x} {count:>12}  {self.line(pc)}")
+        lines += ["", "Branches (taken / not taken):"]
+        for pc, taken, not_taken in self.branches():
+            lines.append(f"  0x{pc:04x} {taken:>12} {not_taken:>12}  {self.line(pc)}")
+        lines += ["", "Hot loops (iterations):"]
+        for start, end, iterations in self.hot_loops():
+            lines.append(
+                f"  0x{start:04x}-0x{end:04x} {iterations:>12}  {self.line(start)}"
+            )
+        return "\n".join(lines)
+
+    def to_dict(self) -> dict:
+        def line(pc):
+            return self.line_map.get(pc)
+
+        return {
+            "instructions": self.instructions,
+            "opcodes": {
+                OpCode(o).name: self.opcode_counts[o]
+                for o in self.nonzero(self.opcode_counts)
+            },
+            "pcs": [
+                {"pc": pc, "count": self.pc_counts[pc], "line": line(pc)}
+                for pc in self.nonzero(self.pc_counts)
+            ],
+            "branches": [
+                {"pc": pc, "taken": t, "not_taken": n, "line": line(pc)}
+                for pc, t, n in self.branches()
+            ],
+            "loops": [
+                {"start": s, "end": e, "iterations": i, "line": line(s)}
+                for s, e, i in self.hot_loops()
+            ],
+        }
+
+    def save(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    # endregion
@@ -1,14 +1,23 @@
+import struct
+
 Byte = int
 Long = int
 
+HALFWORD = struct.Struct(">H")
+
 
 class RegisterFile:
     def __init__(self, reg_count: int, ireg_count: int):
         self.reg_count = reg_count
         self.ireg_count = ireg_count
         self.total_count = reg_count + 2 * ireg_count
-        self.registers = [0 for _ in range(self.total_count)]
+        self.registers = bytearray(self.total_count)
+        self.view = memoryview(self.registers)
+        # Byte offsets of the big-endian 16-bit register pairs
+        self.i_offsets = [reg_count + 2 * i for i in range(ireg_count)]
 
+    # Indices are validated once when an instruction is decoded, the accessors
+    # below don't check them again
     def check_r_index(self, index: int) -> bool:
         if index >= self.total_count:
             print(f"Index out of range! {index} >= {self.total_count}")
@@ -22,22 +31,20 @@ class RegisterFile:
         return True
 
     def get_register(self, index: int) -> Byte:
-        if not self.check_r_index(index):
-            return 0
         return self.registers[index]
 
     def get_iregister(self, index: int) -> Long:
-        if not self.check_i_index(index):
-            return 0
-        p1 = self.registers[self.reg_count + index * 2] << 8
-        p2 = self.registers[self.reg_count + index * 2 + 1]
-        return p1 | p2
+        return HALFWORD.unpack_from(self.registers, self.i_offsets[index])[0]
 
     def set_register(self, index: int, byte: Byte):
-        if self.check_r_index(index):
-            self.registers[index] = byte & 0xFF
+        self.registers[index] = byte & 0xFF
 
     def set_iregister(self, index: int, value: Long):
-        if self.check_i_index(index):
-            self.registers[self.reg_count + index * 2] = (value >> 8) & 0xFF
-            self.registers[self.reg_count + index * 2 + 1] = value & 0xFF
+        HALFWORD.pack_into(self.registers, self.i_offsets[index], value & 0xFFFF)
+
+    def snapshot(self) -> bytes:
+        return bytes(self.registers)
+
+    def restore(self, snapshot: bytes):
+        # In place, so views and cached references to the buffer stay valid
+        self.registers[:] = snapshot
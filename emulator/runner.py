@@ -0,0 +1,63 @@
+import time
+from typing import Sequence
+
+from .cpu import CPU
+from .memory import Memory
+from .register_file import RegisterFile
+
+# Instructions executed between two checks of the wall-clock timeout
+SLICE_SIZE = 50_000
+
+
+def run_binary(
+    path: str,
+    max_instructions: int | None = None,
+    timeout: float | None = None,
+    memory_ranges: Sequence[tuple[int, int]] = (),
+    jit: bool = False,
+    lazy_flags: bool = False,
+) -> dict:
+    """Runs a single binary on a fresh machine and returns its final state
+
+    Meant to be submitted to a process pool, so it only takes and returns
+    plain picklable values. 'status' is 'halted', 'waiting' ('INB' without
+    input), 'budget' (instruction budget exhausted), 'timeout' or 'error'.
+    """
+    start = time.perf_counter()
+    m = Memory(2**16)
+    r = RegisterFile(10, 3)
+    c = CPU(m, r, lazy_flags=lazy_flags)
+    executed = 0
+    status = "halted"
+    error = None
+    try:
+        m.load_from_file(path)
+        while True:
+            budget = SLICE_SIZE
+            if max_instructions is not None:
+                budget = min(budget, max_instructions - executed)
+                if budget <= 0:
+                    status = "budget"
+                    break
+            executed += c.run(jit=jit, max_instructions=budget)
+            if not c.running:
+                if c.waiting is not None:
+                    status = "waiting"
+                break
+            if timeout is not None and time.perf_counter() - start > timeout:
+                status = "timeout"
+                break
+    except Exception as e:
+        status = "error"
+        error = f"{type(e).__name__}: {e}"
+    return {
+        "path": path,
+        "status": status,
+        "error": error,
+        "registers": list(r.registers),
+        "flags": int(c.flags),
+        "pc": c.pc,
+        "instructions": executed,
+        "time": time.perf_counter() - start,
+        "memory": {f"{f}:{t}": m.view[f:t].hex() for f, t in memory_ranges},
+    }
@@ -0,0 +1,157 @@
+from __future__ import annotations
+import time
+from collections import deque
+from dataclasses import dataclass
+
+from .cpu import CPU, StopReason
+
+# Instructions a machine may run per turn
+DEFAULT_QUANTUM = 10_000
+# Stops that end a machine's turns until 'resume'
+DEBUG_STOPS = (StopReason.BREAKPOINT, StopReason.WATCHPOINT)
+
+
+@dataclass(eq=False)
+class Task:
+    """A machine run by the Scheduler and what it used so far"""
+
+    cpu: CPU
+    name: str
+    # Instruction budget of the whole run, None runs until 'HLT'
+    max_instructions: int | None = None
+    # Executed instructions, an 'INB' that parked the machine counts once it
+    # found input
+    cycles: int = 0
+    # Turns the machine got and the time it ran in them
+    slices: int = 0
+    time: float = 0.0
+    # 'ready', 'waiting' ('INB' without input), 'ended' ('INB' after the end of
+    # its input stream), 'stopped' (breakpoint or watchpoint, see resume),
+    # 'halted', 'budget' or 'error'
+    status: str = "ready"
+    error: str | None = None
+
+
+class Scheduler:
+    """Time slices many machines in one thread, round-robin
+
+    Every ready machine runs up to 'quantum' instructions per turn, in the
+    order they became ready. A machine whose 'INB' found no input is parked
+    and doesn't get turns until 'feed' provides input for its port. Stream
+    devices block while they read ahead, so machines run here should read
+    from queue devices.
+    """
+
+    def __init__(self, quantum: int = DEFAULT_QUANTUM, jit: bool = False):
+        if quantum < 1:
+            raise ValueError("The quantum must be at least one instruction")
+        self.quantum = quantum
+        self.jit = jit
+        self.tasks: list[Task] = []
+        self.ready: deque[Task] = deque()
+        self.parked: set[Task] = set()
+        # Set by 'feed' while run_async waits for input, see there
+        self.wakeup = None
+
+    def add(
+        self, cpu: CPU, name: str | None = None, max_instructions: int | None = None
+    ) -> Task:
+        task = Task(cpu, name or f"cpu{len(self.tasks)}", max_instructions)
+        self.tasks.append(task)
+        self.ready.append(task)
+        return task
+
+    def feed(self, task: Task, port: int, data: bytes):
+        """Queues input for the machine and unparks it if it waited for it"""
+        task.cpu.feed(port, data)
+        if task in self.parked and task.cpu.waiting is None:
+            self.parked.discard(task)
+            task.status = "ready"
+            self.ready.append(task)
+            if self.wakeup is not None:
+                self.wakeup.set()
+
+    def resume(self, task: Task):
+        """Gives a machine stopped by a breakpoint or watchpoint turns again"""
+        if task.status == "stopped":
+            task.status = "ready"
+            self.ready.append(task)
+
+    def run_slice(self, task: Task) -> int:
+        """Gives 'task' one turn, returns the number of executed instructions"""
+        budget = self.quantum
+        if task.max_instructions is not None:
+            budget = min(budget, task.max_instructions - task.cycles)
+        cpu = task.cpu
+        start = time.perf_counter()
+        try:
+            executed = cpu.run(jit=self.jit, max_instructions=budget)
+        except Exception as e:
+            task.status = "error"
+            task.error = f"{type(e).__name__}: {e}"
+            return 0
+        finally:
+            task.slices += 1
+            task.time += time.perf_counter() - start
+        task.cycles += executed
+        if cpu.running:
+            if task.cycles == task.max_instructions:
+                task.status = "budget"
+            else:
+                self.ready.append(task)
+        elif cpu.stop is not None and cpu.stop.reason in DEBUG_STOPS:
+            task.status = "stopped"
+        elif cpu.waiting is not None and cpu.bus[cpu.waiting].ended:
+            # Can't be fed, parking it would keep run_async waiting forever
+            task.status = "ended"
+        elif cpu.waiting is not None:
+            task.status = "waiting"
+            self.parked.add(task)
+        else:
+            task.status = "halted"
+        if not cpu.running:
+            # Output of a machine that waits or halted is written out
+            cpu.bus.flush()
+        return executed
+
+    def run_round(self) -> int:
+        """One turn for every machine that is ready when the round starts"""
+        executed = 0
+        for _ in range(len(self.ready)):
+            executed += self.run_slice(self.ready.popleft())
+        return executed
+
+    def run(self, max_rounds: int | None = None) -> int:
+        """Runs rounds until no machine is ready, parked ones may remain
+
+        Returns the number of executed instructions.
+        """
+        executed = 0
+        rounds = 0
+        while self.ready and (max_rounds is None or rounds < max_rounds):
+            executed += self.run_round()
+            rounds += 1
+        return executed
+
+    async def run_async(self) -> int:
+        """Like run, but waits for 'feed' while all remaining machines are parked
+
+        Yields to the event loop after every round, so other tasks can feed
+        input. Returns once every machine halted, ran out of budget or input
+        or failed.
+        """
+        import asyncio
+
+        self.wakeup = asyncio.Event()
+        executed = 0
+        try:
+            while self.ready or self.parked:
+                if not self.ready:
+                    self.wakeup.clear()
+                    await self.wakeup.wait()
+                    continue
+                executed += self.run_round()
+                await asyncio.sleep(0)
+        finally:
+            self.wakeup = None
+        return executed
@@ -0,0 +1,200 @@
+from __future__ import annotations
+import mmap
+import struct
+import sys
+from array import array
+from bisect import bisect_right
+from typing import Iterator
+
+from .cpu import OpCode
+from .memory import Address
+
+# File layout, all numbers little endian:
+#   header: MAGIC, format version (u16), index of the first record (u64)
+#   chunks: record count (u32), then the fields of the records column by column:
+#           pc (u32 each), instruction index (u8), destination (u8), result (u8)
+MAGIC = b"STPTRACE"
+VERSION = 1
+HEADER = struct.Struct("<8sHQ")
+CHUNK = struct.Struct("<I")
+# Bytes of one record in a chunk
+RECORD_SIZE = 7
+
+# Records kept in memory before they are written out
+DEFAULT_CAPACITY = 1 << 16
+# 'dest' of instructions that don't write a register, their result are the flags
+NO_DEST = 0xFF
+# Instructions (layout << 5 | opcode) whose result is the new value of their
+# destination register
+DEST_INSTRUCTIONS = [
+    layout << 5 | opcode
+    for layout in (0, 1)
+    for opcode in range(OpCode.ADD.value, OpCode.NOR.value + 1)
+] + [2 << 5 | OpCode.INB.value, 2 << 5 | OpCode.LDB.value]
+FLAG_NAMES = (("Z", 0b100), ("S", 0b010), ("C", 0b001))
+# Traced runs may take at most this many times as long as untraced ones
+# (checked by the benchmarks)
+TRACE_OVERHEAD_LIMIT = 2.5
+
+
+def little_endian(a: array) -> array:
+    if sys.byteorder == "big":
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a
+
+
+class Tracer:
+    """Records pc, instruction, destination and result of executed instructions
+
+    The records live in preallocated arrays, one per field, used as ring
+    buffer of 'capacity' records. 'CPU.run_traced' writes into the arrays
+    directly and calls 'wrap' when they are full. With 'keep_all' a full
+    buffer is written to 'path' as one chunk, otherwise the oldest records
+    are overwritten and only the last 'capacity' records are written by
+    'close'.
+    """
+
+    def __init__(
+        self, path: str, capacity: int = DEFAULT_CAPACITY, keep_all: bool = True
+    ):
+        if capacity < 1:
+            raise ValueError("A trace needs room for at least one record")
+        self.path = path
+        self.capacity = capacity
+        self.keep_all = keep_all
+        self.pcs = array("I", bytes(4 * capacity))
+        self.ops = bytearray(capacity)
+        self.dests = bytearray(capacity)
+        self.results = bytearray(capacity)
+        # Next slot to fill
+        self.position = 0
+        # Records that left the buffer, written out or overwritten
+        self.dropped = 0
+        self.wrapped = False
+        self.file = None
+        if keep_all:
+            self.file = open(path, "wb")
+            self.file.write(HEADER.pack(MAGIC, VERSION, 0))
+
+    @property
+    def recorded(self) -> int:
+        return self.dropped + self.position
+
+    def wrap(self):
+        """Called when the buffer is full, writes it out or starts overwriting"""
+        if self.keep_all:
+            self.write_chunk(0, self.capacity)
+        self.wrapped = True
+        self.dropped += self.capacity
+        self.position = 0
+
+    def write_chunk(self, start: int, end: int):
+        if start == end:
+            return
+        self.file.write(CHUNK.pack(end - start))
+        self.file.write(little_endian(self.pcs[start:end]))
+        self.file.write(memoryview(self.ops)[start:end])
+        self.file.write(memoryview(self.dests)[start:end])
+        self.file.write(memoryview(self.results)[start:end])
+
+    def close(self):
+        """Writes the records still in the buffer"""
+        if self.keep_all:
+            self.write_chunk(0, self.position)
+        else:
+            self.file = open(self.path, "wb")
+            kept = self.capacity if self.wrapped else self.position
+            self.file.write(HEADER.pack(MAGIC, VERSION, self.recorded - kept))
+            # Oldest records first
+            if self.wrapped:
+                self.write_chunk(self.position, self.capacity)
+            self.write_chunk(0, self.position)
+        self.file.close()
+
+
+class TraceFile:
+    """Records of a trace file, decoded when they are accessed
+
+    The file is mapped, opening it only reads the chunk headers.
+    """
+
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise ValueError(f"'{path}' is not a trace file") from None
+        if len(self.map) < HEADER.size or HEADER.unpack_from(self.map)[:2] != (
+            MAGIC,
+            VERSION,
+        ):
+            self.close()
+            raise ValueError(f"'{path}' is not a trace file")
+        # Instructions executed before the first record, see 'Tracer.keep_all'
+        self.first = HEADER.unpack_from(self.map)[2]
+        # Offset of the first pc and record count of every chunk
+        self.chunks: list[tuple[int, int]] = []
+        # Index of the first record of every chunk
+        self.starts: list[int] = []
+        self.count = 0
+        offset = HEADER.size
+        while offset + CHUNK.size <= len(self.map):
+            (count,) = CHUNK.unpack_from(self.map, offset)
+            offset += CHUNK.size
+            # A chunk cut short by a crashed run is ignored
+            if offset + count * RECORD_SIZE > len(self.map):
+                break
+            self.chunks.append((offset, count))
+            self.starts.append(self.count)
+            self.count += count
+            offset += count * RECORD_SIZE
+
+    def __len__(self) -> int:
+        return self.count
+
+    def records(
+        self, start: int = 0, stop: int | None = None
+    ) -> Iterator[tuple[int, Address, int, int, int]]:
+        """Yields (index, pc, op, dest, result) of the records [start:stop]
+
+        'index' counts the executed instructions, it starts at 'first'.
+        """
+        stop = self.count if stop is None else min(stop, self.count)
+        start = max(start, 0)
+        chunk = bisect_right(self.starts, start) - 1
+        while start < stop:
+            offset, count = self.chunks[chunk]
+            first = start - self.starts[chunk]
+            last = min(count, stop - self.starts[chunk])
+            pcs = array("I")
+            pcs.frombytes(self.map[offset + 4 * first : offset + 4 * last])
+            pcs = little_endian(pcs)
+            fields = offset + 4 * count
+            ops = self.map[fields + first : fields + last]
+            fields += count
+            dests = self.map[fields + first : fields + last]
+            fields += count
+            results = self.map[fields + first : fields + last]
+            indices = range(self.first + start, self.first + stop)
+            yield from zip(indices, pcs, ops, dests, results)
+            start += last - first
+            chunk += 1
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+def describe(pc: Address, op: int, dest: int, result: int) -> str:
+    """One line of 'main.py trace'"""
+    opcode = op & 0b11111
+    try:
+        name = OpCode(opcode).name
+    except ValueError:
+        name = f"?{opcode}"
+    if dest == NO_DEST:
+        flags = "".join(c if result & bit else "-" for c, bit in FLAG_NAMES)
+        return f"0x{pc:04x}  {name:<5} flags {flags}"
+    return f"0x{pc:04x}  {name:<5} R{dest} = {result}"
@@ -1,6 +1,23 @@
+from __future__ import annotations
+import time
+
+# 'exec' measures its latency from here, everything else is imported when used
+START = time.perf_counter()
+
 import argparse
-from emulator import CPU, Memory, RegisterFile
-from assembler import Compiler
+import os
+import sys
+from typing import TYPE_CHECKING
+
+from budgets import EXEC_LATENCY_BUDGET
+
+if TYPE_CHECKING:
+    from assembler.cache import BuildCache
+    from emulator import CPU, Memory, RegisterFile
+    from emulator.profiler import Profiler
+
+# Seconds between two checks of the watched source
+WATCH_INTERVAL = 0.2
 
 
 def stp_file_checker(s: str) -> str:
@@ -30,6 +47,155 @@ compile_parser.add_argument(
     default="out.bin",
 )
 
+compile_parser.add_argument(
+    "--stream",
+    action="store_true",
+    help="write instructions to the output while reading the source, for very large sources",
+)
+
+compile_parser.add_argument(
+    "--watch",
+    action="store_true",
+    help="stay resident and reassemble the changed lines whenever the source changes",
+)
+
+compile_parser.add_argument(
+    "-O",
+    "--optimize",
+    action="store_true",
+    help="remove instructions without effect, unreachable code and jumps to jumps",
+)
+compile_parser.add_argument(
+    "--profile",
+    metavar="JSON_FILE",
+    help="profile of the unoptimized binary ('run --profile'), -O then reports measured savings",
+)
+
+compile_parser.add_argument(
+    "--no-cache",
+    action="store_true",
+    help="always assemble, neither read nor fill the build cache",
+)
+
+
+def add_cache_arguments(p: argparse.ArgumentParser):
+    # Defaults are filled in by open_cache, so the cache is only imported when used
+    p.add_argument(
+        "--cache-dir",
+        help="build cache directory (default: '~/.cache/stp')",
+    )
+    p.add_argument(
+        "--cache-size",
+        type=int,
+        metavar="MIB",
+        help="least recently used binaries are removed above this size (default 64)",
+    )
+
+
+add_cache_arguments(compile_parser)
+
+link_parser = subparsers.add_parser(
+    "link", help="assemble several modules and link them into one binary"
+)
+link_parser.add_argument(
+    "inputs",
+    nargs="+",
+    help="'.stp' modules or '.o' object files, laid out in the given order",
+)
+link_parser.add_argument(
+    "-o",
+    "--output",
+    type=bin_file_checker,
+    help="path to output file (default: './out.bin')",
+    default="out.bin",
+)
+link_parser.add_argument(
+    "--obj-dir",
+    default="obj",
+    help="directory of the object files of '.stp' modules (default: './obj')",
+)
+link_parser.add_argument(
+    "-j", "--jobs", type=int, help="number of worker processes (default: cpu count)"
+)
+
+cache_parser = subparsers.add_parser("cache", help="build cache statistics")
+add_cache_arguments(cache_parser)
+cache_parser.add_argument(
+    "--clear", action="store_true", help="remove all cached binaries and statistics"
+)
+
+
+def add_run_arguments(p: argparse.ArgumentParser):
+    p.add_argument(
+        "-pm",
+        "--print-memory",
+        type=int,
+        nargs="*",
+        help="print memory from given range (default range 0 100)",
+    )
+    p.add_argument(
+        "-pr", "--print-register", action="store_true", help="print reigsters"
+    )
+    p.add_argument(
+        "-dm",
+        "--dump-memory",
+        type=str,
+        help="write the whole memory to the given file after the run",
+    )
+    p.add_argument(
+        "--lazy-flags",
+        action="store_true",
+        help="only compute flags when an instruction or the user reads them",
+    )
+    p.add_argument(
+        "--jit",
+        action="store_true",
+        help="translate basic blocks to python instead of interpreting each instruction",
+    )
+    p.add_argument(
+        "--predecode",
+        action="store_true",
+        help="decode the whole memory before the first instruction (needs numpy)",
+    )
+    p.add_argument(
+        "--console",
+        type=int,
+        nargs="?",
+        const=0,
+        metavar="PORT",
+        help="attach stdin and stdout to a port for INB/OUTB (default port: 0)",
+    )
+    p.add_argument(
+        "--port-in",
+        nargs=2,
+        action="append",
+        default=[],
+        metavar=("PORT", "FILE"),
+        help="INB on PORT reads from FILE, can be repeated",
+    )
+    p.add_argument(
+        "--port-out",
+        nargs=2,
+        action="append",
+        default=[],
+        metavar=("PORT", "FILE"),
+        help="OUTB on PORT writes to FILE, can be repeated",
+    )
+    p.add_argument(
+        "--trace",
+        nargs="?",
+        const="out.trace",
+        metavar="TRACE_FILE",
+        help="record every executed instruction, read with 'trace' (default: ./out.trace)",
+    )
+    p.add_argument(
+        "--trace-last",
+        type=int,
+        metavar="N",
+        help="only keep the last N instructions in the trace",
+    )
+
+
 run_parser = subparsers.add_parser("run", help="run help")
 run_parser.add_argument(
     "input",
@@ -38,28 +204,200 @@ run_parser.add_argument(
     default="out.bin",
     nargs="?",
 )
+add_run_arguments(run_parser)
 run_parser.add_argument(
-    "-pm",
-    "--print-memory",
-    type=int,
-    nargs="*",
-    help="print memory from given range (default range 0 100)",
+    "--profile",
+    nargs="?",
+    const="profile.json",
+    metavar="JSON_FILE",
+    help="print an execution profile and save it as json (default: ./profile.json)",
 )
 run_parser.add_argument(
-    "-pr", "--print-register", action="store_true", help="print reigsters"
+    "--source",
+    type=stp_file_checker,
+    help="source of the binary, adds source lines to the profile",
 )
 
-ns = parser.parse_args()
-if ns.command == "compile":
-    c = Compiler(ns.input)
+exec_parser = subparsers.add_parser(
+    "exec", help="assemble and run a source in one go, without an output file"
+)
+exec_parser.add_argument("input", type=stp_file_checker, help="path to spt file")
+add_run_arguments(exec_parser)
+exec_parser.add_argument(
+    "--latency",
+    action="store_true",
+    help=f"print the time until the first instruction runs (budget {1000 * EXEC_LATENCY_BUDGET:.0f} ms)",
+)
+
+disasm_parser = subparsers.add_parser(
+    "disasm", help="list the instructions of a binary"
+)
+disasm_parser.add_argument(
+    "input",
+    type=bin_file_checker,
+    help="binary to disassemble (default out.bin)",
+    default="out.bin",
+    nargs="?",
+)
+disasm_parser.add_argument(
+    "-o", "--output", help="path to the listing (default: stdout)"
+)
+disasm_parser.add_argument(
+    "--all",
+    action="store_true",
+    help="list every word, runs of zero words are collapsed by default",
+)
+
+trace_parser = subparsers.add_parser(
+    "trace", help="print the instructions recorded by 'run --trace'"
+)
+trace_parser.add_argument(
+    "input",
+    help="trace file (default out.trace)",
+    default="out.trace",
+    nargs="?",
+)
+trace_range = trace_parser.add_mutually_exclusive_group()
+trace_range.add_argument(
+    "-n",
+    "--last",
+    type=int,
+    default=20,
+    metavar="N",
+    help="print the last N records (default 20)",
+)
+trace_range.add_argument(
+    "--first", type=int, metavar="N", help="print the first N records"
+)
+trace_range.add_argument("--all", action="store_true", help="print every record")
+
+batch_parser = subparsers.add_parser("batch", help="batch help")
+batch_parser.add_argument(
+    "inputs",
+    nargs="+",
+    help="binaries, directories containing binaries or glob patterns",
+)
+batch_parser.add_argument(
+    "-o",
+    "--output",
+    help="path to the json lines result file (default: stdout)",
+)
+batch_parser.add_argument(
+    "-j", "--jobs", type=int, help="number of worker processes (default: cpu count)"
+)
+batch_parser.add_argument(
+    "--max-instructions",
+    type=int,
+    default=10_000_000,
+    help="instruction budget per program (default 10000000)",
+)
+batch_parser.add_argument(
+    "--timeout",
+    type=float,
+    default=60.0,
+    help="wall-clock timeout per program in seconds (default 60)",
+)
+batch_parser.add_argument(
+    "-m",
+    "--memory",
+    type=int,
+    nargs=2,
+    action="append",
+    default=[],
+    metavar=("FROM", "TO"),
+    help="memory range to include in the results, can be repeated",
+)
+batch_parser.add_argument("--jit", action="store_true", help="see 'run --jit'")
+batch_parser.add_argument(
+    "--lazy-flags", action="store_true", help="see 'run --lazy-flags'"
+)
+
+
+def open_cache(ns: argparse.Namespace) -> BuildCache:
+    from assembler.cache import BuildCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_SIZE
+
+    size = DEFAULT_MAX_SIZE if ns.cache_size is None else ns.cache_size * 2**20
+    return BuildCache(ns.cache_dir or DEFAULT_CACHE_DIR, size)
+
+
+def collect_binaries(inputs: list[str]) -> list[str]:
+    import glob
+
+    paths = []
+    for i in inputs:
+        if os.path.isdir(i):
+            paths.extend(sorted(glob.glob(os.path.join(i, "*.bin"))))
+        elif glob.has_magic(i):
+            paths.extend(sorted(glob.glob(i, recursive=True)))
+        else:
+            paths.append(bin_file_checker(i))
+    return paths
+
+
+def make_profiler(m: Memory, source: str | None):
+    from assembler import Compiler
+    from emulator.profiler import Profiler
+
+    if source is None:
+        return Profiler(m.size)
+    c = Compiler(source)
     c.build()
-    c.output(ns.output)
-elif ns.command == "run":
-    m = Memory(2**16)
-    m.load_from_file(ns.input)
-    r = RegisterFile(10, 3)
-    c = CPU(m, r)
-    c.run()
+    with open(source, "r") as f:
+        lines = f.read().split("\n")
+    return Profiler(m.size, c.line_map, lines)
+
+
+def make_tracer(ns: argparse.Namespace):
+    if ns.trace is None and ns.trace_last is None:
+        return None
+    from emulator.tracer import Tracer
+
+    if ns.trace_last is not None:
+        return Tracer(ns.trace or "out.trace", ns.trace_last, keep_all=False)
+    return Tracer(ns.trace)
+
+
+def attach_devices(cpu: CPU, ns: argparse.Namespace):
+    from emulator.devices import ConsoleDevice, StreamDevice
+
+    if ns.console is not None:
+        cpu.bus.attach(ns.console, ConsoleDevice())
+    # Input and output file of a port share one device
+    files: dict[int, list[str | None]] = {}
+    for port, path in ns.port_in:
+        files.setdefault(int(port), [None, None])[0] = path
+    for port, path in ns.port_out:
+        files.setdefault(int(port), [None, None])[1] = path
+    for port, (i, o) in files.items():
+        cpu.bus.attach(port, StreamDevice.open(i, o))
+
+
+def run_cpu(cpu: CPU, ns: argparse.Namespace, profiler: Profiler | None = None):
+    """Runs 'cpu', a trace and buffered output are written even if the program crashes"""
+    attach_devices(cpu, ns)
+    tracer = make_tracer(ns)
+    try:
+        if profiler is not None:
+            cpu.run(profiler=profiler)
+        elif tracer is not None:
+            cpu.run(tracer=tracer)
+        else:
+            cpu.run(jit=ns.jit)
+    finally:
+        cpu.bus.close()
+        if tracer is not None:
+            tracer.close()
+            print(
+                f"Traced {tracer.recorded} instructions to '{tracer.path}'",
+                file=sys.stderr,
+            )
+    if cpu.waiting is not None and cpu.bus[cpu.waiting].ended:
+        print(f"Stopped at 'INB', input on port {cpu.waiting} ended", file=sys.stderr)
+    elif cpu.waiting is not None:
+        print(f"Stopped at 'INB', no input on port {cpu.waiting}", file=sys.stderr)
+
+
+def print_results(ns: argparse.Namespace, m: Memory, r: RegisterFile):
     if ns.print_memory is not None:
         if len(ns.print_memory) == 0:
             m.print_bytes(0, 100)
@@ -67,5 +405,237 @@ elif ns.command == "run":
             m.print_bytes(0, ns.print_memory[0])
         elif len(ns.print_memory) >= 2:
             m.print_bytes(ns.print_memory[0], ns.print_memory[1])
+    if ns.dump_memory:
+        m.dump_to_file(ns.dump_memory)
     if ns.print_register:
-        print(r.registers)
+        print(list(r.registers))
+
+
+def run_file(ns: argparse.Namespace):
+    from emulator import CPU, Memory, RegisterFile
+
+    m = Memory(2**16)
+    m.load_from_file(ns.input)
+    r = RegisterFile(10, 3)
+    c = CPU(m, r, lazy_flags=ns.lazy_flags)
+    if ns.predecode:
+        c.predecode()
+    profiler = None
+    if ns.profile:
+        profiler = make_profiler(m, ns.source)
+    run_cpu(c, ns, profiler)
+    if profiler:
+        print(profiler.report())
+        profiler.save(ns.profile)
+    print_results(ns, m, r)
+
+
+def exec_source(ns: argparse.Namespace):
+    """Assembles in memory and runs the program straight from the compiler's buffer"""
+    from assembler.compiler import Compiler
+    from emulator.cpu import CPU
+    from emulator.memory import Memory
+    from emulator.register_file import RegisterFile
+
+    c = Compiler(ns.input)
+    c.build()
+    m = Memory(2**16, c.buffer)
+    r = RegisterFile(10, 3)
+    cpu = CPU(m, r, lazy_flags=ns.lazy_flags)
+    if ns.predecode:
+        cpu.predecode()
+    if ns.latency:
+        latency = time.perf_counter() - START
+        print(
+            f"First instruction after {1000 * latency:.1f} ms "
+            f"(budget {1000 * EXEC_LATENCY_BUDGET:.0f} ms)",
+            file=sys.stderr,
+        )
+        if latency > EXEC_LATENCY_BUDGET:
+            print("Latency budget exceeded", file=sys.stderr)
+    run_cpu(cpu, ns)
+    print_results(ns, m, r)
+
+
+def disassemble_binary(ns: argparse.Namespace):
+    from emulator.decoder import decode, disassemble
+
+    with open(ns.input, "rb") as f:
+        image = f.read()
+    lines = disassemble(decode(image), collapse_zeros=not ns.all)
+    if len(image) % 3:
+        lines.append(f"Ignored {len(image) % 3} trailing byte(s)")
+    out = open(ns.output, "w") if ns.output else sys.stdout
+    try:
+        out.write("\n".join(lines) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def print_trace(ns: argparse.Namespace):
+    from emulator.tracer import TraceFile, describe
+
+    trace = TraceFile(ns.input)
+    try:
+        if ns.all:
+            start, stop = 0, len(trace)
+        elif ns.first is not None:
+            start, stop = 0, ns.first
+        else:
+            start, stop = len(trace) - ns.last, len(trace)
+        print(f"{len(trace)} records")
+        for index, pc, op, dest, result in trace.records(start, stop):
+            print(f"{index:>10}  {describe(pc, op, dest, result)}")
+    finally:
+        trace.close()
+
+
+def run_batch(ns: argparse.Namespace):
+    import json
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    from emulator.runner import run_binary
+
+    paths = collect_binaries(ns.inputs)
+    out = open(ns.output, "w") if ns.output else sys.stdout
+    try:
+        with ProcessPoolExecutor(ns.jobs) as executor:
+            futures = [
+                executor.submit(
+                    run_binary,
+                    path,
+                    ns.max_instructions,
+                    ns.timeout,
+                    ns.memory,
+                    ns.jit,
+                    ns.lazy_flags,
+                )
+                for path in paths
+            ]
+            for future in as_completed(futures):
+                out.write(json.dumps(future.result()) + "\n")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def link_modules(ns: argparse.Namespace):
+    from concurrent.futures import ProcessPoolExecutor
+    from assembler.linker import (
+        ObjectModule,
+        assemble_object,
+        is_stale,
+        link,
+        object_path,
+    )
+
+    objects = []
+    for i in ns.inputs:
+        if i.endswith(".stp"):
+            os.makedirs(ns.obj_dir, exist_ok=True)
+            objects.append((i, object_path(i, ns.obj_dir)))
+        else:
+            objects.append((None, i))
+    if len({path for _, path in objects}) < len(objects):
+        raise ValueError("Two modules would share the same object file")
+    stale = [(s, o) for s, o in objects if s is not None and is_stale(s, o)]
+    if len(stale) > 1:
+        with ProcessPoolExecutor(ns.jobs) as executor:
+            list(executor.map(assemble_object, *zip(*stale)))
+    elif stale:
+        assemble_object(*stale[0])
+    for source, _ in stale:
+        print(f"Assembled '{source}'")
+    buffer = link([ObjectModule.load(path) for _, path in objects])
+    with open(ns.output, "wb") as f:
+        f.write(buffer)
+
+
+def watch(ns: argparse.Namespace):
+    from assembler.incremental import IncrementalCompiler
+
+    c = IncrementalCompiler(ns.input)
+    mtime = None
+    print(f"Watching '{ns.input}', stop with Ctrl+C")
+    try:
+        while True:
+            if (current := os.stat(ns.input).st_mtime_ns) != mtime:
+                mtime = current
+                start = time.perf_counter()
+                try:
+                    changed = c.update()
+                except Exception as e:
+                    print(f"{type(e).__name__}: {e}")
+                else:
+                    if changed is not None:
+                        c.output_range(ns.output, *changed)
+                        ms = 1000 * (time.perf_counter() - start)
+                        print(
+                            f"Wrote bytes {changed[0]}-{changed[1]} of '{ns.output}' ({ms:.1f} ms)"
+                        )
+            time.sleep(WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    ns = parser.parse_args()
+    if ns.command == "compile" and ns.optimize and (ns.stream or ns.watch):
+        parser.error(
+            "-O needs the whole program, it can't be used with --stream or --watch"
+        )
+    if ns.command == "run" and ns.profile and (ns.trace or ns.trace_last):
+        parser.error("a run can't be profiled and traced at once")
+    # Profiled and traced runs are interpreted
+    if ns.command == "run" and ns.jit and ns.profile:
+        parser.error("--jit can't be used with --profile")
+    if ns.command in ("run", "exec") and ns.jit and (ns.trace or ns.trace_last):
+        parser.error("--jit can't be used with --trace or --trace-last")
+    if ns.command == "compile" and ns.watch:
+        watch(ns)
+    elif ns.command == "compile":
+        from assembler import Compiler
+
+        cache = None
+        if not ns.no_cache:
+            cache = open_cache(ns)
+        profile = None
+        if ns.profile:
+            import json
+
+            with open(ns.profile, "r") as f:
+                profile = json.load(f)
+        c = Compiler(ns.input, cache, ns.optimize, profile)
+        if ns.stream:
+            c.build_streaming(ns.output)
+        else:
+            c.build()
+            c.output(ns.output)
+        if c.report is not None:
+            print(c.report.summary())
+        elif ns.optimize and c.cached:
+            print("Optimized binary served from the build cache")
+    elif ns.command == "link":
+        link_modules(ns)
+    elif ns.command == "cache":
+        cache = open_cache(ns)
+        if ns.clear:
+            cache.clear()
+        stats = cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+        print(f"Hits:    {stats['hits']}")
+        print(f"Misses:  {stats['misses']}")
+        if lookups:
+            print(f"Hit rate: {100 * stats['hits'] / lookups:.1f}%")
+        print(f"Entries: {stats['entries']}")
+        print(f"Size:    {stats['size']} / {stats['max_size']} bytes")
+    elif ns.command == "run":
+        run_file(ns)
+    elif ns.command == "exec":
+        exec_source(ns)
+    elif ns.command == "disasm":
+        disassemble_binary(ns)
+    elif ns.command == "trace":
+        print_trace(ns)
+    elif ns.command == "batch":
+        run_batch(ns)
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from assembler import Compiler  # noqa: E402
+from emulator import CPU, Memory, RegisterFile  # noqa: E402
+
+
+@pytest.fixture
+def assemble(tmp_path):
+    """Assembles source text, returns the binary"""
+
+    def assemble(source: str, **options) -> bytes:
+        path = tmp_path / "program.stp"
+        path.write_text(source)
+        c = Compiler(str(path), **options)
+        c.build()
+        return bytes(c.buffer)
+
+    return assemble
+
+
+def machine(binary: bytes, lazy_flags: bool = False) -> CPU:
+    return CPU(Memory(2**16, bytearray(binary)), RegisterFile(10, 3), lazy_flags)
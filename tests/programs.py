@@ -0,0 +1,118 @@
+"""Random programs for comparing the execution modes of the emulator"""
+
+import random
+
+ALU_OPCODES = (1, 2, 3, 4, 5, 6, 8, 9, 10, 11)
+SHL, SHR, SUB, JMP, JZE, JNZ, HLT = 5, 6, 3, 17, 18, 19, 31
+LOOP_COUNTER = 15
+ALU_NAMES = ("ADD", "ADDC", "SUB", "SUBB", "SHL", "SHR", "AND", "OR", "XOR", "NOR")
+
+
+def alu(rnd: random.Random, registers: int) -> int:
+    opcode = rnd.choice(ALU_OPCODES)
+    d, s, t = (rnd.randrange(registers) for _ in range(3))
+    if rnd.random() < 0.5:
+        return opcode << 17 | d << 13 | s << 9 | t << 5
+    # Large shift counts only shift in zeros, small ones are more interesting
+    value = rnd.randrange(10) if opcode in (SHL, SHR) else rnd.randrange(256)
+    return 1 << 22 | opcode << 17 | d << 13 | s << 9 | value << 1
+
+
+def jump(opcode: int, target: int) -> int:
+    layout = 1 if target <= 0xFF else 3
+    return layout << 22 | opcode << 17 | target << 1
+
+
+def random_program(seed: int, length: int = 100, loops: int = 0) -> bytes:
+    """ALU instructions, NOPs and forward jumps, ending with 'HLT'
+
+    With 'loops' the body runs that many times, counted down in r15 which
+    the body doesn't write, so the same code executes again.
+    """
+    rnd = random.Random(seed)
+    words = []
+    if loops:
+        # r15 = loops
+        words.append(1 << 22 | 8 << 17 | LOOP_COUNTER << 13 | LOOP_COUNTER << 9)
+        words.append(
+            1 << 22 | 1 << 17 | LOOP_COUNTER << 13 | LOOP_COUNTER << 9 | loops << 1
+        )
+    start = len(words)
+    end = start + length
+    for i in range(start, end):
+        r = rnd.random()
+        if r < 0.1:
+            target = rnd.randrange(i + 1, end + 1) * 3
+            words.append(jump(rnd.choice((JMP, JZE, JNZ)), target))
+        elif r < 0.13:
+            words.append(0)
+        else:
+            words.append(alu(rnd, LOOP_COUNTER if loops else 16))
+    if loops:
+        words.append(
+            1 << 22 | SUB << 17 | LOOP_COUNTER << 13 | LOOP_COUNTER << 9 | 1 << 1
+        )
+        words.append(jump(JNZ, start * 3))
+    words.append(3 << 22 | HLT << 17)
+    return b"".join(w.to_bytes(3, "big") for w in words)
+
+
+def random_registers(seed: int, count: int = 16) -> list[int]:
+    rnd = random.Random(-seed - 1)
+    return [rnd.randrange(256) for _ in range(count)]
+
+
+def label(i: int) -> str:
+    # Labels are letters only
+    return "L" + "".join(chr(ord("A") + int(digit)) for digit in str(i))
+
+
+def random_source(seed: int, length: int = 100, loops: int = 0) -> str:
+    """Like random_program but as source, with what the optimizer rewrites
+
+    Mixes NOPs, identities, ADD/SUB pairs, jumps to the next instruction, jumps
+    to jumps and unreachable code behind 'JMP' into the instructions. Every
+    instruction gets a label, so jumps can land anywhere ahead.
+    """
+    rnd = random.Random(seed)
+    registers = LOOP_COUNTER if loops else 16
+    lines = []
+    if loops:
+        lines += ["AND r15, r15, 0", f"ADD r15, r15, {loops}", "LOOP:"]
+    for i in range(length):
+        lines.append(label(i) + ":")
+        r = rnd.random()
+        x = rnd.randrange(registers)
+        if r < 0.1:
+            jump = rnd.choice(("JMP", "JZE", "JNZ"))
+            lines.append(f"{jump} {label(rnd.randrange(i + 1, length + 1))}")
+        elif r < 0.13:
+            lines.append("NOP")
+        elif r < 0.18:
+            op, value = rnd.choice([("ADD", 0), ("SUB", 0), ("SHL", 0), ("OR", 0)])
+            lines.append(f"{op} r{x}, r{x}, {value}")
+        elif r < 0.22:
+            value = rnd.randrange(256)
+            first, second = rnd.sample(["ADD", "SUB"], 2)
+            lines += [f"{first} r{x}, r{x}, {value}", f"{second} r{x}, r{x}, {value}"]
+        elif r < 0.25:
+            # A jump to the next instruction, then one to a jump
+            lines += [f"JMP {label(i)}X", f"{label(i)}X:", f"JNZ {label(i)}Y"]
+            lines += [f"{label(i)}Y:", f"JMP {label(min(i + 2, length))}"]
+        elif r < 0.28:
+            lines += [f"JMP {label(i)}Z", f"ADD r{x}, r{x}, 1", f"{label(i)}Z:"]
+        else:
+            name = rnd.choice(list(ALU_NAMES))
+            d, s, t = (rnd.randrange(registers) for _ in range(3))
+            if rnd.random() < 0.5:
+                lines.append(f"{name} r{d}, r{s}, r{t}")
+            else:
+                value = (
+                    rnd.randrange(10) if name in ("SHL", "SHR") else rnd.randrange(256)
+                )
+                lines.append(f"{name} r{d}, r{s}, {value}")
+    lines.append(label(length) + ":")
+    if loops:
+        lines += ["SUB r15, r15, 1", "JNZ LOOP"]
+    lines += ["HLT", "ADD r1, r1, 1"]
+    return "\n".join(lines) + "\n"
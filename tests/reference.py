@@ -0,0 +1,65 @@
+"""The instruction set executed the plain way, as the first emulator did
+
+Fetches, decodes into named fields and looks up the operation by name for
+every instruction. Slow, but short enough to check by reading, the emulator
+is compared against it.
+"""
+
+CARRY, SIGN, ZERO = 1, 2, 4
+IMMEDIATE_MASKS = (None, 0xFF, 0xFFF, 0xFFFF)
+OPERATIONS = {
+    "ADD": lambda a, b, f: a + b,
+    "ADDC": lambda a, b, f: a + b + (1 if f & CARRY else 0),
+    "SUB": lambda a, b, f: a - b,
+    "SUBB": lambda a, b, f: a - b - (1 if f & SIGN else 0),
+    "SHL": lambda a, b, f: a << b,
+    "SHR": lambda a, b, f: a >> b,
+    "AND": lambda a, b, f: a & b,
+    "OR": lambda a, b, f: a | b,
+    "XOR": lambda a, b, f: a ^ b,
+    "NOR": lambda a, b, f: ~(a | b),
+}
+NAMES = {1: "ADD", 2: "ADDC", 3: "SUB", 4: "SUBB", 5: "SHL", 6: "SHR"}
+NAMES.update({8: "AND", 9: "OR", 10: "XOR", 11: "NOR"})
+NAMES.update({0: "NOP", 17: "JMP", 18: "JZE", 19: "JNZ", 31: "HLT"})
+
+
+def flags_of(value: int) -> int:
+    return (value == 0) * ZERO | ((value & 0x80) != 0) * SIGN | (value > 0xFF) * CARRY
+
+
+def run(binary: bytes, registers: list[int], max_steps: int = 1_000_000):
+    """Runs until 'HLT', returns (registers, flags, pc, executed instructions)
+
+    Only covers NOP, HLT, the ALU instructions and JMP/JZE/JNZ, which is
+    what the generated test programs contain.
+    """
+    memory = bytearray(binary) + bytes(2**16 - len(binary))
+    regs = list(registers)
+    flags = 0
+    pc = 0
+    for step in range(max_steps):
+        word = int.from_bytes(memory[pc : pc + 3], "big")
+        pc += 3
+        layout = word >> 22
+        name = NAMES[(word >> 17) & 0b11111]
+        fields = {"dest": (word >> 13) & 0xF, "src1": (word >> 9) & 0xF}
+        if layout == 0:
+            fields["src2"] = (word >> 5) & 0xF
+        else:
+            fields["val"] = (word >> 1) & IMMEDIATE_MASKS[layout]
+        if name == "HLT":
+            return regs, flags, pc, step + 1
+        if name in OPERATIONS:
+            a = regs[fields["src1"]]
+            b = regs[fields["src2"]] if "src2" in fields else fields["val"]
+            value = OPERATIONS[name](a, b, flags)
+            flags = flags_of(value)
+            regs[fields["dest"]] = value & 0xFF
+        elif name == "JMP":
+            pc = fields["val"]
+        elif name == "JZE" and flags & ZERO:
+            pc = fields["val"]
+        elif name == "JNZ" and not flags & ZERO:
+            pc = fields["val"]
+    raise RuntimeError(f"No 'HLT' after {max_steps} instructions")
@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+import reference
+from emulator.batch import BatchCPU
+from programs import random_program, random_registers
+
+LANES = 16
+
+
+def load(batch: BatchCPU, programs: list[bytes]):
+    """A different program in every lane"""
+    for lane, program in enumerate(programs):
+        batch.memory[lane, : len(program)] = np.frombuffer(program, dtype=np.uint8)
+    batch.reset()
+
+
+@pytest.mark.parametrize("seed", range(10))
+@pytest.mark.parametrize("budget", [None, 7])
+def test_lanes_match_reference(seed, budget):
+    seeds = [seed * LANES + lane for lane in range(LANES)]
+    programs = [random_program(2000 + s, loops=s % 4) for s in seeds]
+    registers = [random_registers(s) for s in seeds]
+    batch = BatchCPU(LANES)
+    load(batch, programs)
+    batch.registers[:] = registers
+    # Runs in slices continue where the last one stopped
+    while batch.run(budget) == budget:
+        pass
+    assert not batch.running.any() and not batch.errors.any()
+    for lane in range(LANES):
+        regs, flags, pc, executed = reference.run(programs[lane], registers[lane])
+        state = batch.lane_state(lane)
+        assert state["registers"] == regs
+        assert (int(state["flags"]), state["pc"]) == (flags, pc)
+        assert state["instructions"] == executed
+    # Halted lanes stay halted
+    before = batch.final_state()
+    assert batch.run() == 0
+    for name, value in batch.final_state().items():
+        assert (value == before[name]).all()
+
+
+def test_waiting_lanes_are_fed_and_resumed(assemble):
+    batch = BatchCPU(4)
+    batch.load_program(assemble("INB r1, 0\nADD r2, r1, 1\nOUTB r2, 1\nHLT\n"))
+    batch.feed(1, 0, b"\x29")
+    batch.run()
+    assert batch.waiting.tolist() == [0, -1, 0, 0]
+    assert batch.running.tolist() == [False] * 4
+    # Waiting lanes stay in front of the 'INB', which isn't counted
+    assert batch.pc.tolist() == [0, 12, 0, 0]
+    assert batch.instructions.tolist() == [0, 4, 0, 0]
+    assert batch.buses[1][1].output == bytearray(b"\x2a")
+
+    batch.feed(2, 0, b"\x07")
+    batch.run()
+    assert batch.lane_state(2)["registers"][2] == 8
+    assert batch.buses[2][1].output == bytearray(b"\x08")
+    assert batch.waiting.tolist() == [0, -1, -1, 0]
+    assert batch.instructions.tolist() == [0, 4, 4, 0]
+
+
+def test_faults_only_stop_their_lane(assemble):
+    batch = BatchCPU(5, memory_size=64, reg_count=4, ireg_count=0)
+    programs = [
+        assemble("ADD r1, r1, 1\nHLT\n"),
+        # Runs off the end of memory
+        assemble("JMP 63\n"),
+        assemble("LDB r1, 100\nHLT\n"),
+        # A register outside the register file
+        assemble("ADD r5, r1, 1\nHLT\n"),
+        # An unknown opcode
+        (25 << 17).to_bytes(3, "big"),
+    ]
+    load(batch, programs)
+    batch.run()
+    assert batch.errors.tolist() == [False, True, True, True, True]
+    # Stopped after the faulting instruction, or where the fetch failed
+    assert batch.pc.tolist() == [6, 63, 3, 3, 3]
+    assert batch.running.tolist() == [False] * 5
+    assert batch.registers[0, 1] == 1
+
+
+def test_feed_needs_a_queue_device():
+    from emulator.devices import StreamDevice
+
+    batch = BatchCPU(2)
+    batch.buses[0].attach(0, StreamDevice())
+    with pytest.raises(ValueError):
+        batch.feed(0, 0, b"x")
@@ -0,0 +1,41 @@
+import os
+import shutil
+
+from assembler import cache
+from assembler.cache import BuildCache
+
+
+def test_key_covers_source_options_and_assembler(tmp_path, monkeypatch):
+    source = tmp_path / "program.stp"
+    source.write_text("ADD r1, r1, 1\nHLT\n")
+    build_cache = BuildCache(str(tmp_path / "cache"))
+    key = build_cache.key(str(source))
+    assert build_cache.key(str(source)) == key
+    assert build_cache.key(str(source), "O") != key
+    source.write_text("ADD r1, r1, 2\nHLT\n")
+    assert build_cache.key(str(source)) != key
+    key = build_cache.key(str(source))
+
+    # A copy of the assembler with one file changed
+    copy = tmp_path / "assembler"
+    shutil.copytree(cache.ASSEMBLER_DIR, copy, ignore=shutil.ignore_patterns("*.pyc"))
+    monkeypatch.setattr(cache, "ASSEMBLER_DIR", str(copy))
+    cache.assembler_digest.cache_clear()
+    try:
+        assert build_cache.key(str(source)) == key
+        with open(os.path.join(copy, "ir.py"), "a") as f:
+            f.write("\n# changed\n")
+        cache.assembler_digest.cache_clear()
+        assert build_cache.key(str(source)) != key
+    finally:
+        cache.assembler_digest.cache_clear()
+
+
+def test_store_and_load(tmp_path):
+    build_cache = BuildCache(str(tmp_path))
+    assert build_cache.load("k") is None
+    build_cache.store("k", b"\x01\x02\x03")
+    assert build_cache.load("k") == b"\x01\x02\x03"
+    assert build_cache.stats()["hits"] == 1
+    assert build_cache.stats()["misses"] == 1
+    assert [p for p in os.listdir(tmp_path) if p.endswith(".tmp")] == []
@@ -0,0 +1,75 @@
+import pytest
+
+from conftest import machine
+from emulator.cpu import StopReason
+from emulator.scheduler import Scheduler
+
+# Adds 5, 4, 3, 2 and 1 to the byte at 0x100
+SUM = """
+.EQU DATA, 0x100
+ADD r1, r1, 5
+loop:
+LDB r2, DATA
+ADD r2, r2, r1
+STB r2, DATA
+SUB r1, r1, 1
+JNZ loop
+LDB r3, DATA
+HLT
+"""
+
+
+def test_breakpoint_stops_before_the_instruction(assemble):
+    cpu = machine(assemble(SUM))
+    cpu.add_breakpoint(0x6)
+    stop = cpu.continue_()
+    assert (stop.reason, stop.pc, cpu.running) == (StopReason.BREAKPOINT, 0x6, False)
+    assert cpu.registers.registers[2] == 0
+    # Continuing executes the instruction it stopped at
+    assert cpu.step().pc == 0x9
+    assert cpu.registers.registers[2] == 5
+
+
+@pytest.mark.parametrize("jit", [False, True])
+def test_write_watchpoint_stops_after_every_store(assemble, jit):
+    cpu = machine(assemble(SUM))
+    cpu.watch(0x100)
+    hits = []
+    while cpu.run(jit=jit) and cpu.stop.reason == StopReason.WATCHPOINT:
+        hits.append(cpu.stop.access)
+        assert cpu.stop.pc == 0xC
+    assert hits == [("write", 0x100, v) for v in (5, 9, 12, 14, 15)]
+    assert cpu.stopped().reason == StopReason.HALT
+    assert cpu.registers.registers[3] == 15
+
+
+@pytest.mark.parametrize("jit", [False, True])
+def test_step_after_run_stays_at_hlt(assemble, jit):
+    cpu = machine(assemble("ADD r1, r1, 1\nHLT\nADD r1, r1, 5\nHLT\n"))
+    cpu.run(jit=jit)
+    assert (cpu.registers.registers[1], cpu.pc) == (1, 6)
+    for stop in (cpu.step(), cpu.continue_(), cpu.run_until(9)):
+        assert (stop.reason, stop.pc) == (StopReason.HALT, 6)
+    assert cpu.registers.registers[1] == 1
+
+
+def test_read_watchpoint_and_unwatch(assemble):
+    cpu = machine(assemble(SUM))
+    cpu.watch(0x100, read=True, write=False)
+    assert cpu.continue_().access == ("read", 0x100, 0)
+    cpu.unwatch(0x100)
+    assert cpu.continue_().reason == StopReason.HALT
+    assert "load_byte" not in vars(cpu.memory)
+
+
+def test_scheduler_keeps_stopped_machines_until_resumed(assemble):
+    scheduler = Scheduler(quantum=100)
+    cpu = machine(assemble(SUM))
+    cpu.add_breakpoint(0x12)
+    task = scheduler.add(cpu)
+    scheduler.run()
+    assert (task.status, cpu.pc) == ("stopped", 0x12)
+    scheduler.resume(task)
+    scheduler.run()
+    assert task.status == "halted"
+    assert task.cycles == 28
@@ -0,0 +1,69 @@
+import random
+
+import pytest
+
+from emulator import CPU, Memory, RegisterFile
+from emulator.decoder import decode, disassemble
+
+WORDS_PER_RUN = 2**16 // 3
+
+
+def words(seed: int) -> list[int]:
+    """Every layout and opcode with extreme fields, then random words"""
+    if seed == 0:
+        return [
+            i << 17 | fields
+            for i in range(128)
+            for fields in (0, 0x1FFFF, 0x1E000, 0x01E00, 0x001E0, 0x1, 0x15555)
+        ]
+    rnd = random.Random(seed)
+    return [rnd.randrange(2**24) for _ in range(WORDS_PER_RUN)]
+
+
+def decode_instr(cpu: CPU, word: int):
+    """CPU.decode_instr, None for words it skips or can't decode"""
+    cpu.instr_buffer = word
+    try:
+        entry = cpu.decode_instr()
+    except ValueError:
+        # Unknown opcode
+        return None
+    return None if entry[0] == cpu.skip_instr else entry
+
+
+@pytest.mark.parametrize("seed", range(4))
+@pytest.mark.parametrize("registers", [(10, 3), (4, 1)])
+def test_predecode_matches_decode_instr(seed, registers):
+    sample = words(seed)
+    image = bytearray(b"".join(w.to_bytes(3, "big") for w in sample))
+    cpu = CPU(Memory(2**16, image), RegisterFile(*registers))
+    filled = cpu.predecode(0, 3 * len(sample))
+    expected = [decode_instr(cpu, w) for w in sample]
+    assert [cpu.icache[3 * i] for i in range(len(sample))] == expected
+    assert filled == sum(e is not None for e in expected)
+
+
+def test_decode_fields():
+    sample = words(1)
+    image = b"".join(w.to_bytes(3, "big") for w in sample)
+    decoded = decode(image, 0x30)
+    cpu = CPU(Memory(2**16), RegisterFile(10, 3))
+    assert decoded.words.tolist() == sample
+    assert decoded.addresses().tolist()[:2] == [0x30, 0x33]
+    for i, word in enumerate(sample[:2000]):
+        cpu.instr_buffer = word
+        layout = word >> 22
+        fields = (cpu.decode_L0, cpu.decode_L1, cpu.decode_L2, cpu.decode_L3)[layout]()
+        assert (decoded.layout[i], decoded.opcode[i]) == (layout, word >> 17 & 31)
+        assert (decoded.d[i], decoded.s[i], decoded.x[i]) == fields
+
+
+def test_disassemble():
+    image = bytes.fromhex("422006" "000000" "000000" "000000" "e3fffe" "fe0000")
+    assert disassemble(decode(image)) == [
+        "0x0000  422006  ADD R1, R0, 3",
+        "0x0003  000000  NOP",
+        "*        2 more zero words",
+        "0x000c  e3fffe  JMP 65535",
+        "0x000f  fe0000  HLT",
+    ]
@@ -0,0 +1,105 @@
+import io
+
+import pytest
+
+from conftest import machine
+from emulator import devices
+from emulator.devices import DeviceBus, QueueDevice, StreamDevice
+
+ECHO = "loop:\nINB r1, 0\nOUTB r1, 1\nJMP loop\n"
+
+
+class Input(io.RawIOBase):
+    """Input stream that records the output written before each read"""
+
+    def __init__(self, data: bytes, output: io.BytesIO):
+        self.data = io.BytesIO(data)
+        self.output = output
+        self.seen: list[bytes] = []
+
+    def readable(self) -> bool:
+        return True
+
+    def read1(self, size: int) -> bytes:
+        self.seen.append(self.output.getvalue())
+        return self.data.read(size)
+
+
+def test_queue_device():
+    device = QueueDevice()
+    assert device.read() is None
+    device.feed(b"\x01\x02")
+    device.write(7)
+    assert (device.read(), device.read(), device.read()) == (1, 2, None)
+    assert device.output == bytearray(b"\x07") and not device.ended
+
+
+def test_stream_device_buffers_reads_and_writes(monkeypatch):
+    monkeypatch.setattr(devices, "READ_AHEAD", 3)
+    monkeypatch.setattr(devices, "FLUSH_SIZE", 4)
+    output = io.BytesIO()
+    source = Input(b"abcdefg", output)
+    device = StreamDevice(source, output)
+    assert device.read() == ord("a")
+    for byte in b"xyz":
+        device.write(byte)
+    # Collected until FLUSH_SIZE bytes, or until more input is read
+    assert output.getvalue() == b""
+    assert (device.read(), device.read()) == (ord("b"), ord("c"))
+    assert output.getvalue() == b""
+    assert device.read() == ord("d")
+    assert output.getvalue() == b"xyz"
+    for byte in b"1234":
+        device.write(byte)
+    assert output.getvalue() == b"xyz1234"
+    device.write(ord("5"))
+    assert [device.read() for _ in range(4)] == [ord("e"), ord("f"), ord("g"), None]
+    # Output is written before every read ahead, the prompt comes first
+    assert source.seen == [b"", b"xyz", b"xyz12345", b"xyz12345"]
+    assert device.ended
+
+
+def test_stream_device_without_input_has_ended():
+    device = StreamDevice(output=io.BytesIO())
+    assert device.read() is None and device.ended
+
+
+def test_close_owned_streams_once(tmp_path):
+    (tmp_path / "in.bin").write_bytes(b"\x05")
+    device = StreamDevice.open(str(tmp_path / "in.bin"), str(tmp_path / "out.bin"))
+    device.write(9)
+    bus = DeviceBus()
+    bus.attach(0, device)
+    bus.attach(1, device)
+    assert bus.unique() == [device]
+    bus.close()
+    assert device.input.closed and device.output.closed
+    assert (tmp_path / "out.bin").read_bytes() == b"\x09"
+    # Streams passed in stay open
+    output = io.BytesIO()
+    StreamDevice(output=output).close()
+    assert not output.closed
+
+
+@pytest.mark.parametrize("jit", [False, True])
+def test_echo_through_files(tmp_path, monkeypatch, assemble, jit):
+    monkeypatch.setattr(devices, "READ_AHEAD", 5)
+    monkeypatch.setattr(devices, "FLUSH_SIZE", 7)
+    data = bytes(range(256)) * 3
+    (tmp_path / "in.bin").write_bytes(data)
+    cpu = machine(assemble(ECHO))
+    cpu.bus.attach(0, StreamDevice.open(input=str(tmp_path / "in.bin")))
+    cpu.bus.attach(1, StreamDevice.open(output=str(tmp_path / "out.bin")))
+    cpu.run(jit=jit)
+    # Parked at the 'INB' after the end of the input
+    assert (cpu.waiting, cpu.pc, cpu.bus[0].ended) == (0, 0, True)
+    cpu.bus.close()
+    assert (tmp_path / "out.bin").read_bytes() == data
+
+
+def test_feed_needs_a_queue_device(assemble):
+    cpu = machine(assemble(ECHO))
+    cpu.feed(0, b"\x01")
+    cpu.bus.attach(0, StreamDevice())
+    with pytest.raises(ValueError):
+        cpu.feed(0, b"\x01")
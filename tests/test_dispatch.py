@@ -0,0 +1,28 @@
+import os
+
+import pytest
+
+import reference
+from conftest import machine
+from programs import random_program, random_registers
+
+
+def run(binary: bytes, registers: list[int], **options):
+    cpu = machine(binary)
+    cpu.registers.registers[:] = bytes(registers)
+    executed = cpu.run(**options)
+    return list(cpu.registers.registers), int(cpu.flags), cpu.pc, executed
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_matches_reference(seed):
+    binary = random_program(seed, loops=seed % 3)
+    registers = random_registers(seed)
+    assert run(binary, registers) == tuple(reference.run(binary, registers))
+
+
+def test_example(assemble):
+    with open(os.path.join(os.path.dirname(__file__), "..", "example.stp")) as f:
+        binary = assemble(f.read())
+    assert run(binary, [0] * 16) == tuple(reference.run(binary, [0] * 16))
+    assert run(binary, [0] * 16)[0][2] == 55
@@ -0,0 +1,110 @@
+import pytest
+
+from assembler.compiler import CompilationError
+from assembler.expression import Expression, SymbolTable
+from assembler.stp_parser import Parser, ParsingError
+
+
+def operand(source: str):
+    """The operand of 'JMP source' as the parser leaves it"""
+    (instruction,) = Parser("<test>").parse_lines([f"JMP {source}\n"])
+    return instruction.operands[0]
+
+
+def value(assemble, source: str, immediate: int = 0xFFFF) -> int:
+    """The immediate 'source' assembles to"""
+    binary = assemble(source)
+    return int.from_bytes(binary[:3], "big") >> 1 & immediate
+
+
+@pytest.mark.parametrize(
+    "source, expected",
+    [
+        ("1 - 2 - 3", -4),
+        ("2 * 3 + 4", 10),
+        ("2 + 3 * 4", 14),
+        ("(2 + 3) * 4", 20),
+        ("16 / 4 / 2", 2),
+        ("7 / 2", 3),
+        # Floor division and modulo like Python
+        ("-7 / 2", -4),
+        ("-7 % 3", 2),
+        ("1 << 4 + 1", 32),
+        ("0x100 >> 4 >> 1", 8),
+        ("1 | 2 ^ 3 & 1", 3),
+        ("~0 & 0xFF", 0xFF),
+    ],
+)
+def test_constant_expressions_are_folded(assemble, source, expected):
+    assert operand(source) == expected
+    assert value(assemble, f"JMP {source}\n") == expected & 0xFFFF
+
+
+def test_expressions_on_labels_are_compiled():
+    expression = operand("L + 2 * 3 - M")
+    assert isinstance(expression, Expression)
+    assert expression.names == {"L", "M"}
+    assert expression.evaluate(SymbolTable({"L": 9, "M": 2})) == 13
+    # A single name is kept like a label operand
+    assert operand("L") == "L"
+
+
+def test_label_expressions(assemble):
+    assert value(assemble, "JMP END + 1\nNOP\nEND:\nHLT\n") == 7
+    assert value(assemble, "JMP (END - START) / 3\nSTART:\nNOP\nEND:\n") == 1
+
+
+def test_division_by_zero(assemble):
+    with pytest.raises(ParsingError):
+        assemble("JMP 1 / 0\n")
+    with pytest.raises(CompilationError):
+        assemble("JMP L % 0\nL:\n")
+
+
+def test_equ_refers_to_later_equ(assemble):
+    source = ".EQU A, B + 1\n.EQU B, C * 2\n.EQU C, 3\nADD r1, r0, A\n"
+    assert value(assemble, source, 0xFF) == 7
+
+
+def test_equ_refers_to_label(assemble):
+    assert value(assemble, ".EQU A, L - 3\nJMP A\nNOP\nL:\n") == 3
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        ".EQU A, A + 1\nJMP A\n",
+        ".EQU A, B + 1\n.EQU B, A\nADD r1, r0, A\n",
+        ".EQU A, B\n.EQU B, C\n.EQU C, A - 1\nJMP A\n",
+    ],
+)
+def test_cyclic_equ(assemble, source):
+    with pytest.raises(CompilationError, match="in terms of itself"):
+        assemble(source)
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        "L:\n.EQU L, 3\nHLT\n",
+        ".EQU L, 3\nL:\nJMP L\n",
+        ".EQU L, 3\nL:\nADD r1, r0, L + 1\n",
+    ],
+)
+def test_label_and_constant_clash(assemble, source):
+    with pytest.raises(CompilationError, match="both a label and a constant"):
+        assemble(source)
+
+
+def test_equ_defined_twice(assemble):
+    with pytest.raises(ParsingError):
+        assemble(".EQU A, 1\n.EQU A, 2\n")
+
+
+@pytest.mark.parametrize(
+    "source, expected",
+    [("-1", 0xFF), ("-2", 0xFE), ("-128", 0x80), ("-(1 + 2)", 0xFD), ("256", 0)],
+)
+def test_immediates_are_masked_to_8_bits(assemble, source, expected):
+    binary = assemble(f"ADD r1, r0, {source}\n")
+    assert binary == (1 << 22 | 1 << 17 | 1 << 13 | expected << 1).to_bytes(3, "big")
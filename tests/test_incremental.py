@@ -0,0 +1,71 @@
+import random
+import re
+
+import pytest
+
+from assembler.compiler import Compiler
+from assembler.incremental import IncrementalCompiler
+
+LABEL = re.compile(r"^(\w+):")
+
+
+def random_lines(rnd: random.Random, lines: list[str], broken: bool) -> list[str]:
+    """Jumps and label operands refer to defined labels
+
+    With 'broken' also statements spanning lines, which an edit may tear
+    apart, and invalid lines.
+    """
+    defined = [m.group(1) for line in lines if (m := LABEL.match(line))]
+    target = rnd.choice(defined) if defined else str(3 * rnd.randrange(10))
+    kind = rnd.randrange(40)
+    if kind < 4:
+        # Rarely defined twice
+        return ["".join(rnd.choice("ABCDEFGH") for _ in range(4)) + ":"]
+    if kind < 8:
+        return [f"{rnd.choice(['jmp', 'jze', 'jnz'])} {target}"]
+    if kind < 10:
+        return [f"add r1, r2, {target} + 1"]
+    if kind < 13:
+        return [rnd.choice(["", "# comment", "nop"])]
+    if kind == 13 and broken:
+        # A statement spanning two lines
+        return ["add r1,", " r2, r3"]
+    if kind == 14 and broken:
+        return [rnd.choice(["add r1,", "jmp", "hlt nop", "add r1, r2, r20", "x"])]
+    return [f"add r{rnd.randrange(16)}, r1, {rnd.randrange(300)}"]
+
+
+def edit(rnd: random.Random, lines: list[str], broken: bool):
+    i = rnd.randrange(len(lines) + 1)
+    kind = rnd.randrange(3)
+    if kind == 0 or not lines:
+        lines[i:i] = random_lines(rnd, lines, broken)
+    elif kind == 1:
+        del lines[min(i, len(lines) - 1)]
+    else:
+        lines[min(i, len(lines) - 1) : i + 1] = random_lines(rnd, lines, broken)
+
+
+def build(compiler: Compiler, update: bool = False):
+    """The binary, or the type of the error"""
+    try:
+        compiler.update() if update else compiler.build()
+    except Exception as e:
+        return type(e).__name__
+    return bytes(compiler.buffer)
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_edits_match_full_builds(tmp_path, seed):
+    rnd = random.Random(seed)
+    source = tmp_path / "program.stp"
+    broken = seed % 2 == 1
+    lines = []
+    for _ in range(rnd.randrange(1, 30)):
+        lines += random_lines(rnd, lines, broken)
+    source.write_text("\n".join(lines))
+    incremental = IncrementalCompiler(str(source))
+    for _ in range(40):
+        assert build(incremental, update=True) == build(Compiler(str(source)))
+        edit(rnd, lines, broken)
+        source.write_text("\n".join(lines))
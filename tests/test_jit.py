@@ -0,0 +1,41 @@
+import pytest
+
+from conftest import machine
+from programs import random_program, random_registers
+
+
+def run(binary: bytes, registers: list[int], jit: bool, budget: int | None = None):
+    """Runs in slices of 'budget' instructions, so blocks are entered midway too"""
+    cpu = machine(binary)
+    cpu.registers.registers[:] = bytes(registers)
+    executed = cpu.run(jit=jit, max_instructions=budget)
+    while cpu.running:
+        executed += cpu.run(jit=jit, max_instructions=budget)
+    return list(cpu.registers.registers), int(cpu.flags), cpu.pc, executed
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_blocks_match_interpreter(seed):
+    binary = random_program(1000 + seed, loops=seed % 4)
+    registers = random_registers(seed)
+    assert run(binary, registers, True) == run(binary, registers, False)
+
+
+@pytest.mark.parametrize("budget", [1, 7, 50])
+def test_budget_splits_blocks(budget):
+    binary = random_program(77, loops=3)
+    registers = random_registers(77)
+    assert run(binary, registers, True, budget) == run(binary, registers, False)
+
+
+def test_store_into_block_invalidates_it(assemble):
+    binary = assemble("ADD r1, r1, 1\nADD r2, r2, 2\nHLT\n")
+    cpu = machine(binary)
+    cpu.run(jit=True)
+    assert cpu.jit.translations == 1
+    # ADD r2, r2, 2 -> ADD r2, r2, 5
+    cpu.memory.store_byte(5, 5 << 1)
+    assert cpu.jit.invalidations == 1
+    cpu.pc = 0
+    cpu.run(jit=True)
+    assert list(cpu.registers.registers[1:3]) == [2, 7]
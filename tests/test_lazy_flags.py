@@ -0,0 +1,38 @@
+import pytest
+
+from conftest import machine
+from emulator.cpu import Flag
+from programs import random_program, random_registers
+
+
+def run(binary: bytes, registers: list[int], lazy: bool, jit: bool):
+    cpu = machine(binary, lazy_flags=lazy)
+    cpu.registers.registers[:] = bytes(registers)
+    executed = cpu.run(jit=jit)
+    return list(cpu.registers.registers), int(cpu.flags), cpu.pc, executed
+
+
+@pytest.mark.parametrize("jit", [False, True])
+@pytest.mark.parametrize("seed", range(40))
+def test_lazy_flags_match_eager(seed, jit):
+    binary = random_program(2000 + seed, loops=seed % 3)
+    registers = random_registers(seed)
+    assert run(binary, registers, True, jit) == run(binary, registers, False, False)
+
+
+def test_flags_read_between_steps(assemble):
+    # 0x80 + 0x80 sets CARRY, 0 - 1 then only SIGN
+    binary = assemble("ADD r1, r1, 128\nADD r2, r1, r1\nSUB r3, r3, 1\nHLT\n")
+    eager, lazy = machine(binary), machine(binary, lazy_flags=True)
+    for _ in range(4):
+        eager.run(max_instructions=1)
+        lazy.run(max_instructions=1)
+        assert lazy.flags == eager.flags
+    assert lazy.flags == Flag.SIGN
+
+
+def test_assigned_flags_drop_pending_result(assemble):
+    cpu = machine(assemble("ADD r1, r1, 0\nHLT\n"), lazy_flags=True)
+    cpu.run(max_instructions=1)
+    cpu.flags = Flag.CARRY
+    assert cpu.flags == Flag.CARRY
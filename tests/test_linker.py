@@ -0,0 +1,76 @@
+import os
+
+import pytest
+
+from assembler import linker
+from assembler.compiler import Compiler
+from assembler.linker import LinkError, ObjectModule, assemble_object, is_stale, link
+from programs import random_source
+
+
+def modules(tmp_path, source: str, count: int) -> list[str]:
+    """Splits 'source' into 'count' modules at line boundaries"""
+    lines = source.splitlines(keepends=True)
+    cuts = [len(lines) * i // count for i in range(count + 1)]
+    paths = []
+    for i in range(count):
+        path = tmp_path / f"module{'abcdefgh'[i]}.stp"
+        path.write_text("".join(lines[cuts[i] : cuts[i + 1]]))
+        paths.append(str(path))
+    return paths
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_linking_matches_the_concatenated_source(tmp_path, seed):
+    source = random_source(seed, loops=seed % 3)
+    whole = tmp_path / "whole.stp"
+    whole.write_text(source)
+    c = Compiler(str(whole))
+    c.build()
+    paths = modules(tmp_path, source, 1 + seed % 4)
+    objects = []
+    for path in paths:
+        # Through the object files, like 'main.py link'
+        objects.append(assemble_object(path, path[:-4] + ".o"))
+    assert link([ObjectModule.load(o) for o in objects]) == c.buffer
+
+
+def test_own_labels_first_and_ambiguous_labels(tmp_path):
+    a = tmp_path / "a.stp"
+    b = tmp_path / "b.stp"
+    a.write_text("X:\nJMP X\nJMP Y\n")
+    b.write_text("X:\nJMP X\nY:\nHLT\n")
+    binary = link([ObjectModule.assemble(str(a)), ObjectModule.assemble(str(b))])
+    (tmp_path / "whole.stp").write_text("JMP 0\nJMP 9\nJMP 6\nHLT\n")
+    c = Compiler(str(tmp_path / "whole.stp"))
+    c.build()
+    assert binary == c.buffer
+    # 'X' is defined by both, a third module can't use it
+    (tmp_path / "c.stp").write_text("JMP X\n")
+    with pytest.raises(LinkError, match="several modules"):
+        link([ObjectModule.assemble(str(p)) for p in (a, b, tmp_path / "c.stp")])
+    with pytest.raises(LinkError, match="Unknown identifier"):
+        link([ObjectModule.assemble(str(tmp_path / "c.stp"))])
+
+
+def test_objects_of_another_assembler_are_stale(tmp_path, monkeypatch):
+    source = tmp_path / "a.stp"
+    source.write_text("ADD r1, r1, 1\nHLT\n")
+    obj = str(tmp_path / "a.o")
+    assert is_stale(str(source), obj)
+    assemble_object(str(source), obj)
+    assert not is_stale(str(source), obj)
+    # A newer source
+    stat = os.stat(obj)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert is_stale(str(source), obj)
+    assemble_object(str(source), obj)
+    assert not is_stale(str(source), obj)
+    # The object file of a different assembler or object format
+    monkeypatch.setattr(linker, "assembler_digest", lambda: bytes(32))
+    assert is_stale(str(source), obj)
+    monkeypatch.undo()
+    monkeypatch.setattr(linker, "OBJECT_VERSION", linker.OBJECT_VERSION + 1)
+    assert is_stale(str(source), obj)
+    with pytest.raises(LinkError):
+        ObjectModule.load(obj)
@@ -0,0 +1,73 @@
+import pytest
+
+import reference
+from assembler import Compiler
+from programs import random_registers, random_source
+
+
+def build(tmp_path, source: str, optimize: bool) -> Compiler:
+    path = tmp_path / "program.stp"
+    path.write_text(source)
+    compiler = Compiler(str(path), optimize=optimize)
+    compiler.build()
+    return compiler
+
+
+@pytest.mark.parametrize("seed", range(40))
+def test_optimized_programs_match_reference(tmp_path, seed):
+    source = random_source(seed, loops=seed % 3)
+    registers = random_registers(seed)
+    plain = build(tmp_path, source, False)
+    optimized = build(tmp_path, source, True)
+    assert sum(optimized.report.removed.values()) > 0
+    regs, flags, _, executed = reference.run(bytes(plain.buffer), registers)
+    opt_regs, opt_flags, _, opt_executed = reference.run(
+        bytes(optimized.buffer), registers
+    )
+    assert (opt_regs, opt_flags) == (regs, flags)
+    assert opt_executed <= executed
+
+
+REWRITES = [
+    ("nop", "NOP\nADD r1, r2, 3\nHLT", "ADD r1, r2, 3\nHLT"),
+    (
+        "identity",
+        "ADD r1, r1, 0\nAND r2, r2, 255\nADD r3, r3, 1\nHLT",
+        "ADD r3, r3, 1\nHLT",
+    ),
+    (
+        "add/sub pair",
+        "SUB r1, r1, 7\nADD r1, r1, 7\nADD r2, r2, 1\nHLT",
+        "ADD r2, r2, 1\nHLT",
+    ),
+    ("unreachable", "ADD r1, r1, 1\nHLT\nADD r2, r2, 1\n", "ADD r1, r1, 1\nHLT"),
+    (
+        "unreachable",
+        "JMP end\nADD r2, r2, 1\nend:\nADD r1, r1, 1\nHLT",
+        "ADD r1, r1, 1\nHLT",
+    ),
+    ("jump to next", "ADD r1, r1, 1\nJNZ next\nnext:\nHLT", "ADD r1, r1, 1\nHLT"),
+    (
+        "threaded",
+        "ADD r1, r1, 1\nJNZ a\nHLT\na:\nJMP b\nADD r3, r3, 1\nb:\nADD r4, r4, 1\nHLT",
+        "ADD r1, r1, 1\nJNZ b\nHLT\nb:\nADD r4, r4, 1\nHLT",
+    ),
+    # Flags that a later instruction reads keep their instructions
+    ("kept", "ADD r1, r1, 0\nJZE z\nHLT\nz:\nADD r2, r2, 1\nHLT", None),
+    ("kept", "ADD r1, r1, 7\nSUB r1, r1, 7\nADDC r2, r2, 0\nHLT", None),
+    ("kept", "SHL r1, r1, 0\nSUBB r2, r2, 0\nHLT", None),
+    ("kept", "ADD r1, r2, 1\nADD r1, r1, 0\nHLT", None),
+    ("kept", "ADD r1, r1, 0\nJMP a\na:\nJNZ b\nb:\nHLT", "ADD r1, r1, 0\nHLT"),
+]
+
+
+@pytest.mark.parametrize("reason, source, expected", REWRITES)
+def test_rewrites(tmp_path, reason, source, expected):
+    optimized = build(tmp_path, source, True)
+    expected = build(tmp_path, expected or source, False)
+    assert optimized.buffer == expected.buffer
+    report = optimized.report
+    if reason == "threaded":
+        assert report.threaded_jumps == 1
+    elif reason != "kept":
+        assert report.removed.get(reason, 0) > 0
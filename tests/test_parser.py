@@ -0,0 +1,69 @@
+import random
+
+import pytest
+
+from assembler.stp_parser import Parser
+
+PIECES = [
+    "add", "ADDC", "sub", "jmp", "jze", "hlt", "nop", "inb", "stb", "foo",
+    "r1", "R15", "r16", "r123", "rx", "R", "12", "300", "loop", "LOOP:", "x:",
+    ",", " ", "  ", "\t", "#c", "# comment, r1", "3a", "a_", ":", ".equ", "0",
+]  # fmt: skip
+
+
+def random_line(rnd: random.Random) -> str:
+    kind = rnd.randrange(8)
+    if kind < 3:
+        label = rnd.choice(["", "l:", "loop: "])
+        last = rnd.choice([" r3", "7", "loop", " r99"])
+        comment = rnd.choice(["", "#x"])
+        return f"{label} add r{rnd.randrange(20)}, r{rnd.randrange(3)},{last} {comment}"
+    if kind < 4:
+        return (
+            f" {rnd.choice(['jmp', 'jnz', 'hlt'])} {rnd.choice(['', 'l', '5', 'r1'])}"
+        )
+    pieces = (
+        rnd.choice(PIECES) + rnd.choice(["", " "]) for _ in range(rnd.randrange(7))
+    )
+    return "".join(pieces)
+
+
+def parse(source: str, fast: bool):
+    """The parsed program, or the type of the error"""
+    parser = Parser("<test>")
+    if not fast:
+        # Every line goes through the tokens
+        parser.parse_line = lambda line, number: None
+    try:
+        items = list(parser.parse_lines(source.splitlines(keepends=True)))
+    except Exception as e:
+        return type(e).__name__
+    return [(type(i).__name__, repr(i), i.line) for i in items]
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_fast_path_matches_token_parser(seed):
+    rnd = random.Random(seed)
+    for _ in range(200):
+        lines = [random_line(rnd) for _ in range(rnd.randrange(1, 5))]
+        source = "\n".join(lines) + rnd.choice(["", "\n"])
+        assert parse(source, True) == parse(source, False), source
+
+
+@pytest.mark.parametrize(
+    "source, word",
+    [
+        ("ADD r1, r1, 5", 0x42220A),
+        ("ADD r2, r2, r1", 0x024420),
+        ("nor r15, r0, r14", 0x17E1C0),
+        ("SUB r1, r1, 1", 0x462202),
+        ("JNZ 3", 0xE60006),
+        ("jmp 0xFFFF", 0xE3FFFE),
+        ("LDB r2, 256", 0x9E4200),
+        ("OUTB r3, 4095", 0x9C7FFE),
+        ("NOP", 0xC00000),
+        ("HLT", 0xFE0000),
+    ],
+)
+def test_encoding(assemble, source, word):
+    assert assemble(source + "\n") == word.to_bytes(3, "big")
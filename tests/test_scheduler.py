@@ -0,0 +1,104 @@
+import asyncio
+import io
+from collections import deque
+
+import pytest
+
+from conftest import machine
+from emulator.devices import StreamDevice
+from emulator.scheduler import Scheduler
+from programs import random_program, random_registers
+
+# Reads a byte, writes it plus one and halts
+INCREMENT = "INB r1, 0\nADD r2, r1, 1\nOUTB r2, 1\nHLT\n"
+
+
+@pytest.mark.parametrize("jit", [False, True])
+def test_round_robin_counts_like_plain_runs(jit):
+    scheduler = Scheduler(quantum=7, jit=jit)
+    expected = []
+    for seed in range(4):
+        binary = random_program(4000 + seed, loops=seed)
+        cpu = machine(binary)
+        cpu.registers.registers[:] = bytes(random_registers(seed))
+        alone = machine(binary)
+        alone.registers.registers[:] = bytes(random_registers(seed))
+        expected.append((alone.run(), list(alone.registers.registers)))
+        scheduler.add(cpu)
+    executed = scheduler.run()
+    assert executed == sum(count for count, _ in expected)
+    for task, (count, registers) in zip(scheduler.tasks, expected):
+        assert (task.status, task.cycles) == ("halted", count)
+        assert task.slices == -(-count // 7)
+        assert list(task.cpu.registers.registers) == registers
+
+
+@pytest.mark.parametrize("jit", [False, True])
+def test_parked_inb_is_not_counted(assemble, jit):
+    scheduler = Scheduler(jit=jit)
+    binary = assemble(INCREMENT)
+    tasks = [scheduler.add(machine(binary)) for _ in range(2)]
+    scheduler.feed(tasks[1], 0, b"\x09")
+    assert scheduler.run() == 4
+    assert [(t.status, t.cycles) for t in tasks] == [("waiting", 0), ("halted", 4)]
+    assert scheduler.ready == deque() and scheduler.parked == {tasks[0]}
+    # Feeding another port doesn't unpark it
+    scheduler.feed(tasks[0], 5, b"\x01")
+    assert tasks[0].status == "waiting"
+    scheduler.feed(tasks[0], 0, b"\x29")
+    assert tasks[0].status == "ready"
+    assert scheduler.run() == 4
+    assert (tasks[0].status, tasks[0].cycles) == ("halted", 4)
+    assert tasks[0].cpu.bus[1].output == bytearray(b"\x2a")
+
+
+def test_budget_and_error(assemble):
+    scheduler = Scheduler(quantum=3)
+    loop = scheduler.add(machine(assemble("l:\nJMP l\n")), max_instructions=10)
+    # Runs off the end of memory
+    crash = scheduler.add(machine(assemble("JMP 0xFFFF\n")))
+    scheduler.run()
+    assert (loop.status, loop.cycles, loop.slices) == ("budget", 10, 4)
+    assert crash.status == "error" and crash.error.startswith("IndexError")
+
+
+def test_machine_at_the_end_of_its_input_has_ended(assemble):
+    scheduler = Scheduler()
+    cpu = machine(assemble("INB r1, 0\n" * 3 + "HLT\n"))
+    output = io.BytesIO()
+    cpu.bus.attach(0, StreamDevice(io.BytesIO(b"ab")))
+    cpu.bus.attach(1, StreamDevice(output=output))
+    task = scheduler.add(cpu)
+    asyncio.run(asyncio.wait_for(scheduler.run_async(), 5))
+    assert (task.status, task.cycles, cpu.waiting) == ("ended", 2, 0)
+    assert scheduler.parked == set()
+
+
+def test_run_async_waits_for_feed(assemble):
+    scheduler = Scheduler()
+    output = io.BytesIO()
+    cpu = machine(assemble("OUTB r0, 1\n" + INCREMENT))
+    cpu.registers.registers[0] = 0x3F
+    cpu.bus.attach(1, StreamDevice(output=output))
+    task = scheduler.add(cpu)
+    other = scheduler.add(machine(assemble(INCREMENT)))
+
+    async def feed():
+        while task.status != "waiting" or other.status != "waiting":
+            await asyncio.sleep(0)
+        # The output of the parked machine was written
+        assert output.getvalue() == b"\x3f"
+        await asyncio.sleep(0.01)
+        scheduler.feed(task, 0, b"\x01")
+        await asyncio.sleep(0.01)
+        scheduler.feed(other, 0, b"\x02")
+
+    async def main():
+        return await asyncio.gather(scheduler.run_async(), feed())
+
+    executed, _ = asyncio.run(asyncio.wait_for(main(), 5))
+    assert executed == 5 + 4
+    assert (task.status, task.cycles) == ("halted", 5)
+    assert output.getvalue() == b"\x3f\x02"
+    assert other.cpu.bus[1].output == bytearray(b"\x03")
+    assert scheduler.wakeup is None
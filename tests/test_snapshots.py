@@ -0,0 +1,96 @@
+import random
+
+import pytest
+
+from conftest import machine
+from emulator import Memory
+from emulator.memory import PAGE_SIZE
+
+
+def write_randomly(memory: Memory, rnd: random.Random, pages: list[int], count: int):
+    for _ in range(count):
+        page = rnd.choice(pages)
+        memory.store_byte(
+            page * PAGE_SIZE + rnd.randrange(PAGE_SIZE), rnd.randrange(256)
+        )
+
+
+def copied_pages(memory: Memory) -> list[int]:
+    """Records the pages restore writes back"""
+    pages = []
+    memory.add_write_listener(lambda start, end: pages.append(start // PAGE_SIZE))
+    return pages
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_restore_after_writes_on_several_pages(seed):
+    rnd = random.Random(seed)
+    memory = Memory(2**16, bytearray(rnd.randbytes(1000)))
+    write_randomly(memory, rnd, list(range(256)), 500)
+    snapshot = memory.snapshot()
+    expected = bytes(memory.data)
+    pages = rnd.sample(range(256), 5)
+    write_randomly(memory, rnd, pages, 200)
+    copied = copied_pages(memory)
+    memory.restore(snapshot)
+    assert memory.data == expected
+    # Only the written pages are copied back
+    assert sorted(copied) == sorted(pages)
+    assert memory.dirty_pages == set()
+    copied.clear()
+    memory.restore(snapshot)
+    assert copied == []
+
+
+def test_nested_snapshots():
+    rnd = random.Random(1)
+    memory = Memory(2**16)
+    write_randomly(memory, rnd, [0, 1, 2], 100)
+    outer = memory.snapshot()
+    outer_data = bytes(memory.data)
+    write_randomly(memory, rnd, [2, 3], 100)
+    inner = memory.snapshot()
+    inner_data = bytes(memory.data)
+    # Pages that didn't change are shared between the snapshots
+    assert inner.pages[0] is outer.pages[0] and inner.pages[1] is outer.pages[1]
+    assert inner.pages[3] is not outer.pages[3]
+    write_randomly(memory, rnd, [1, 3, 4], 100)
+
+    copied = copied_pages(memory)
+    memory.restore(inner)
+    assert memory.data == inner_data
+    assert sorted(copied) == [1, 3, 4]
+    copied.clear()
+    memory.restore(outer)
+    assert memory.data == outer_data
+    assert sorted(copied) == [2, 3]
+    memory.restore(inner)
+    assert memory.data == inner_data
+    # Snapshots taken again after a restore still compare by page identity
+    assert memory.snapshot().pages == inner.pages
+
+
+@pytest.mark.parametrize("jit", [False, True])
+def test_restore_invalidates_translated_and_predecoded_code(assemble, jit):
+    cpu = machine(assemble("ADD r1, r1, 2\nADD r2, r2, r1\nHLT\n"))
+    snapshot = cpu.snapshot()
+    cpu.run(jit=jit)
+    assert list(cpu.registers.registers[1:3]) == [2, 2]
+
+    cpu.restore(snapshot)
+    assert (cpu.pc, list(cpu.registers.registers[1:3])) == (0, [0, 0])
+    # ADD r1, r1, 2 -> ADD r1, r1, 7
+    cpu.memory.store_byte(2, 7 << 1)
+    cpu.run(jit=jit)
+    assert list(cpu.registers.registers[1:3]) == [7, 7]
+
+    # Restoring the code drops what was decoded or translated from the change
+    invalidations = cpu.jit.invalidations if jit else 0
+    cpu.restore(snapshot)
+    assert cpu.icache[0] is None
+    if jit:
+        assert cpu.jit.invalidations == invalidations + 1
+        assert cpu.jit.blocks == {}
+    cpu.run(jit=jit)
+    assert list(cpu.registers.registers[1:3]) == [2, 2]
+    assert cpu.stopped().reason.name == "HALT"
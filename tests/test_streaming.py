@@ -0,0 +1,60 @@
+import os
+
+import pytest
+
+from assembler import compiler
+from assembler.compiler import Compiler, CompilationError
+from assembler.stp_parser import ParsingError
+from programs import random_source
+
+CONSTANTS = ".EQU BASE, 0x40\n.EQU STEP, LATE * 2\n.EQU LATE, BASE + 3\n"
+
+
+def build(path: str) -> bytes:
+    c = Compiler(path)
+    c.build()
+    return bytes(c.buffer)
+
+
+def sources():
+    with open(os.path.join(os.path.dirname(__file__), "..", "example.stp")) as f:
+        yield "example.stp", f.read()
+    for seed in range(5):
+        source = random_source(seed, loops=seed % 2)
+        # Forward references through constants and expressions on labels
+        source = CONSTANTS + source.replace(
+            "HLT", "ADD r1, r2, STEP\nJMP LB + BASE\nHLT"
+        )
+        yield f"random {seed}", source
+
+
+@pytest.mark.parametrize("chunk", [3, 9, compiler.WRITE_CHUNK])
+def test_streaming_matches_build(tmp_path, monkeypatch, chunk):
+    # Small chunks patch forward references in chunks already written
+    monkeypatch.setattr(compiler, "WRITE_CHUNK", chunk)
+    source_path = tmp_path / "program.stp"
+    out = tmp_path / "out.bin"
+    for name, source in sources():
+        source_path.write_text(source)
+        Compiler(str(source_path)).build_streaming(str(out))
+        assert out.read_bytes() == build(str(source_path)), name
+
+
+@pytest.mark.parametrize(
+    "error, source",
+    [
+        (ParsingError, "ADD r1, r1, 1\n" * 100 + "ADD r1,\n"),
+        (CompilationError, "JMP NOWHERE\n" + "ADD r1, r1, 1\n" * 100),
+        (CompilationError, ".EQU A, B\n.EQU B, A\nJMP A\n"),
+    ],
+)
+def test_failed_build_keeps_the_old_output(tmp_path, monkeypatch, error, source):
+    monkeypatch.setattr(compiler, "WRITE_CHUNK", 3)
+    source_path = tmp_path / "program.stp"
+    source_path.write_text(source)
+    out = tmp_path / "out.bin"
+    out.write_bytes(b"old binary")
+    with pytest.raises(error):
+        Compiler(str(source_path)).build_streaming(str(out))
+    assert out.read_bytes() == b"old binary"
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["out.bin", "program.stp"]
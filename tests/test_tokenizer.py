@@ -0,0 +1,84 @@
+import glob
+import os
+import random
+import re
+
+import pytest
+
+from assembler.tokenizer import TOKEN_DEFINTIONS, Tokenizer, TokenizationError
+from benchmarks.bench import generate_source
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+COMMENT = re.compile(r"\s*(#[^\n]*|\s+)")
+DEFINITIONS = {t: re.compile(p) for t, p in TOKEN_DEFINTIONS.items()}
+
+
+def old_tokens(buffer: str) -> list[tuple]:
+    """(type, value, line) the way the tokenizer worked before the Scanner
+
+    Skips comments and tries every definition in order on the rest of the
+    buffer, which it slices for every match.
+    """
+    buffer = buffer.upper()
+    pointer = 0
+    line = 1
+    tokens = []
+    while True:
+        while m := COMMENT.match(buffer[pointer:]):
+            pointer += m.end()
+            line += m[0].count("\n")
+        if pointer >= len(buffer):
+            return tokens
+        for token_type, definition in DEFINITIONS.items():
+            if m := definition.match(buffer[pointer:]):
+                pointer += m.end()
+                tokens.append((token_type, m[0], line))
+                break
+        else:
+            raise TokenizationError(
+                f"Unknown Token at '{buffer[pointer:pointer + 20]}'"
+            )
+
+
+def tokens(buffer: str) -> list[tuple]:
+    return [(t.token_type, t.value, t.line) for t in Tokenizer(buffer)]
+
+
+def sources():
+    paths = [os.path.join(ROOT, "example.stp")]
+    paths += sorted(glob.glob(os.path.join(ROOT, "benchmarks", "workloads", "*.stp")))
+    for path in paths:
+        with open(path) as f:
+            yield os.path.basename(path), f.read()
+
+
+@pytest.mark.parametrize("name, source", list(sources()))
+def test_files_tokenize_like_before(name, source):
+    assert tokens(source) == old_tokens(source)
+
+
+def test_generated_workload_tokenizes_like_before(tmp_path):
+    path = tmp_path / "generated.stp"
+    generate_source(str(path), 2000)
+    source = path.read_text()
+    assert tokens(source) == old_tokens(source)
+
+
+PIECES = [
+    "add", "r1", "R15", "r123", "loop", "LOOP:", ".equ", ".x", "0x1F", "0b101",
+    "0b2", "12", ",", "+", "-", "<<", ">>", "*", "(", ")", "~", " ", "\t", "\n",
+    "# c", "#", "$", "x:", "a_b", "é",
+]  # fmt: skip
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_random_fragments(seed):
+    rnd = random.Random(seed)
+    source = "".join(rnd.choice(PIECES) for _ in range(rnd.randrange(1, 20)))
+    try:
+        expected = old_tokens(source)
+    except TokenizationError:
+        with pytest.raises(TokenizationError):
+            tokens(source)
+    else:
+        assert tokens(source) == expected
@@ -0,0 +1,132 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from conftest import machine
+from emulator.tracer import NO_DEST, TraceFile, Tracer, describe
+from programs import random_program, random_registers
+
+MAIN = os.path.join(os.path.dirname(__file__), "..", "main.py")
+
+
+def trace(path, binary: bytes, seed: int, **options) -> Tracer:
+    cpu = machine(binary)
+    cpu.registers.registers[:] = bytes(random_registers(seed))
+    tracer = Tracer(str(path), **options)
+    cpu.run(tracer=tracer)
+    tracer.close()
+    return tracer
+
+
+def records(path) -> list[tuple]:
+    trace_file = TraceFile(str(path))
+    try:
+        return list(trace_file.records())
+    finally:
+        trace_file.close()
+
+
+def test_records_of_a_small_program(tmp_path, assemble):
+    binary = assemble("ADD r1, r1, 5\nSUB r2, r1, 5\nJZE 12\nNOP\nHLT\n")
+    cpu = machine(binary)
+    tracer = Tracer(str(tmp_path / "t"))
+    assert cpu.run(tracer=tracer) == 4
+    tracer.close()
+    assert records(tmp_path / "t") == [
+        (0, 0, 1 << 5 | 1, 1, 5),
+        (1, 3, 1 << 5 | 3, 2, 0),
+        (2, 6, 3 << 5 | 18, NO_DEST, 0b100),
+        (3, 12, 3 << 5 | 31, NO_DEST, 0b100),
+    ]
+    assert describe(3, 1 << 5 | 3, 2, 0) == "0x0003  SUB   R2 = 0"
+    assert describe(6, 3 << 5 | 18, NO_DEST, 0b100) == "0x0006  JZE   flags Z--"
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("capacity", [1, 7, 64])
+def test_full_buffers_are_written_as_chunks(tmp_path, seed, capacity):
+    binary = random_program(3000 + seed, loops=3)
+    whole = trace(tmp_path / "whole", binary, seed)
+    chunked = trace(tmp_path / "chunked", binary, seed, capacity=capacity)
+    assert chunked.recorded == whole.recorded
+    expected = records(tmp_path / "whole")
+    assert len(expected) == whole.recorded
+    assert records(tmp_path / "chunked") == expected
+    trace_file = TraceFile(str(tmp_path / "chunked"))
+    assert len(trace_file.chunks) == -(-whole.recorded // capacity)
+    # Slices across chunk boundaries
+    for start, stop in [(0, 3), (capacity - 1, capacity + 2), (5, 5), (-4, 10**9)]:
+        assert list(trace_file.records(start, stop)) == expected[max(start, 0) : stop]
+    trace_file.close()
+
+
+@pytest.mark.parametrize("capacity", [1, 10, 33, 10_000])
+def test_ring_buffer_keeps_the_last_records(tmp_path, capacity):
+    binary = random_program(3100, loops=2)
+    trace(tmp_path / "whole", binary, 1)
+    last = trace(tmp_path / "last", binary, 1, capacity=capacity, keep_all=False)
+    expected = records(tmp_path / "whole")
+    kept = records(tmp_path / "last")
+    assert last.recorded == len(expected)
+    assert kept == expected[-capacity:]
+    # Indices continue from the instructions that were dropped
+    assert kept[0][0] == max(len(expected) - capacity, 0)
+
+
+def test_truncated_chunk_is_ignored(tmp_path):
+    trace(tmp_path / "t", random_program(3200), 0, capacity=16)
+    with open(tmp_path / "t", "rb") as f:
+        data = f.read()
+    complete = records(tmp_path / "t")
+    (tmp_path / "t").write_bytes(data[:-5])
+    assert records(tmp_path / "t") == complete[: len(complete) // 16 * 16]
+
+
+def main(*args: str, cwd) -> str:
+    result = subprocess.run(
+        [sys.executable, MAIN, *args],
+        cwd=cwd,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout
+
+
+def test_trace_command(tmp_path):
+    (tmp_path / "p.stp").write_text(
+        "ADD r1, r1, 3\nloop:\nSUB r1, r1, 1\nJNZ loop\nHLT\n"
+    )
+    main("compile", "p.stp", "-o", "p.bin", cwd=tmp_path)
+    main("run", "p.bin", "--trace-last", "4", cwd=tmp_path)
+    lines = main("trace", "--all", cwd=tmp_path).splitlines()
+    assert lines == [
+        "4 records",
+        "         4  0x0006  JNZ   flags ---",
+        "         5  0x0003  SUB   R1 = 0",
+        "         6  0x0006  JNZ   flags Z--",
+        "         7  0x0009  HLT   flags Z--",
+    ]
+    assert main("trace", "--first", "1", cwd=tmp_path).splitlines()[1:] == lines[1:2]
+    assert main("trace", "--last", "2", cwd=tmp_path).splitlines()[1:] == lines[3:]
+    assert main("trace", "-n", "9", cwd=tmp_path).splitlines() == lines
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ("run", "p.bin", "--jit", "--trace"),
+        ("run", "p.bin", "--jit", "--trace-last", "4"),
+        ("run", "p.bin", "--jit", "--profile"),
+        ("exec", "p.stp", "--jit", "--trace"),
+    ],
+)
+def test_jit_is_rejected_with_trace_or_profile(tmp_path, args):
+    (tmp_path / "p.stp").write_text("HLT\n")
+    main("compile", "p.stp", "-o", "p.bin", cwd=tmp_path)
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        main(*args, cwd=tmp_path)
+    assert "--jit can't be used" in e.value.stderr
+    assert not (tmp_path / "out.trace").exists()